@@ -1,133 +1,160 @@
-import itertools
-
 import numpy as np
 import pandas as pd
 from model.image import Image
-from model.response import ResponseType2
+from model.pairwise_wins import PairwiseWins
+from model.response import Response, ResponseType2, ResponseType3
+from model.score_summary import ScoreSummaries
+from sqlalchemy import func, select, union_all
 from utils.database import engine, session
 from utils.logger import logger
 
 
-def copeland_score():
-    logger.info(f"Loading repeated measurements for intra-observer agreement evaluation.")
+def load_comparisons():
+    """
+    Loads all pairwise comparisons in the order the responses were given. Comparisons are type 2 responses and the
+    pairwise outcomes implied by type 3 (ranking) responses.
+
+    :return: A dataframe with columns `response_id`, `observer_id`, `group_id`, `img1_id`, `img2_id` and `choice`, one
+        row per response.
+    """
+    stmts = [
+        select(
+            response_class.id.label("response_id"),
+            response_class.observer_id,
+            Image.group_id,
+            response_class.img1_id,
+            response_class.img2_id,
+            response_class.choice,
+            response_class.created
+        ).join(
+            response_class, Image.id == response_class.img1_id
+        )
+        for response_class in (ResponseType2, ResponseType3)
+    ]
+    comparisons = union_all(*stmts).subquery()
+    stmt = select(
+        comparisons.c.response_id,
+        comparisons.c.observer_id,
+        comparisons.c.group_id,
+        comparisons.c.img1_id,
+        comparisons.c.img2_id,
+        comparisons.c.choice
+    ).order_by(
+        comparisons.c.created,
+        comparisons.c.response_id
+    )
+    return pd.read_sql(stmt, engine)
+
+
+def load_win_counts():
+    """
+    Loads win counts of all compared image pairs. The counts are kept up to date during response import, so loading
+    them takes time proportional to the number of compared pairs rather than the number of responses. If the counts do
+    not cover all imported comparisons, e.g. in a database created before the counts were kept, they are rebuilt from
+    all imported responses first.
+
+    :return: A dataframe with columns `group_id`, `image_a_id`, `image_b_id`, `wins_a`, `wins_b` and `n_compared`, one
+        row per compared pair.
+    """
+    n_comparisons = session.query(func.count(Response.id)).where(Response.type.in_([2, 3])).scalar()
+    if PairwiseWins.count_comparisons() != n_comparisons:
+        logger.info(f"Rebuilding pairwise win counts from {n_comparisons} imported comparisons.")
+        PairwiseWins.rebuild(load_comparisons())
+    return pd.read_sql(PairwiseWins.get_all(return_statement=True), engine)
+
+
+def win_tensor(counts):
+    """
+    Builds a tensor of pairwise wins for each image group from win counts of compared pairs.
+
+    Candidates of a group are all images that appear in at least one compared pair in that group. Groups with fewer
+    candidates than the largest group are padded.
+
+    :param counts: A dataframe as returned by `load_win_counts`.
+    :return: A tuple (candidates, wins, valid) where `candidates` is a dataframe with columns `group_id`, `img_id`,
+        `group_index` and `local_index` mapping each candidate to its position in the tensor, `wins` is a G x n x n
+        array where wins[g, i, j] is the number of times candidate i was chosen over candidate j in group g, and `valid`
+        is a G x n boolean mask of candidates that are not padding.
+    """
+    candidates = pd.concat([
+        counts[["group_id", "image_a_id"]].rename(columns={"image_a_id": "img_id"}),
+        counts[["group_id", "image_b_id"]].rename(columns={"image_b_id": "img_id"}),
+    ]).drop_duplicates().sort_values(["group_id", "img_id"], ignore_index=True)
+    candidates["group_index"] = pd.factorize(candidates["group_id"], sort=True)[0]
+    candidates["local_index"] = candidates.groupby("group_id").cumcount()
+
+    n_groups = candidates["group_index"].max() + 1 if len(candidates) != 0 else 0
+    n = candidates["local_index"].max() + 1 if len(candidates) != 0 else 0
+    valid = np.zeros((n_groups, n), dtype=bool)
+    valid[candidates["group_index"], candidates["local_index"]] = True
+
+    positions = candidates[["group_id", "img_id", "group_index", "local_index"]]
+    counts = counts.merge(
+        positions.rename(columns={"img_id": "image_a_id", "local_index": "i"}), on=["group_id", "image_a_id"]
+    ).merge(
+        positions.drop(columns="group_index").rename(columns={"img_id": "image_b_id", "local_index": "j"}),
+        on=["group_id", "image_b_id"]
+    )
+    g, i, j = counts["group_index"].to_numpy(), counts["i"].to_numpy(), counts["j"].to_numpy()
+
+    # each pair is stored once, so indices do not repeat and wins can be assigned directly
+    wins = np.zeros((n_groups, n, n), dtype=np.int64)
+    wins[g, i, j] = counts["wins_a"].to_numpy()
+    wins[g, j, i] = counts["wins_b"].to_numpy()
+    return candidates, wins, valid
+
+
+def copeland_from_wins(wins, valid):
+    """
+    Calculates Copeland score of each candidate from the wins tensor. A candidate gets a point for each candidate from
+    the same group it won more comparisons against, and half a point for each candidate it is tied with. Candidates
+    that were never compared with each other, e.g. in incomplete comparison designs, do not get any points for that
+    pair.
+
+    :param wins: A G x n x n array of pairwise wins, see `win_tensor`.
+    :param valid: A G x n boolean mask of candidates that are not padding.
+    :return: A G x n array of Copeland scores, padding candidates have score 0.
+    """
+    losses = wins.transpose(0, 2, 1)
+    opponents = valid[:, :, None] & valid[:, None, :] & ~np.eye(wins.shape[1], dtype=bool)[None, :, :]
+    beats = ((wins > losses) & opponents).sum(axis=2)
+    ties = ((wins == losses) & (wins + losses > 0) & opponents).sum(axis=2)
+    return beats + 0.5 * ties
 
-    # get all images that are compared
-    # those are images that have group id set (just reference image have group id set to none)
-    stmt = session.query(
-        Image.id
-    ).where(
-        Image.group_id is not None
-    ).statement
 
-    df = pd.read_sql(stmt, engine)
-    df = df.rename(columns={'id': 'candidate'})
-    df['copeland_score'] = 0
+def copeland_score():
+    logger.info(f"Loading pairwise win counts for Copeland score calculation.")
 
+    # images that are never compared get score 0
     stmt = session.query(
         Image.id,
-        ResponseType2.img2_id,
-        ResponseType2.choice,
-        Image.group_id,
-        ResponseType2.id,
         Image.model,
-        Image.dataset,
-    ).join(
-        ResponseType2, Image.id == ResponseType2.img1_id
-    ).where(
-        Image.group_id is not None
-    ).order_by(
-        Image.group_id,
-        Image.id,
-        ResponseType2.img2_id
+        Image.dataset
     ).statement
+    df = pd.read_sql(stmt, engine)
+    df = df.rename(columns={'id': 'img_id'})
+
+    counts = load_win_counts()
+    candidates, wins, valid = win_tensor(counts)
+    scores = copeland_from_wins(wins, valid)
+    logger.info(f"Calculated Copeland scores for {len(candidates)} images in {wins.shape[0]} image groups from "
+                f"{len(counts)} compared pairs.")
 
-    df_scores = pd.read_sql(stmt, engine)
-    df_scores = df_scores.rename(columns={'id_1': 'survey_id', 'id': 'img1_id'})
-
-    rankings = pd.DataFrame(columns=["candidate", "copeland_score"])
-    rankings = rankings.astype({
-        "candidate": np.int16,
-        "copeland_score": np.float16,
-    })
-
-    # for candidate in df['candidate']:
-    for group in df_scores.groupby('group_id'):
-        img1 = group[1]['img1_id'].to_list()
-        img2 = group[1]['img2_id'].to_list()
-
-        images = img1 + img2
-        candidates = np.unique(images)
-
-        ranking = pd.DataFrame({
-            "candidate": candidates,
-            "copeland_score": np.zeros(len(candidates), dtype=np.float16)
-        })
-        ranking = ranking.set_index(ranking["candidate"])
-
-        # create empty pairwise comparison table
-        candidate_pairs = [i for i in itertools.combinations(iterable=candidates, r=2)]
-        xs = [x for x, _ in candidate_pairs]
-        ys = [y for _, y in candidate_pairs]
-        pairwise_comparison = pd.DataFrame({
-            "candidate1": xs,
-            "candidate2": ys,
-            "candidate1_wins": np.zeros(len(xs), dtype=np.int16),
-            "candidate2_wins": np.zeros(len(ys), dtype=np.int16)
-        })
-
-        # populate pairwise table
-        for c1, c2 in candidate_pairs:
-            logger.info(f"Calculating Copeland score for image pair {c1} and {c2}.")
-
-            # extract from the group all questions where candidate1 and candidate2 compete
-            # as img1 and/or img2
-
-            pairs = group[1][
-                np.logical_or(
-                    np.logical_and(group[1]["img1_id"] == c1, group[1]["img2_id"] == c2),
-                    np.logical_and(group[1]["img1_id"] == c2, group[1]["img2_id"] == c1)
-                )
-            ]
-            c1_wins = len(pairs[pairs["choice"] == c1])
-            c2_wins = len(pairs[pairs["choice"] == c2])
-
-            row_position = np.logical_and(
-                    pairwise_comparison["candidate1"] == c1,
-                    pairwise_comparison["candidate2"] == c2
-                )
-            # https://stackoverflow.com/questions/52173161/getting-a-list-of-indices-where-pandas-boolean-series-is-true
-            row_position = row_position[row_position].index.values[0]
-
-            # write win count for candidate 1
-            pairwise_comparison.at[
-                row_position, 'candidate1_wins'
-            ] = c1_wins
-
-            # write win count for candidate 2
-            pairwise_comparison.at[
-                row_position, 'candidate1_wins'
-            ] = c2_wins
-
-            # populate table with copeland ranking score
-            if c1_wins > c2_wins:
-                ranking.at[c1, "copeland_score"] += 1
-            elif c2_wins > c1_wins:
-                ranking.at[c2, "copeland_score"] += 1
-            else:
-                ranking.at[c1, "copeland_score"] += 0.5
-                ranking.at[c2, "copeland_score"] += 0.5
-                # TODO what now?!
-                pass
-
-        # if some image is selected by none of the observers, then it will appear in ranking with score
-        # 0 and no other cells populated (such as network name etc.)
-        # luckily, there are just a few entries like this so it is easy to manually correct this once ranking file is
-        # produced
-        rankings = pd.concat([rankings, ranking], ignore_index=True)
-
-    df = df.merge(rankings, on='candidate', how='left', suffixes=('', '_from_df'))
-    df['copeland_score'] = df['copeland_score_from_df'].combine_first(df['copeland_score'])
-    df.drop(columns=['copeland_score_from_df'], inplace=True)
-    df = df.rename(columns={'candidate': 'img_id'})
+    candidates["copeland_score"] = scores[candidates["group_index"], candidates["local_index"]]
+    df = df.merge(candidates[["img_id", "copeland_score"]], on='img_id', how='left')
+    df['copeland_score'] = df['copeland_score'].fillna(0)
 
     return df
+
+
+def update_score_summaries(scores_df, run_id=ScoreSummaries.default_run):
+    """
+    Replaces summaries of Copeland scores per model and dataset of a run. Reference images, i.e. images without a
+    model name, are left out, since they are inputs rather than images produced by a model.
+
+    :param scores_df: Copeland scores of all images, as returned by `copeland_score`.
+    :param run_id: Identifier of the run the scores belong to.
+    """
+    produced = scores_df["model"].notna() & (scores_df["model"] != "")
+    scores = scores_df.loc[produced, ["model", "dataset", "copeland_score"]].rename(columns={"copeland_score": "value"})
+    ScoreSummaries.replace(scores, "cs", run_id=run_id)
@@ -1,7 +1,17 @@
-from utils.database import Base, session
+import numpy as np
+import pandas as pd
+
+from model.diagnosis import Diagnosis, association_table
+from model.image import Image
+from model.question import QuestionType1
+from model.response import ResponseType1
+from model.score_summary import ScoreSummaries
+from utils.database import Base, engine, session
+from utils.logger import logger
 
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy import Integer, String
+from sqlalchemy import func, insert, select
 from sqlalchemy.orm import relationship
 
 
@@ -11,7 +21,7 @@ class DiagnosticScore(Base):
     id     = Column(Integer, primary_key=True, autoincrement=True)
     value  = Column(Integer, nullable=False)
 
-    response_id = Column(Integer, ForeignKey("rtype1.id"), nullable=False)
+    response_id = Column(Integer, ForeignKey("rtype1.id"), nullable=False, index=True)
     response = relationship("ResponseType1", back_populates='diagnostic_score')
 
     def __init__(self, response):
@@ -29,7 +39,7 @@ class DiagnosticScore(Base):
         if answer == 'not_applicable':
             self.value = 0
         else:
-            diagnoses = list(diagnoses)
+            diagnoses = [diagnosis.token for diagnosis in diagnoses]
             diagnoses.append('none')
             if answer in diagnoses:
                 self.value = 1
@@ -49,3 +59,123 @@ class DiagnosticScores:
             raise
         finally:
             session.commit()
+
+    @staticmethod
+    def bulk_insert(scores_df):
+        """
+        Inserts diagnostic scores in a single transaction.
+
+        :param scores_df: A dataframe with columns `response_id` and `value`.
+        """
+        if len(scores_df) == 0:
+            return
+        try:
+            session.execute(insert(DiagnosticScore), scores_df[["response_id", "value"]].to_dict(orient="records"))
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.commit()
+
+
+score_columns = ["response_id", "value", "observer_id", "image_id", "model", "dataset"]
+
+
+def diagnostic_score():
+    """
+    Calculates diagnostic scores of all type 1 responses that do not have a diagnostic score yet.
+
+    Responses are loaded together with the diagnosis tokens of the image they refer to in a single query, one row
+    per (response, token) pair. A response is correct if the answer matches any of the image diagnosis tokens, or if
+    the answer is `none`. The score is the certainty of a correct response, negative certainty of an incorrect
+    response and 0 for `not_applicable` responses.
+
+    :return: A dataframe with columns `response_id`, `value`, `observer_id`, `image_id`, `model` and `dataset`, or
+        None if there are no responses in the database.
+    """
+    if session.query(ResponseType1.id).first() is None:
+        return None
+
+    stmt = select(
+        ResponseType1.id.label("response_id"),
+        ResponseType1.response.label("answer"),
+        ResponseType1.certainty,
+        ResponseType1.observer_id,
+        QuestionType1.image_id,
+        Image.model,
+        Image.dataset,
+        Diagnosis.token
+    ).join(
+        QuestionType1, QuestionType1.id == ResponseType1.question_id
+    ).join(
+        Image, Image.id == QuestionType1.image_id
+    ).outerjoin(
+        association_table, association_table.c.image_id == QuestionType1.image_id
+    ).outerjoin(
+        Diagnosis, Diagnosis.id == association_table.c.diagnosis_id
+    ).outerjoin(
+        DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id
+    ).where(
+        DiagnosticScore.id.is_(None)
+    )
+    df = pd.read_sql(stmt, engine)
+    logger.info(f"Calculating diagnostic scores for {df['response_id'].nunique()} responses.")
+    if len(df) == 0:
+        return pd.DataFrame(columns=score_columns)
+
+    # answers are stored as text, although the column is declared as an integer
+    answers = df["answer"].astype(str)
+    df["correct"] = (answers == df["token"]) | (answers == "none")
+    scores = df.groupby("response_id", sort=False).agg(
+        answer=("answer", "first"),
+        certainty=("certainty", "first"),
+        correct=("correct", "any"),
+        observer_id=("observer_id", "first"),
+        image_id=("image_id", "first"),
+        model=("model", "first"),
+        dataset=("dataset", "first")
+    ).reset_index()
+
+    sign = np.where(scores["correct"], 1, -1)
+    sign = np.where(scores["answer"].astype(str) == "not_applicable", 0, sign)
+    scores["value"] = sign * scores["certainty"].to_numpy()
+    return scores[score_columns]
+
+
+def load_diagnostic_scores():
+    """
+    Loads all stored diagnostic scores together with the observer and the image they refer to.
+
+    :return: A dataframe with the same columns as returned by `diagnostic_score`.
+    """
+    stmt = select(
+        DiagnosticScore.response_id,
+        DiagnosticScore.value,
+        ResponseType1.observer_id,
+        QuestionType1.image_id,
+        Image.model,
+        Image.dataset
+    ).join(
+        ResponseType1, ResponseType1.id == DiagnosticScore.response_id
+    ).join(
+        QuestionType1, QuestionType1.id == ResponseType1.question_id
+    ).join(
+        Image, Image.id == QuestionType1.image_id
+    )
+    return pd.read_sql(stmt, engine)
+
+
+def update_score_summaries(scores_df):
+    """
+    Refreshes summaries of diagnostic scores per image, model, dataset and observer with newly stored scores, so only
+    the new scores are read. If the summaries do not cover all previously stored scores, e.g. in a database created
+    before the summaries were kept, they are rebuilt from all stored scores instead.
+
+    :param scores_df: Newly stored scores, as returned by `diagnostic_score`.
+    """
+    n_scores = session.query(func.count(DiagnosticScore.id)).scalar()
+    if ScoreSummaries.count("dv") + len(scores_df) == n_scores:
+        ScoreSummaries.add(scores_df, "dv")
+    else:
+        logger.info(f"Rebuilding diagnostic score summaries from {n_scores} stored scores.")
+        ScoreSummaries.replace(load_diagnostic_scores(), "dv")
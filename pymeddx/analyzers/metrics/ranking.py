@@ -0,0 +1,250 @@
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from analyzers.metrics.copeland_score import load_comparisons, load_win_counts
+from model.image import Image
+from utils.database import engine, session
+from utils.logger import logger
+
+
+supported_methods = ["bt", "elo", "kemeny"]
+
+
+def outcomes(comparisons):
+    """
+    Maps pairwise comparisons to outcomes between indexed images.
+
+    :param comparisons: A dataframe as returned by `load_comparisons`.
+    :return: A tuple (images, winners, losers) where `images` is a dataframe with columns `img_id` and `group_id`
+        whose index is the position of an image in the win matrix, and `winners` and `losers` are arrays of image
+        positions, one pair per response in which one of the compared images was chosen. Outcomes keep the order of
+        the comparisons.
+    """
+    images = pd.concat([
+        comparisons[["img1_id", "group_id"]].rename(columns={"img1_id": "img_id"}),
+        comparisons[["img2_id", "group_id"]].rename(columns={"img2_id": "img_id"}),
+    ]).drop_duplicates("img_id").sort_values(["group_id", "img_id"], ignore_index=True)
+    position = pd.Series(images.index, index=images["img_id"])
+
+    i = position.loc[comparisons["img1_id"]].to_numpy()
+    j = position.loc[comparisons["img2_id"]].to_numpy()
+    img1_won = (comparisons["choice"] == comparisons["img1_id"]).to_numpy()
+    img2_won = (comparisons["choice"] == comparisons["img2_id"]).to_numpy()
+    decided = img1_won | img2_won
+    winners = np.where(img1_won, i, j)[decided]
+    losers = np.where(img1_won, j, i)[decided]
+    return images, winners, losers
+
+
+def win_matrix(n_images, winners, losers):
+    """
+    Builds a sparse matrix of pairwise wins, where wins[i, j] is the number of times image i was chosen over image j.
+    """
+    return sparse.coo_matrix(
+        (np.ones(len(winners)), (winners, losers)), shape=(n_images, n_images)
+    ).tocsr()
+
+
+def counts_matrix(counts):
+    """
+    Builds a sparse matrix of pairwise wins from win counts of compared pairs, see `win_matrix`.
+
+    :param counts: A dataframe as returned by `load_win_counts`.
+    :return: A tuple (images, wins) where `images` is a dataframe with columns `img_id` and `group_id` whose index is
+        the position of an image in the win matrix.
+    """
+    images = pd.concat([
+        counts[["image_a_id", "group_id"]].rename(columns={"image_a_id": "img_id"}),
+        counts[["image_b_id", "group_id"]].rename(columns={"image_b_id": "img_id"}),
+    ]).drop_duplicates("img_id").sort_values(["group_id", "img_id"], ignore_index=True)
+    position = pd.Series(images.index, index=images["img_id"])
+
+    a = position.loc[counts["image_a_id"]].to_numpy()
+    b = position.loc[counts["image_b_id"]].to_numpy()
+    wins = sparse.coo_matrix(
+        (np.concatenate([counts["wins_a"], counts["wins_b"]]).astype(float),
+         (np.concatenate([a, b]), np.concatenate([b, a]))),
+        shape=(len(images), len(images))
+    ).tocsr()
+    wins.eliminate_zeros()
+    return images, wins
+
+
+def bradley_terry(wins, prior=0.5, max_iter=10000, tol=1e-9):
+    """
+    Fits the Bradley-Terry model using minorization-maximization (MM) iterations, where each iteration is a single
+    vectorized pass over the nonzero entries of the win matrix.
+
+    To keep strengths finite for images that never won or never lost, each image plays `2 * prior` virtual games
+    against a virtual opponent of strength 1 and wins half of them, i.e. `prior` virtual wins and `prior` virtual
+    losses. This also fixes the scale of strengths in each image group.
+
+    :param wins: A sparse matrix of pairwise wins, see `win_matrix`.
+    :param prior: Number of virtual wins (and of virtual losses) per image, must be positive.
+    :param max_iter: Maximum number of MM iterations.
+    :param tol: Iterations stop when the largest change of log-strength is below this value.
+    :return: A tuple (scores, diagnostics) where scores are log-strengths of images.
+    """
+    if prior <= 0:
+        logger.error(f"Bradley-Terry prior must be positive, but it is {prior}.")
+        raise ValueError(f"Bradley-Terry prior must be positive, but it is {prior}.")
+
+    n_images = wins.shape[0]
+    games = (wins + wins.T).tocoo()
+    rows, cols, n_games = games.row, games.col, games.data
+    n_wins = np.asarray(wins.sum(axis=1)).ravel() + prior
+
+    strength = np.ones(n_images)
+    change, iteration = np.inf, 0
+    for iteration in range(1, max_iter + 1):
+        denominator = np.bincount(rows, weights=n_games / (strength[rows] + strength[cols]), minlength=n_images)
+        denominator = denominator + 2 * prior / (strength + 1)
+        updated = n_wins / denominator
+        change = np.max(np.abs(np.log(updated) - np.log(strength))) if n_images != 0 else 0.0
+        strength = updated
+        if change < tol:
+            break
+
+    won = wins.tocoo()
+    log_likelihood = np.sum(won.data * (np.log(strength[won.row]) - np.log(strength[won.row] + strength[won.col])))
+    diagnostics = {
+        "iterations": iteration,
+        "converged": bool(change < tol),
+        "max_change": float(change),
+        "log_likelihood": float(log_likelihood),
+    }
+    return np.log(strength), diagnostics
+
+
+def elo(n_images, winners, losers, k=32, initial=1500):
+    """
+    Calculates Elo ratings by processing outcomes one by one in the order the responses were given.
+
+    :param n_images: Number of images.
+    :param winners: Positions of chosen images, see `outcomes`.
+    :param losers: Positions of images that were not chosen, see `outcomes`.
+    :param k: K-factor, the largest possible rating change after a single comparison.
+    :param initial: Initial rating of each image.
+    :return: A tuple (scores, diagnostics) where scores are Elo ratings of images.
+    """
+    ratings = np.full(n_images, initial, dtype=float)
+    changes = np.zeros(len(winners))
+    for t, (winner, loser) in enumerate(zip(winners.tolist(), losers.tolist())):
+        expected = 1 / (1 + 10 ** ((ratings[loser] - ratings[winner]) / 400))
+        change = k * (1 - expected)
+        ratings[winner] += change
+        ratings[loser] -= change
+        changes[t] = change
+
+    # ratings have settled if updates at the end are smaller than at the beginning
+    window = max(len(changes) // 10, 1)
+    diagnostics = {
+        "updates": len(changes),
+        "mean_change_first": float(changes[:window].mean()) if len(changes) != 0 else 0.0,
+        "mean_change_last": float(changes[-window:].mean()) if len(changes) != 0 else 0.0,
+    }
+    return ratings, diagnostics
+
+
+def kemeny(wins, groups, max_passes=1000):
+    """
+    Approximates the Kemeny ranking of each image group. The initial ranking sorts images by Borda count (number of
+    wins minus number of losses) and it is then improved by local search, swapping adjacent images while the lower
+    ranked image won more comparisons against the higher ranked one. Each swap reduces the number of disagreements
+    between the ranking and the comparisons, so the search ends in a locally Kemeny optimal ranking.
+
+    :param wins: A sparse matrix of pairwise wins, see `win_matrix`.
+    :param groups: Group id of each image, in the order of the win matrix.
+    :param max_passes: Maximum number of local search passes per group.
+    :return: A tuple (scores, diagnostics) where the score of an image is the number of images ranked below it in its
+        group.
+    """
+    scores = np.zeros(wins.shape[0])
+    passes, cost_borda, cost_final = 0, 0, 0
+    for idx in pd.Series(np.arange(len(groups))).groupby(np.asarray(groups)).indices.values():
+        group_wins = wins[idx][:, idx].toarray()
+        order = np.argsort(-(group_wins.sum(axis=1) - group_wins.sum(axis=0)), kind="stable")
+        cost_borda += _disagreements(group_wins, order)
+
+        for n_pass in range(1, max_passes + 1):
+            swapped = False
+            for pos in range(len(order) - 1):
+                a, b = order[pos], order[pos + 1]
+                if group_wins[b, a] > group_wins[a, b]:
+                    order[pos], order[pos + 1] = b, a
+                    swapped = True
+            passes = max(passes, n_pass)
+            if not swapped:
+                break
+
+        cost_final += _disagreements(group_wins, order)
+        scores[idx[order]] = np.arange(len(order) - 1, -1, -1)
+
+    diagnostics = {
+        "max_passes": passes,
+        "disagreements_borda": int(cost_borda),
+        "disagreements_final": int(cost_final),
+    }
+    return scores, diagnostics
+
+
+def _disagreements(wins, order):
+    # number of comparisons won by an image ranked below the other one
+    ranked = wins[np.ix_(order, order)]
+    return np.tril(ranked, k=-1).sum()
+
+
+def ranking_scores(method):
+    """
+    Ranks all compared images using one of the supported methods.
+
+    :param method: One of `supported_methods`, `bt` for Bradley-Terry, `elo` for Elo rating and `kemeny` for Kemeny
+        ranking approximation.
+    :return: A tuple (scores, diagnostics) where scores is a dataframe with columns `img_id` and `score`, and
+        diagnostics is a dictionary with convergence diagnostics and runtime of the method in seconds.
+    """
+    if method not in supported_methods:
+        logger.error(f"Unsupported ranking method '{method}'. Supported methods are {supported_methods}.")
+        raise ValueError(f"Unsupported ranking method '{method}'. Supported methods are {supported_methods}.")
+
+    if method == "elo":
+        # Elo depends on the order of comparisons, so it is calculated from the responses
+        logger.info(f"Loading pairwise comparisons for ranking.")
+        comparisons = load_comparisons()
+        start = time.perf_counter()
+        images, winners, losers = outcomes(comparisons)
+        scores, diagnostics = elo(len(images), winners, losers)
+    else:
+        logger.info(f"Loading pairwise win counts for ranking.")
+        counts = load_win_counts()
+        start = time.perf_counter()
+        images, wins = counts_matrix(counts)
+        if method == "bt":
+            scores, diagnostics = bradley_terry(wins)
+        else:
+            scores, diagnostics = kemeny(wins, images["group_id"].to_numpy())
+    diagnostics["runtime"] = time.perf_counter() - start
+
+    return pd.DataFrame({"img_id": images["img_id"], "score": scores}), diagnostics
+
+
+def model_leaderboard(scores):
+    """
+    Averages image scores across images produced by the same model. Reference images are excluded, since they do not
+    have an assigned model name.
+
+    :param scores: A dataframe with columns `img_id` and `score`.
+    :return: A list of (model, average score) tuples sorted in descending order of the average score.
+    """
+    stmt = session.query(
+        Image.id.label("img_id"),
+        Image.model
+    ).where(
+        Image.model != ""
+    ).statement
+    models = pd.read_sql(stmt, engine)
+    leaderboard = scores.merge(models, on="img_id").groupby("model")["score"].mean().sort_values(ascending=False)
+    return list(leaderboard.items())
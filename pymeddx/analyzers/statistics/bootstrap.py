@@ -0,0 +1,348 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scipy import sparse
+
+from analyzers.metrics.copeland_score import load_comparisons
+from analyzers.metrics.diagnostic_score import load_diagnostic_scores
+from analyzers.statistics.interobserver import kappa_from_cells
+from analyzers.statistics.ratings import RatingsMatrix
+from model.image import Image
+from utils.database import engine, session
+from utils.logger import logger
+
+
+resampling_units = ["cases", "observers", "both"]
+
+# number of elements of a resampling weight matrix processed at once, per worker
+batch_elements = 2 ** 23
+
+# approximate cost of a binomial draw relative to drawing an index, see `_strata_layout`
+binomial_cost = 4
+
+# state shared by batches of a worker process, set once by `_init_worker` instead of sending it with every batch
+_state = dict()
+
+
+def bootstrap(features, finalize, observers, cases, unit="cases", strata=None, n_resamples=10000, confidence=0.95,
+              n_jobs=None, seed=None):
+    """
+    Calculates bootstrap confidence intervals of statistics that depend on the data only through sums of per-response
+    features, e.g. means of groups of scores (sums of scores and counts of responses per group) or Copeland scores
+    (numbers of wins of each image of each compared pair).
+
+    A resample is represented by the number of times each case, observer, or both (cluster bootstrap) are drawn, so
+    the feature sums of a whole batch of resamples are a single product of a count matrix and the feature matrix. Counts
+    are drawn from precomputed index arrays, and the batches are spread over a process pool. Features are summed per
+    case or observer first, so the cost of a batch depends on the number of cases or observers rather than the number
+    of responses. When both are resampled, features are summed per case separately for each observer, and the sums of
+    a resample are weighted by the number of times each observer is drawn.
+
+    :param features: An R x K (sparse) matrix with K features of each of R responses.
+    :param finalize: A function mapping a B x K array of feature sums of B resamples to a B x S array of S statistics.
+        It has to be picklable, i.e. a module level function or a partial of one.
+    :param observers: An array of R observer codes from 0 to the number of observers - 1.
+    :param cases: An array of R case codes from 0 to the number of cases - 1.
+    :param unit: One of `resampling_units`.
+    :param strata: An optional array of stratum codes of each case. If given, cases are resampled within their strata,
+        so each stratum keeps its number of cases in every resample.
+    :param n_resamples: Number of bootstrap resamples.
+    :param confidence: Confidence level of the percentile intervals.
+    :param n_jobs: Number of worker processes, all available CPUs if None.
+    :param seed: Seed of the random number generator.
+    :return: A dictionary with arrays of S values: `estimate` with the statistics of the original data, `se` with
+        bootstrap standard errors, and `lower` and `upper` with bounds of the confidence intervals.
+    """
+    if unit not in resampling_units:
+        logger.error(f"Unsupported resampling unit '{unit}'. Supported units are {resampling_units}.")
+        raise ValueError(f"Unsupported resampling unit '{unit}'. Supported units are {resampling_units}.")
+    if not 0 < confidence < 1:
+        logger.error(f"Confidence level has to be between 0 and 1, but it is {confidence}.")
+        raise ValueError(f"Confidence level has to be between 0 and 1, but it is {confidence}.")
+
+    features = sparse.csr_matrix(features, dtype=float)
+    observers, cases = np.asarray(observers), np.asarray(cases)
+    estimate = finalize(np.asarray(features.sum(axis=0)))[0]
+
+    state = _prepare(features, finalize, observers, cases, unit, strata)
+    width = max(state["clusters"].shape)
+    batch_size = int(np.clip(batch_elements // max(width, 1), 1, n_resamples))
+    sizes = [batch_size] * (n_resamples // batch_size)
+    if n_resamples % batch_size != 0:
+        sizes.append(n_resamples % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(sizes))
+    logger.info(f"Drawing {n_resamples} bootstrap resamples of {unit} in {len(sizes)} batches on {n_jobs} processes.")
+    if n_jobs == 1:
+        _init_worker(state)
+        results = [_run_batch(s, size) for s, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as executor:
+            results = list(executor.map(_run_batch, seeds, sizes))
+    statistics = np.concatenate(results, axis=0)
+
+    alpha = 1 - confidence
+    lower, upper = np.nanquantile(statistics, [alpha / 2, 1 - alpha / 2], axis=0)
+    return {
+        "estimate": estimate,
+        "se": np.nanstd(statistics, axis=0, ddof=1),
+        "lower": lower,
+        "upper": upper,
+    }
+
+
+def _prepare(features, finalize, observers, cases, unit, strata):
+    state = {"finalize": finalize, "unit": unit, "layout": None}
+    if unit == "both":
+        # features of each case summed separately for each observer, i.e. a n_cases x (n_observers * K) matrix
+        n_observers, n_features = observers.max() + 1, features.shape[1]
+        cells = features.tocoo()
+        state["n_observers"] = n_observers
+        state["clusters"] = sparse.csr_matrix(
+            (cells.data, (cases[cells.row], observers[cells.row] * n_features + cells.col)),
+            shape=(cases.max() + 1, n_observers * n_features)
+        )
+    else:
+        codes = cases if unit == "cases" else observers
+        membership = sparse.csr_matrix(
+            (np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(codes.max() + 1, len(codes))
+        )
+        state["clusters"] = (membership @ features).tocsr()
+
+    if strata is not None and unit != "observers":
+        state["clusters"], state["layout"] = _strata_layout(state["clusters"], np.asarray(strata))
+    return state
+
+
+def _init_worker(state):
+    _state.clear()
+    _state.update(state)
+
+
+def _strata_layout(clusters, strata):
+    # cases of a stratum with equal features are interchangeable, e.g. comparisons of a pair with the same outcome, so
+    # they are merged into a single atom, and the counts of the atoms of a stratum are drawn from a multinomial
+    # distribution as a chain of binomial draws, one draw per atom rank within the stratum
+    atoms, first, multiplicity = dict(), list(), list()
+    for i in range(clusters.shape[0]):
+        start, end = clusters.indptr[i], clusters.indptr[i + 1]
+        key = (strata[i], clusters.indices[start:end].tobytes(), clusters.data[start:end].tobytes())
+        if key not in atoms:
+            atoms[key] = len(first)
+            first.append(i)
+            multiplicity.append(0)
+        multiplicity[atoms[key]] += 1
+
+    # a binomial draw costs several times more than drawing an index, so cases are drawn by index within their strata
+    # unless merging reduces their number enough
+    if len(first) * binomial_cost > clusters.shape[0]:
+        order = np.argsort(strata, kind="stable")
+        sorted_strata = strata[order]
+        starts = np.searchsorted(sorted_strata, sorted_strata, side="left")
+        sizes = np.searchsorted(sorted_strata, sorted_strata, side="right") - starts
+        return clusters, ("index", order, starts, sizes)
+
+    first, multiplicity = np.array(first), np.array(multiplicity)
+    atom_strata = pd.factorize(pd.Series(strata[first]))[0]
+    order = np.lexsort((np.arange(len(first)), atom_strata))
+    first, multiplicity, atom_strata = first[order], multiplicity[order], atom_strata[order]
+    sizes = np.bincount(atom_strata, weights=multiplicity).astype(np.int64)
+    drawn_before = np.cumsum(multiplicity) - multiplicity - (np.cumsum(sizes) - sizes)[atom_strata]
+    ranks = np.arange(len(first)) - np.searchsorted(atom_strata, atom_strata, side="left")
+    is_last = np.append(atom_strata[1:] != atom_strata[:-1], True)
+    probabilities = multiplicity / (sizes[atom_strata] - drawn_before)
+    return clusters[first], ("atoms", atom_strata, sizes, ranks, is_last, probabilities)
+
+
+def _resample_counts(rng, n, size, layout=None):
+    # number of times each of n units is drawn in each of `size` resamples, within strata if `layout` is given
+    if layout is not None and layout[0] == "atoms":
+        _, atom_strata, sizes, ranks, is_last, probabilities = layout
+        left = np.repeat(sizes[None, :], size, axis=0)
+        counts = np.zeros((size, n), dtype=np.int64)
+        for rank in range(ranks.max() + 1):
+            # the last atom of a stratum takes all cases that are left
+            drawn = np.flatnonzero((ranks == rank) & ~is_last)
+            counts[:, drawn] = rng.binomial(left[:, atom_strata[drawn]], probabilities[drawn])
+            left[:, atom_strata[drawn]] -= counts[:, drawn]
+            last = np.flatnonzero((ranks == rank) & is_last)
+            counts[:, last] = left[:, atom_strata[last]]
+        return counts
+
+    if layout is None:
+        draws = rng.integers(0, n, size=(size, n))
+    else:
+        _, order, starts, sizes = layout
+        draws = order[starts + (rng.random((size, n)) * sizes).astype(np.int64)]
+    draws += np.arange(size)[:, None] * n
+    return np.bincount(draws.ravel(), minlength=size * n).reshape(size, n)
+
+
+def _run_batch(seed, size):
+    rng = np.random.default_rng(seed)
+    clusters = _state["clusters"]
+    counts = _resample_counts(rng, clusters.shape[0], size, _state["layout"] if _state["unit"] != "observers" else None)
+    sums = np.asarray((clusters.T @ counts.T.astype(float)).T)
+    if _state["unit"] == "both":
+        observer_counts = _resample_counts(rng, _state["n_observers"], size)
+        sums = np.einsum("bo,bok->bk", observer_counts, sums.reshape(size, _state["n_observers"], -1))
+    return _state["finalize"](sums)
+
+
+def _codes(values):
+    return pd.factorize(pd.Series(values), sort=True)[0]
+
+
+def _group_means(sums, n_groups):
+    # sums of values of all groups followed by counts of all groups
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums[:, :n_groups] / sums[:, n_groups:]
+
+
+def group_means(values, groups, observers, cases, **kwargs):
+    """
+    Calculates bootstrap confidence intervals of mean values of groups, e.g. mean diagnostic scores of datasets.
+
+    :param values: An array of values of all responses.
+    :param groups: An array of group names of all responses.
+    :param observers: An array of observer ids of all responses.
+    :param cases: An array of case ids of all responses.
+    :param kwargs: Options of `bootstrap`.
+    :return: A dataframe indexed by group with columns `estimate`, `se`, `lower` and `upper`.
+    """
+    codes, names = pd.factorize(pd.Series(groups), sort=True)
+    n, n_groups = len(codes), len(names)
+    rows = np.concatenate([np.arange(n), np.arange(n)])
+    columns = np.concatenate([codes, codes + n_groups])
+    data = np.concatenate([np.asarray(values, dtype=float), np.ones(n)])
+    features = sparse.csr_matrix((data, (rows, columns)), shape=(n, 2 * n_groups))
+
+    result = bootstrap(features, partial(_group_means, n_groups=n_groups), _codes(observers), _codes(cases), **kwargs)
+    return pd.DataFrame(result, index=pd.Index(names, name="group"))
+
+
+def diagnostic_score_means(**kwargs):
+    """
+    Calculates bootstrap confidence intervals of mean diagnostic scores of datasets. Cases are images, so responses to
+    redundant questions about the same image are drawn together.
+
+    :param kwargs: Options of `bootstrap`.
+    :return: A dataframe indexed by dataset, see `group_means`.
+    """
+    scores = load_diagnostic_scores()
+    scores = scores[scores["dataset"].notna()]
+    result = group_means(scores["value"], scores["dataset"], scores["observer_id"], scores["image_id"], **kwargs)
+    return result.rename_axis("dataset")
+
+
+def _copeland_means(sums, pair_a, pair_b, averaging):
+    # wins of the first image of each pair followed by wins of the second image of each pair
+    n_pairs = len(pair_a)
+    wins_a, wins_b = sums[:, :n_pairs], sums[:, n_pairs:]
+    points_a = (wins_a > wins_b) + 0.5 * ((wins_a == wins_b) & (wins_a + wins_b > 0))
+    points_b = (wins_b > wins_a) + 0.5 * ((wins_a == wins_b) & (wins_a + wins_b > 0))
+    return (points_a @ averaging[pair_a] + points_b @ averaging[pair_b])
+
+
+def copeland_model_means(**kwargs):
+    """
+    Calculates bootstrap confidence intervals of mean Copeland scores of models. Copeland scores of images are
+    recalculated from the wins of each resample, as in `copeland_score`, and averaged over all images produced by each
+    model, including images that were never compared. Cases are single comparisons, resampled within the compared
+    pair, so each pair is compared the same number of times in every resample as in the data. Otherwise, pairs left
+    out of a resample would not contribute any points and the resampled scores would be biased downwards.
+
+    :param kwargs: Options of `bootstrap`.
+    :return: A dataframe indexed by model with columns `estimate`, `se`, `lower` and `upper`.
+    """
+    comparisons = load_comparisons()
+    images = pd.read_sql(session.query(Image.id, Image.model).statement, engine)
+    images = images[images["model"].notna() & (images["model"] != "")]
+
+    img1, img2 = comparisons["img1_id"].to_numpy(), comparisons["img2_id"].to_numpy()
+    image_a, image_b = np.minimum(img1, img2), np.maximum(img1, img2)
+    pairs, pair_codes = np.unique(np.stack([image_a, image_b], axis=1), axis=0, return_inverse=True)
+    pair_codes = pair_codes.ravel()
+    n, n_pairs = len(comparisons), len(pairs)
+    choice = comparisons["choice"].to_numpy()
+    won_a, won_b = (choice == image_a).astype(float), (choice == image_b).astype(float)
+    features = sparse.csr_matrix(
+        (np.concatenate([won_a, won_b]), (np.concatenate([np.arange(n)] * 2),
+                                          np.concatenate([pair_codes, pair_codes + n_pairs]))),
+        shape=(n, 2 * n_pairs)
+    )
+
+    # averaging[i, m] is 1 / number of images of model m if compared image i is produced by model m
+    model_codes, models = pd.factorize(images["model"], sort=True)
+    model_of = dict(zip(images["id"], model_codes))
+    n_images = np.bincount(model_codes, minlength=len(models))
+    compared = np.unique(pairs.ravel()) if n_pairs != 0 else np.array([], dtype=int)
+    averaging = np.zeros((len(compared), len(models)))
+    for i, image_id in enumerate(compared):
+        if image_id in model_of:
+            averaging[i, model_of[image_id]] = 1 / n_images[model_of[image_id]]
+    position = {image_id: i for i, image_id in enumerate(compared)}
+    pair_a = np.array([position[a] for a in pairs[:, 0]], dtype=int)
+    pair_b = np.array([position[b] for b in pairs[:, 1]], dtype=int)
+
+    result = bootstrap(
+        features, partial(_copeland_means, pair_a=pair_a, pair_b=pair_b, averaging=averaging),
+        _codes(comparisons["observer_id"]), np.arange(n), strata=pair_codes, **kwargs
+    )
+    return pd.DataFrame(result, index=pd.Index(models, name="model")).sort_values("estimate", ascending=False)
+
+
+def _cohens_kappa(sums, pairs, rows, columns, n_pairs, weights):
+    # sums are counts of the nonzero cells of the confusion matrices of all observer pairs
+    return kappa_from_cells(sums, pairs, rows, columns, n_pairs, weights)
+
+
+def cohens_kappa(ratings: RatingsMatrix, unit="cases", weights=None, **kwargs):
+    """
+    Calculates bootstrap confidence intervals of Cohen's kappa of all observer pairs. Only cases are resampled, since
+    the statistic is calculated for each pair of observers.
+
+    :param ratings: Ratings of all observers, as used by `interobserver.cohens_kappa`. Cases are rated items, and each
+        pair of observers is evaluated on the items both of them rated.
+    :param unit: Resampling unit, only `cases` is supported.
+    :param weights: None for unweighted kappa, or one of `interobserver.kappa_weights`.
+    :param kwargs: Options of `bootstrap`.
+    :return: A dataframe with columns `observer_a`, `observer_b`, `estimate`, `se`, `lower` and `upper`, one row per
+        observer pair.
+    """
+    if unit != "cases":
+        logger.warning(f"Cohen's kappa is calculated for each pair of observers, so only cases are resampled instead "
+                       f"of '{unit}'.")
+
+    observer_ids, codes = ratings.observer_ids, ratings.codes.astype(np.int64)
+    if len(observer_ids) < 2:
+        logger.warning(f"Cohen's kappa requires at least two observers, but {len(observer_ids)} were found.")
+        return pd.DataFrame(columns=["observer_a", "observer_b", "estimate", "se", "lower", "upper"])
+
+    n_cases, n_categories = ratings.n_items, ratings.n_categories
+    pair_i, pair_j = np.triu_indices(len(observer_ids), k=1)
+    observer_pairs = list(zip(pair_i, pair_j))
+
+    # cell of the confusion matrix of each observer pair that each case falls into, for cases rated by both observers,
+    # where only cells that occur in the data are features, since categories may be many, e.g. image ids
+    cases, pairs = np.nonzero((codes[:, pair_i] >= 0) & (codes[:, pair_j] >= 0))
+    keys = (pairs * n_categories + codes[cases, pair_i[pairs]]) * n_categories + codes[cases, pair_j[pairs]]
+    cells, cell_codes = np.unique(keys, return_inverse=True)
+    features = sparse.csr_matrix((np.ones(len(keys)), (cases, cell_codes.ravel())), shape=(n_cases, len(cells)))
+    cell_pairs, cell_categories = np.divmod(cells, n_categories ** 2)
+    rows, columns = np.divmod(cell_categories, n_categories)
+
+    result = bootstrap(
+        features, partial(_cohens_kappa, pairs=cell_pairs, rows=rows, columns=columns, n_pairs=len(observer_pairs),
+                          weights=weights),
+        np.zeros(n_cases, dtype=int), np.arange(n_cases), unit="cases", **kwargs
+    )
+    result = pd.DataFrame(result)
+    result.insert(0, "observer_a", [observer_ids[i] for i, _ in observer_pairs])
+    result.insert(1, "observer_b", [observer_ids[j] for _, j in observer_pairs])
+    return result
@@ -1,152 +1,394 @@
-import itertools
-import krippendorff
-
 import numpy as np
 import pandas as pd
 
-from typing import Dict, Any
-from sqlalchemy import asc, desc
-from sklearn.metrics import cohen_kappa_score
+from scipy import sparse
+from typing import Dict, Any, Optional
 
-from utils.database import session, engine
 from utils.logger import logger
 
-from model.response import ResponseType1, ResponseType2
-from model.question import QuestionType2
-from analyzers.metrics.diagnostic_score import DiagnosticScore
+from analyzers.statistics.ratings import RatingsMatrix
+
+
+# number of elements of a dense block of marginals or ratio distances, see `alpha_from_cells`
+block_elements = 2 ** 22
 
 
 def stats_wrapper(qtype: int, fn: str, **kwargs) -> Dict[Any, float]:
     """
     Executes a specified statistical calculation function on data retrieved based on the `qtype` and `fn` arguments.
 
+    Ratings of all observers are loaded as a `RatingsMatrix`, aligned by question (type 1 and type 2) or by ranked
+    image pair of a question (type 3), so observers that answered different surveys are compared on the questions they
+    have in common.
+
     :param qtype:
         The type of questionnaire to retrieve results from the database.
     :param fn:
         The name of the statistical function to run. Valid options are:
             - 'cohens-kappa' - to run Cohen's kappa calculation
+            - 'krippendorff-alpha' - to run Krippendorff's alpha calculation
     :return:
         DataFrame with the result of the calculation.
     :raises NotImplementedError:
-        If `qtype` is not defined in `query_map`.
+        If `qtype` is not supported.
     """
-    query_map = {
-        # load info for all answers (response id, observer who have the response, and the score), for all answers
-        # to non-redundant questions (questions
-        1: session.query(ResponseType1.id, ResponseType1.observer_id, DiagnosticScore.value)
-            .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)
-            .where(ResponseType1.is_redundant == False)
-            .statement,
-        # load infor on all responses without responses on redundant questions
-        2: session.query(ResponseType2.id, ResponseType2.observer_id, ResponseType2.choice)
-            .join(QuestionType2, ResponseType2.question_id == QuestionType2.id)
-            .where(QuestionType2.is_redundant == False)
-            .order_by(asc(ResponseType2.observer_id), asc(ResponseType2.id))
-            .statement
-    }
-
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
-        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
-
-    # Load data from database
-    data = pd.read_sql(stmt, engine)
-
     if qtype == 1:
         logger.info(f"Running inter-observer calculations on metric diagnostic score.")
-    elif qtype == 2:
+    elif qtype in [2, 3]:
         logger.info(f"Running inter-observer calculations on chosen responses.")
-
-        # choice column should be renamed to 'value' so that cohen's and krippendorff coefficients can be calculated
-        data.rename(columns={'choice': 'value'}, inplace=True)
     else:
-        logger.error(f"Unknown question type {qtype}.")
-        raise ValueError(f"Unknown question type {qtype}.")
+        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
     if fn.lower() == 'cohens-kappa':
-        return cohens_kappa(data)
+        return cohens_kappa(RatingsMatrix.load(qtype), **kwargs)
     elif fn.lower() == 'krippendorff-alpha':
-        return krippendorff_alpha(data, **kwargs)
+        # Krippendorff's alpha treats empty responses as missing ratings
+        return krippendorff_alpha(RatingsMatrix.load(qtype, missing=True), **kwargs)
     else:
         logger.warning(f"Unsupported calculation type. This command has no effect.")
 
 
-def cohens_kappa(data: pd.DataFrame) -> Dict[Any, Any]:
+kappa_weights = ["linear", "quadratic"]
+
+
+def kappa_from_cells(counts: np.ndarray, pairs: np.ndarray, rows: np.ndarray, columns: np.ndarray, n_pairs: int,
+                     weights: Optional[str] = None) -> np.ndarray:
+    """
+    Calculates Cohen's kappa of observer pairs from the nonzero cells of their confusion matrices, in the same way as
+    `sklearn.metrics.cohen_kappa_score`.
+
+    Only categories that appear in the cells of a pair are represented, and the expected disagreement is summed in
+    closed form from the marginals of the pair, so the cost is linear in the number of cells instead of quadratic in
+    the number of categories. Weighted kappa penalizes disagreements by the distance between the positions of the two
+    categories among the categories used by either observer of the pair, like sklearn does, rather than by the distance
+    between the values.
+
+    :param counts:
+        An array of counts of the cells in the last dimension, e.g. of several bootstrap resamples in the leading
+        dimensions.
+    :param pairs:
+        Index of the observer pair of each cell, from 0 to `n_pairs` - 1.
+    :param rows:
+        Category code given by the first observer of the pair in each cell.
+    :param columns:
+        Category code given by the second observer of the pair in each cell.
+    :param n_pairs:
+        Number of observer pairs.
+    :param weights:
+        None for unweighted kappa, or one of `kappa_weights`.
+    :return:
+        An array of kappa scores with the shape of `counts`, where the last dimension is replaced by the pairs. Pairs
+        without counted cells have NaN scores.
+    """
+    if weights is not None and weights not in kappa_weights:
+        logger.error(f"Unsupported kappa weights '{weights}'. Supported weights are {kappa_weights}.")
+        raise ValueError(f"Unsupported kappa weights '{weights}'. Supported weights are {kappa_weights}.")
+
+    counts = np.asarray(counts, dtype=float)
+    shape = counts.shape[:-1]
+    counts = counts.reshape(-1, counts.shape[-1])
+    n_cells = len(pairs)
+    n_categories = int(max(rows.max(), columns.max())) + 1 if n_cells != 0 else 1
+
+    # categories used by each pair, sorted by pair and category, and the used category of each side of each cell
+    keys, inverse = np.unique(np.concatenate([pairs * n_categories + rows, pairs * n_categories + columns]),
+                              return_inverse=True)
+    key_pairs = keys // n_categories
+    cells = np.arange(n_cells)
+    to_rows = sparse.csr_matrix((np.ones(n_cells), (cells, inverse[:n_cells])), shape=(n_cells, len(keys)))
+    to_columns = sparse.csr_matrix((np.ones(n_cells), (cells, inverse[n_cells:])), shape=(n_cells, len(keys)))
+    cells_to_pairs = sparse.csr_matrix((np.ones(n_cells), (cells, pairs)), shape=(n_cells, n_pairs))
+    keys_to_pairs = sparse.csr_matrix((np.ones(len(keys)), (np.arange(len(keys)), key_pairs)),
+                                      shape=(len(keys), n_pairs))
+
+    row_sums, column_sums = counts @ to_rows, counts @ to_columns
+    n = row_sums @ keys_to_pairs
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if weights is None:
+            observed = (counts * (rows != columns)) @ cells_to_pairs
+            expected = n - (row_sums * column_sums) @ keys_to_pairs / n
+        else:
+            position = _pair_cumsum(((row_sums > 0) | (column_sums > 0)).astype(float), key_pairs)
+            distance = np.abs(position[:, inverse[:n_cells]] - position[:, inverse[n_cells:]])
+            observed = (counts * (distance if weights == "linear" else distance ** 2)) @ cells_to_pairs
+
+            weighted_columns = position * column_sums
+            if weights == "linear":
+                # sum of |position_a - position_b| * columns_b over b, split at a since positions are sorted
+                cumulative = _pair_cumsum(column_sums, key_pairs)
+                weighted_cumulative = _pair_cumsum(weighted_columns, key_pairs)
+                total = (weighted_columns @ keys_to_pairs)[:, key_pairs]
+                distances = position * cumulative - weighted_cumulative \
+                    + (total - weighted_cumulative) - position * (n[:, key_pairs] - cumulative)
+                expected = (row_sums * distances) @ keys_to_pairs / n
+            else:
+                # sum of (position_a - position_b)^2 * rows_a * columns_b expanded into sums of the marginals
+                expected = (((position ** 2 * row_sums) @ keys_to_pairs) * n
+                            + n * ((position ** 2 * column_sums) @ keys_to_pairs)
+                            - 2 * ((position * row_sums) @ keys_to_pairs) * (weighted_columns @ keys_to_pairs)) / n
+
+        return (1 - observed / expected).reshape(shape + (n_pairs,))
+
+
+def _pair_cumsum(values: np.ndarray, key_pairs: np.ndarray) -> np.ndarray:
+    # cumulative sums along the last dimension, restarted at the first category of every pair
+    cumulative = np.cumsum(values, axis=-1)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(key_pairs)) + 1]).astype(np.int64)
+    before = np.concatenate([np.zeros(values.shape[:-1] + (1,)), cumulative], axis=-1)[..., starts]
+    segment = np.cumsum(np.concatenate([[0], np.diff(key_pairs) != 0])) if len(key_pairs) != 0 else key_pairs
+    return cumulative - before[..., segment]
+
+
+def cohens_kappa(ratings: RatingsMatrix, **kwargs) -> Dict[Any, Any]:
     """
     Calculates the pairwise Cohen's kappa score for inter-observer agreement for multiple observers.
 
-    :param data:
-        DataFrame containing 'observer_id' and 'value' columns representing observer ratings.
+    Nonzero cells of the confusion matrices of all observer pairs are calculated from a single sparse contraction of
+    the ratings matrix, so the scores of all pairs are obtained at once. Each pair is evaluated on the items rated by
+    both observers, and the scores are the same as calculated by `sklearn.metrics.cohen_kappa_score` for the ratings of
+    those items. Pairs without common items have NaN scores.
+
+    :param ratings:
+        Ratings of all observers.
+    :param weights:
+        None for unweighted kappa, or one of `kappa_weights` for weighted kappa.
+    :param ci:
+        Confidence level of bootstrap confidence intervals of the scores. Intervals are not calculated if None.
+    :param resample:
+        Resampling unit of the bootstrap, see `bootstrap.cohens_kappa`.
+    :param n_resamples:
+        Number of bootstrap resamples.
     :return:
-        A DataFrame where rows and columns represent observer IDs, and each cell holds the Cohen's kappa score.
-    :raises ValueError:
-        If observers do not have responses of the same length, preventing score calculation.
+        A DataFrame where rows and columns represent observer IDs, and each cell holds the Cohen's kappa score. If
+        `ci` is given, confidence intervals are returned under the key 'confidence_intervals'.
     """
     # Used this link for referent implementation: https://scikit-learn.org/stable/modules/generated/sklearn.metrics.cohen_kappa_score.html#sklearn.metrics.cohen_kappa_score
-    observer_ids = np.unique(data['observer_id'])
-    logger.info(f"Found {len(observer_ids)} observers in a database.")
-
-    scores_per_observer = []
-    for oid in observer_ids:
-        scores_per_observer.append(data[data['observer_id'] == oid]['value'].tolist())
-
-    # Check if all observers has responded to the same number of questions
-    reference_length: int = len(scores_per_observer[0])
-    if not all(len(scores) == reference_length for scores in scores_per_observer):
-        logger.error(f"Inconsistent response lengths between observers. This will prevent Cohen's score calculation. "
-                        f"Exiting")
-        raise ValueError("Inconsistent response lengths between observers.")
-
-    agreement_matrix = np.zeros((len(observer_ids), len(observer_ids)))
-    for i, j in itertools.combinations(range(len(observer_ids)), r=2):
-        agreement_matrix[i, j] = cohen_kappa_score(
-            scores_per_observer[i],
-            scores_per_observer[j]
+    logger.info(f"Found {ratings.n_observers} observers in a database.")
+    _warn_pairs_without_overlap(ratings)
+
+    first, second, rows, columns, counts = ratings.confusion_cells()
+    n_observers = ratings.n_observers
+    kappa = kappa_from_cells(counts, first * n_observers + second, rows, columns, n_observers ** 2,
+                             kwargs.get('weights')).reshape(n_observers, n_observers)
+    # kappa is symmetric, so the scores of pairs first < second are mirrored
+    agreement_matrix = np.where(np.triu(np.ones((n_observers, n_observers), dtype=bool), k=1), kappa, kappa.T)
+    np.fill_diagonal(agreement_matrix, 0)
+
+    agreement_df = pd.DataFrame(agreement_matrix, index=ratings.observer_ids, columns=ratings.observer_ids)
+    retval = {'pairwise_observers': agreement_df}
+
+    if kwargs.get('ci') is not None:
+        # imported here, since the bootstrap module builds on the functions above
+        from analyzers.statistics import bootstrap
+
+        retval['confidence_intervals'] = bootstrap.cohens_kappa(
+            ratings,
+            unit=kwargs.get('resample', 'cases'),
+            weights=kwargs.get('weights'),
+            n_resamples=kwargs.get('n_resamples', 10000),
+            confidence=kwargs['ci']
         )
-        agreement_matrix[j, i] = agreement_matrix[i, j]
 
-    agreement_df = pd.DataFrame(agreement_matrix, index=observer_ids, columns=observer_ids)
+    return retval
+
 
-    return {'pairwise_observers': agreement_df}
+alpha_levels = ["nominal", "ordinal", "interval", "ratio"]
 
 
-def krippendorff_alpha(data: pd.DataFrame, **kwargs) -> Dict[Any, float]:
+def _alpha_distances(categories: np.ndarray, n_v: np.ndarray, level: str) -> np.ndarray:
+    # squared distances of all pairs of categories, ordinal distances depend on the number of pairable values
+    n_categories = len(categories)
+    if level == "nominal":
+        return np.ones((n_categories, n_categories)) - np.eye(n_categories)
+    if level == "ordinal":
+        i, j = np.meshgrid(np.arange(n_categories), np.arange(n_categories), indexing="ij")
+        lower, upper = np.minimum(i, j), np.maximum(i, j)
+        cumulative = np.cumsum(n_v, axis=-1)
+        between = cumulative[..., upper] - cumulative[..., lower] + n_v[..., lower]
+        return (between - (n_v[..., i] + n_v[..., j]) / 2) ** 2
+
+    values = categories.astype(float)
+    difference = values[:, None] - values[None, :]
+    if level == "interval":
+        return difference ** 2
+    total = values[:, None] + values[None, :]
+    return np.divide(difference, total, out=np.zeros_like(difference), where=total != 0) ** 2
+
+
+def alpha_from_coincidences(coincidences: np.ndarray, categories: np.ndarray, level: str = "nominal") -> np.ndarray:
+    """
+    Calculates Krippendorff's alpha from coincidence matrices, in the same way as `krippendorff.alpha`.
+
+    :param coincidences:
+        An array of coincidence matrices with categories in the last two dimensions.
+    :param categories:
+        Sorted categories (values) of the coincidence matrices.
+    :param level:
+        Level of measurement, one of `alpha_levels`.
+    :return:
+        An array of alpha values with the shape of `coincidences` without the last two dimensions. Alpha is NaN if
+        there are no pairable values, or if all pairable values are equal.
+    """
+    if level not in alpha_levels:
+        logger.error(f"Unsupported level of measurement '{level}'. Supported levels are {alpha_levels}.")
+        raise ValueError(f"Unsupported level of measurement '{level}'. Supported levels are {alpha_levels}.")
+
+    n_v = coincidences.sum(axis=-2)
+    n = n_v.sum(axis=-1)[..., None, None]
+    expected = (n_v[..., :, None] * n_v[..., None, :] - n_v[..., :, None] * np.eye(len(categories))) / (n - 1)
+    distances = _alpha_distances(categories, n_v, level)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 1 - (coincidences * distances).sum(axis=(-2, -1)) / (expected * distances).sum(axis=(-2, -1))
+
+
+def alpha_from_cells(counts: np.ndarray, pairs: np.ndarray, rows: np.ndarray, columns: np.ndarray, n_pairs: int,
+                     categories: np.ndarray, level: str = "nominal") -> np.ndarray:
+    """
+    Calculates Krippendorff's alpha of observer pairs from the nonzero cells of their confusion matrices, in the same
+    way as `krippendorff.alpha` for the ratings of the two observers.
+
+    The coincidence matrix of two observers is their confusion matrix plus its transpose, so the observed disagreement
+    is summed over the cells, and the expected disagreement is calculated from the marginals of the pair over the
+    categories it used. Nominal, interval and ordinal distances are squared differences of a value of each category
+    (for ordinal data, the mid-rank of the category among the values of the pair), so the expected disagreement follows
+    from the first and second moments of the marginals and the cost is linear in the number of cells. Ratio distances
+    do not decompose, so the expected disagreement is a quadratic form of the marginals of each pair with the matrix of
+    ratio distances, evaluated as dense matrix products for blocks of at most `block_elements` elements.
+
+    :param counts:
+        Counts of the cells.
+    :param pairs:
+        Index of the observer pair of each cell, from 0 to `n_pairs` - 1.
+    :param rows:
+        Category code given by the first observer of the pair in each cell.
+    :param columns:
+        Category code given by the second observer of the pair in each cell.
+    :param n_pairs:
+        Number of observer pairs.
+    :param categories:
+        Sorted categories (values) the codes refer to.
+    :param level:
+        Level of measurement, one of `alpha_levels`.
+    :return:
+        An array of alpha values of the pairs. Alpha is NaN for pairs without pairable values, or if all pairable
+        values of a pair are equal.
+    """
+    if level not in alpha_levels:
+        logger.error(f"Unsupported level of measurement '{level}'. Supported levels are {alpha_levels}.")
+        raise ValueError(f"Unsupported level of measurement '{level}'. Supported levels are {alpha_levels}.")
+
+    counts = np.asarray(counts, dtype=float)
+    n_cells, n_categories = len(pairs), max(len(categories), 1)
+
+    # categories used by each pair, sorted by pair and category, and their marginals in the coincidence matrix
+    keys, inverse = np.unique(np.concatenate([pairs * n_categories + rows, pairs * n_categories + columns]),
+                              return_inverse=True)
+    key_pairs, key_categories = np.divmod(keys, n_categories)
+    a, b = inverse[:n_cells], inverse[n_cells:]
+    n_v = np.bincount(a, weights=counts, minlength=len(keys)) + np.bincount(b, weights=counts, minlength=len(keys))
+    n = np.bincount(key_pairs, weights=n_v, minlength=n_pairs)
+
+    if level == "nominal":
+        observed = 2 * np.bincount(pairs, weights=counts * (rows != columns), minlength=n_pairs)
+        expected = n ** 2 - np.bincount(key_pairs, weights=n_v ** 2, minlength=n_pairs)
+    elif level == "ratio":
+        values = categories.astype(float)[key_categories]
+        observed = 2 * np.bincount(pairs, weights=counts * _ratio_distances(values[a], values[b]), minlength=n_pairs)
+        expected = _ratio_expected(categories, n_v, key_pairs, key_categories, n_pairs)
+    else:
+        if level == "interval":
+            values = categories.astype(float)[key_categories]
+        else:
+            values = _pair_cumsum(n_v, key_pairs) - n_v / 2
+
+        # values are shifted by the first value of each pair, which does not change the distances
+        values = values - values[np.searchsorted(key_pairs, key_pairs)]
+        observed = 2 * np.bincount(pairs, weights=counts * (values[a] - values[b]) ** 2, minlength=n_pairs)
+        expected = 2 * (n * np.bincount(key_pairs, weights=n_v * values ** 2, minlength=n_pairs)
+                        - np.bincount(key_pairs, weights=n_v * values, minlength=n_pairs) ** 2)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 1 - (n - 1) * observed / expected
+
+
+def _ratio_distances(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    total = first + second
+    return np.divide(first - second, total, out=np.zeros_like(total), where=total != 0) ** 2
+
+
+def _ratio_expected(categories: np.ndarray, n_v: np.ndarray, key_pairs: np.ndarray, key_categories: np.ndarray,
+                    n_pairs: int) -> np.ndarray:
+    # sum of n_a * n_b * distance(a, b) over all pairs of categories, a quadratic form of the marginals of each pair
+    # with the matrix of ratio distances, evaluated for blocks of pairs and of distance columns
+    values = categories.astype(float)
+    n_categories = len(values)
+    pairs, key_pairs = np.unique(key_pairs, return_inverse=True)
+    rows_block = max(1, block_elements // max(n_categories, 1))
+    columns_block = max(1, block_elements // max(n_categories, min(rows_block, len(pairs))))
+
+    expected = np.zeros(n_pairs)
+    for start in range(0, len(pairs), rows_block):
+        end = min(start + rows_block, len(pairs))
+        lower, upper = np.searchsorted(key_pairs, [start, end])
+        marginals = np.zeros((end - start, n_categories))
+        marginals[key_pairs[lower:upper] - start, key_categories[lower:upper]] = n_v[lower:upper]
+        for first in range(0, n_categories, columns_block):
+            last = min(first + columns_block, n_categories)
+            distances = _ratio_distances(values[:, None], values[None, first:last])
+            expected[pairs[start:end]] += ((marginals @ distances) * marginals[:, first:last]).sum(axis=1)
+
+    return expected
+
+
+def krippendorff_alpha(ratings: RatingsMatrix, **kwargs) -> Dict[Any, float]:
     """
     Calculates Krippendorff's alpha for inter-rater reliability among multiple users with possiblity
     to calculate pair-wise alpha values as well.
 
-    :param data: A Pandas DataFrame containing observer IDs and their corresponding values.
-                 Must contain 'observer_id' and 'value' columns.
+    The coincidence matrix of all observers is calculated from the number of times each value was given to each unit,
+    and pairwise scores of all observer pairs from the nonzero cells of their confusion matrices, see
+    `alpha_from_cells`. Units rated by only one observer of a pair are not pairable, so missing ratings are handled as
+    in `krippendorff.alpha`, and the values are the same.
+
+    :param ratings: Ratings of all observers, where empty responses are missing ratings.
     :param pairwise: Calculate pair-wise Krippendorff's alpha score for each distinct observer pair.
+    :param level: Level of measurement, one of `alpha_levels`, 'nominal' by default.
     :return: A DataFrame with Krippendorff's alpha values for each pair of observers.
     """
-    observer_ids = np.unique(data['observer_id'])
+    level = kwargs.get('level') or 'nominal'
+    categories = ratings.categories
+    if level != 'nominal' and not np.issubdtype(categories.dtype, np.number):
+        logger.error(f"Level of measurement '{level}' requires numeric values.")
+        raise ValueError(f"Level of measurement '{level}' requires numeric values.")
 
-    all_raters = list()
-    for oid in observer_ids:
-        values = np.array(data[data['observer_id'] == oid]['value'])
-        all_raters.append(values)
+    # number of times each value was given to each unit, and the number of pairable values of each unit
+    value_counts = ratings.value_counts().astype(float)
+    pairable = np.maximum(value_counts.sum(axis=1), 2)
+    coincidences = (value_counts / (pairable - 1)[:, None]).T @ value_counts
+    coincidences -= np.diag((value_counts / (pairable - 1)[:, None]).sum(axis=0))
 
     retval = dict()
-    r = krippendorff.alpha(
-        reliability_data=all_raters,
-        level_of_measurement='nominal'
-    )
-    retval['all_observers'] = r
+    retval['all_observers'] = alpha_from_coincidences(coincidences, categories, level)
 
     pairwise = kwargs.get('pairwise')
     if pairwise:
-        agreement_matrix = np.zeros((len(observer_ids), len(observer_ids)))
-        for i, j in itertools.combinations(range(len(observer_ids)), r=2):
-            agreement_matrix[i, j] = krippendorff.alpha(
-                reliability_data=[all_raters[i], all_raters[j]],
-                level_of_measurement='nominal'
-            )
-            agreement_matrix[j, i] = agreement_matrix[i, j]
-
-        agreement_df = pd.DataFrame(agreement_matrix, index=observer_ids, columns=observer_ids)
+        _warn_pairs_without_overlap(ratings)
+        first, second, rows, columns, counts = ratings.confusion_cells()
+        n_observers = ratings.n_observers
+        alpha = alpha_from_cells(counts, first * n_observers + second, rows, columns, n_observers ** 2, categories,
+                                 level).reshape(n_observers, n_observers)
+        # alpha is symmetric, so the scores of pairs first < second are mirrored
+        agreement_matrix = np.where(np.triu(np.ones((n_observers, n_observers), dtype=bool), k=1), alpha, alpha.T)
+        np.fill_diagonal(agreement_matrix, 0)
+
+        agreement_df = pd.DataFrame(agreement_matrix, index=ratings.observer_ids, columns=ratings.observer_ids)
         retval['pairwise_observers'] = agreement_df
 
     return retval
 
+
+def _warn_pairs_without_overlap(ratings: RatingsMatrix):
+    pairs = ratings.pairs_without_overlap()
+    if len(pairs) != 0:
+        logger.warning(f"{len(pairs)} observer pairs did not rate any common item, their pairwise scores are NaN: "
+                       f"{pairs[:10]}{' ...' if len(pairs) > 10 else ''}")
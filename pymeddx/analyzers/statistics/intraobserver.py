@@ -1,24 +1,33 @@
-import itertools
+import os
 
 import numpy as np
 import pandas as pd
-import pingouin as pg  # library for Cronbach's alpha
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
 
 from analyzers.metrics.diagnostic_score import DiagnosticScore
-from model.question import Question, QuestionType1, QuestionType2
-from model.response import ResponseType1, ResponseType2
+from analyzers.statistics.reliability import ReliabilityStatistics, intraclass_correlations, icc_table
+from model.question import Question, QuestionType1, QuestionType2, QuestionType3
+from model.response import ResponseType1, ResponseType2, ResponseType3
 from utils.database import engine, session
 from utils.logger import logger
 
-from sqlalchemy import select, and_, asc
+from sqlalchemy import and_, asc
 from sqlalchemy.orm import aliased
 
-from typing import List
+from typing import List, Optional
+
+
+# state shared by chunks of observers processed by a worker process, set once by `_init_worker`
+_state = dict()
 
 
 def stats_wrapper(qtype: int, fn: str, observer_ids: List[str], **kwargs) -> dict[any, float]:
     """
     Executes a specified statistical calculation function on data retrieved based on the `qtype` and `fn` arguments.
+    To calculate several statistics, use `IntraObserverSession`, which loads the data only once.
 
     :param qtype:
         The type of questionnaire to retrieve results from the database.
@@ -41,103 +50,305 @@ def stats_wrapper(qtype: int, fn: str, observer_ids: List[str], **kwargs) -> dic
         logger.error(f"No observers are specified. Exiting.")
         exit(1)
 
-    # logger.info(f"Loading repeated measurements for intra-observer agreement evaluation.")
-    if qtype == 1:
-        # extract responses of redundant questions
-        redundant_stmt = session.query(
-            ResponseType1.id,
-            ResponseType1.question_id,
-            ResponseType1.observer_id,
-            ResponseType1.is_redundant,
-            DiagnosticScore.value
-        ).join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)\
-            .where(ResponseType1.is_redundant == True)\
-            .statement
-        redundant_df = pd.read_sql(redundant_stmt, engine)
-        # redundant_df.to_csv("redudantni.csv")
-
-        # extract responses of regular counterparts for redundant questions.
-        question_ids = redundant_df['question_id']
-        if len(question_ids) == 0:
-            logger.error(f"Cannot perform intra-observer agreement, because there are no control measurements.")
-            return
+    analysis = IntraObserverSession(qtype, observer_ids)
+    for oid in analysis.scores:
+        r = analysis.compute(oid, fn, **kwargs)
+        if r is None:
+            continue
+        if 'alpha' in r:
+            print(f"[observer {oid}] Cronbach's alpha value: {r['alpha']}")
+            print(f"[observer {oid}] Cronbach's alpha 95-percent confidence interval: {r['95-percent-confidence-interval']}")
+        elif 'icc_table' in r:
+            print(f"[observer {oid}] ICC table: {r['icc_table']}")
+        else:
+            name, value = next(iter(r.items()))
+            print(f"[observer {oid}] Guttman's lambda {name[1:]} value: {value}")
+
+
+def load_paired_measurements(qtype: int) -> Optional[pd.DataFrame]:
+    """
+    Loads repeated measurements of all observers, each paired with the original measurement of the same question.
+
+    Pairs are formed in a single self-join of responses keyed on the observer, the original question and the repeated
+    question, so each repeated response is joined only with the original responses of the same observer. For type 1
+    questionnaires the repeated question is the original question itself, answered again in a redundant response. For
+    type 2 and type 3 questionnaires, it is a redundant question that refers to the original question, and outcomes of
+    rankings are paired by image pair as well. The join is backed by the indexes of the question and observer columns.
 
-        pairs_stmt = (select(
-            ResponseType1.id,
-            ResponseType1.question_id,
-            ResponseType1.observer_id,
-            ResponseType1.is_redundant,
-            DiagnosticScore.value
-        ).join(DiagnosticScore, ResponseType1.id == DiagnosticScore.response_id)
-            .where(
-                and_(
-                    ResponseType1.question_id.in_(question_ids),
-                    ResponseType1.is_redundant == False
-                )
-            )
-        )
-        paired_df = pd.read_sql(
-            str(pairs_stmt.compile(compile_kwargs={"literal_binds": True})), engine
-        )
-        paired_df = pd.merge(paired_df, redundant_df, on=["question_id", "observer_id"])
-        # paired_df.to_csv("ostalo.csv")
+    :param qtype:
+        The type of questionnaire to retrieve results from the database.
+    :return:
+        A DataFrame with columns 'observer_id', 'value_x' (original measurement) and 'value_y' (repeated measurement),
+        or None if there are no repeated measurements.
+    :raises NotImplementedError:
+        If `qtype` is not supported.
+    """
+    if qtype == 1:
+        Repeated = aliased(ResponseType1)
+        RepeatedScore = aliased(DiagnosticScore)
+        query = session.query(ResponseType1.observer_id, DiagnosticScore.value.label('value_x'),
+                              RepeatedScore.value.label('value_y')) \
+            .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id) \
+            .join(Repeated, and_(
+                Repeated.question_id == ResponseType1.question_id,
+                Repeated.observer_id == ResponseType1.observer_id,
+                Repeated.is_redundant == True
+            )) \
+            .join(RepeatedScore, RepeatedScore.response_id == Repeated.id) \
+            .where(ResponseType1.is_redundant == False) \
+            .order_by(asc(ResponseType1.observer_id), asc(Repeated.id))
+    elif qtype == 2:
+        Repeated = aliased(ResponseType2)
+        query = session.query(ResponseType2.observer_id, ResponseType2.choice.label('value_x'),
+                              Repeated.choice.label('value_y')) \
+            .join(QuestionType2, QuestionType2.ref_question_id == ResponseType2.question_id) \
+            .join(Repeated, and_(
+                Repeated.question_id == QuestionType2.id,
+                Repeated.observer_id == ResponseType2.observer_id
+            )) \
+            .where(QuestionType2.is_redundant == True) \
+            .order_by(asc(ResponseType2.observer_id), asc(Repeated.id))
+    elif qtype == 3:
+        # pair each outcome of a repeated ranking with the outcome for the same image pair in the original ranking
+        Repeated = aliased(ResponseType3)
+        query = session.query(ResponseType3.observer_id, ResponseType3.choice.label('value_x'),
+                              Repeated.choice.label('value_y')) \
+            .join(QuestionType3, QuestionType3.ref_question_id == ResponseType3.question_id) \
+            .join(Repeated, and_(
+                Repeated.question_id == QuestionType3.id,
+                Repeated.observer_id == ResponseType3.observer_id,
+                Repeated.img1_id == ResponseType3.img1_id,
+                Repeated.img2_id == ResponseType3.img2_id
+            )) \
+            .where(QuestionType3.is_redundant == True) \
+            .order_by(asc(ResponseType3.observer_id), asc(Repeated.id))
     else:
-        ResponseType2Ref = aliased(ResponseType2)
-
-        # implement data fetching for QT2
-        query = session.query(ResponseType2.observer_id, ResponseType2.observer_id, ResponseType2.choice, ResponseType2Ref.choice) \
-            .join(QuestionType2, QuestionType2.id == ResponseType2.question_id) \
-            .join(ResponseType2Ref, QuestionType2.ref_question_id == ResponseType2Ref.question_id)\
-            .order_by(asc(ResponseType2.observer_id), asc(ResponseType2.id))\
-            .statement
-
-        paired_df = pd.read_sql(query, engine)
-        if paired_df.empty:
-            logger.error(f"Cannot perform intra-observer agreement, because there are no control measurements.")
-            return None
+        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
-        paired_df.drop('observer_id__1', axis=1, inplace=True)
-        paired_df.rename(columns={'choice': 'value_x'}, inplace=True)
-        paired_df.rename(columns={'rtype2_choice': 'value_y'}, inplace=True)
+    paired_df = pd.read_sql(query.statement, engine)
+    if paired_df.empty:
+        logger.error(f"Cannot perform intra-observer agreement, because there are no control measurements.")
+        return None
+    return paired_df
 
-    scores_per_observer = []
-    for oid in observer_ids:
-        observer_data = paired_df[paired_df['observer_id'] == oid]
-        scores_per_observer.append(observer_data['value_x'].tolist())   # original measures
-        scores_per_observer.append(observer_data['value_y'].tolist())   # repeated measures (this means that each original question has a single repeated question)
 
-        # Uncomment to test results
-        # scores_per_observer = testing_scores(1)
+def load_scores(qtype: int) -> dict[int, np.ndarray]:
+    """
+    Loads paired measurements of all observers with control measurements, see `load_paired_measurements`.
 
-        if fn.lower() == 'actionbars-alpha':
-            r = cronbachs_alpha(scores_per_observer)
-            print(f"[observer {oid}] Cronbach's alpha value: {r['alpha']}")
-            print(f"[observer {oid}] Cronbach's alpha 95-percent confidence interval: {r['95-percent-confidence-interval']}")
-        elif fn.lower() == 'guttmans-lambda-1':
-            r = guttman_lambda_1(scores_per_observer, **kwargs)
-            print(f"[observer {oid}] Guttman's lambda 1 value: {r['L1']}")
-        elif fn.lower() == 'guttmans-lambda-2':
-            r = guttman_lambda_2(scores_per_observer, **kwargs)
-            print(f"[observer {oid}] Guttman's lambda 2 value: {r['L2']}")
-        elif fn.lower() == 'guttmans-lambda-3':
-            r = guttman_lambda_3(scores_per_observer, **kwargs)
-            print(f"[observer {oid}] Guttman's lambda 3 value: {r['L3']}")
-        elif fn.lower() == 'guttmans-lambda-4':
-            logger.warning(f"Lambda 4 calculation is currently unsupported. The existing implementation is resource "
-                           f"inefficient.")
-            # r = guttman_lambda_4(scores_per_observer, **kwargs)
-            # print(f"[observer {oid}] Guttman's lambda 4 value: {r['L4']}")
-        elif fn.lower() == 'guttmans-lambda-5':
-            r = guttman_lambda_5(scores_per_observer, **kwargs)
-            print(f"[observer {oid}] Guttman's lambda 5 value: {r['L5']}")
-        elif fn.lower() == 'guttmans-lambda-6':
-            r = guttman_lambda_6(scores_per_observer, **kwargs)
-            print(f"[observer {oid}] Guttman's lambda 6 value: {r['L6']}")
-        elif fn.lower() == 'icc':
-            r = icc(scores_per_observer, **kwargs)
-            print(f"[observer {oid}] ICC table: {r['icc_table']}")
+    :param qtype:
+        The type of questionnaire to retrieve results from the database.
+    :return:
+        A dictionary with a 2 x n array of the original and repeated measurements of n questions of each observer,
+        ordered by observer id. It is empty if there are no repeated measurements.
+    """
+    paired_df = load_paired_measurements(qtype)
+    if paired_df is None:
+        return dict()
+    return {
+        oid: observer_data[['value_x', 'value_y']].to_numpy(dtype=float).T
+        for oid, observer_data in paired_df.groupby('observer_id')
+    }
+
+
+class IntraObserverSession:
+    """
+    Repeated measurements of the selected observers, loaded once and shared by all intra-observer agreement statistics.
+
+    Paired measurements of all observers are loaded in a single pass, and the original and repeated measurements of
+    each observer are arranged once as a 2 x n array (original and repeated measurements of n questions), which is the
+    input of every statistic of the battery. The statistics use the array in two orientations, each with its own
+    covariance matrix, see `reliability`: Guttman's lambdas treat the questions as items and share one covariance
+    matrix, while Cronbach's alpha treats the original and the repeated measurement as items and is calculated from the
+    covariance matrix of the transposed array. Alpha therefore differs from Guttman's L3 in general. ICCs of all
+    observers are calculated in batches of observers with the same number of questions, see `icc_tables`. Batteries of
+    many observers can be calculated in a process pool, see `results`.
+    """
+
+    # statistics of the battery, in the order they are calculated
+    statistics = [
+        'cronbachs-alpha',
+        'icc',
+        'guttmans-lambda-1',
+        'guttmans-lambda-2',
+        'guttmans-lambda-3',
+        'guttmans-lambda-4',
+        'guttmans-lambda-5',
+        'guttmans-lambda-6',
+    ]
+
+    def __init__(self, qtype: int, observer_ids: Optional[List[int]] = None,
+                 scores: Optional[dict[int, np.ndarray]] = None):
+        """
+        :param qtype: The type of questionnaire to retrieve results from the database.
+        :param observer_ids: Identifiers of the observers to analyze. If None, all observers with control
+            measurements are discovered and analyzed.
+        :param scores: Measurements of the observers as returned by `load_scores`. Loaded from the database if None.
+        """
+        self.qtype = qtype
+        self._reliability = dict()
+        self._icc_tables = None
+
+        if scores is None:
+            scores = load_scores(qtype)
+        if observer_ids is None:
+            self.observer_ids = list(scores)
+            self.scores = dict(scores)
+            logger.info(f"Found {len(self.scores)} observers with control measurements.")
+            return
+
+        self.observer_ids = list(observer_ids)
+        self.scores = {oid: values for oid, values in scores.items() if oid in self.observer_ids}
+        missing = [oid for oid in self.observer_ids if oid not in self.scores]
+        if len(missing) != 0:
+            logger.warning(f"Observers {missing} have no control measurements and are left out of intra-observer "
+                           f"agreement.")
+
+    def compute(self, oid: int, fn: str, **kwargs) -> Optional[dict[any, any]]:
+        """
+        Calculates a single statistic for one observer.
+
+        :param oid: Identifier of the observer.
+        :param fn: Name of the statistic, one of `statistics`. 'actionbars-alpha' is accepted for Cronbach's alpha.
+        :return: Result of the statistic function, or None if the statistic is not supported.
+        """
+        fn = fn.lower()
+        reliability = self.reliability(oid)
+        if fn in ['cronbachs-alpha', 'actionbars-alpha']:
+            alpha, interval = self.reliability(oid, transposed=True).cronbachs_alpha()
+            return {'alpha': alpha, '95-percent-confidence-interval': interval}
+        elif fn == 'guttmans-lambda-1':
+            return {'L1': reliability.lambda_1()}
+        elif fn == 'guttmans-lambda-2':
+            return {'L2': reliability.lambda_2()}
+        elif fn == 'guttmans-lambda-3':
+            return {'L3': reliability.lambda_3()}
+        elif fn == 'guttmans-lambda-4':
+            L4, L4_upper_bound = reliability.lambda_4(**kwargs)
+            return {'L4': L4, 'L4-upper-bound': L4_upper_bound}
+        elif fn == 'guttmans-lambda-5':
+            return {'L5': reliability.lambda_5()}
+        elif fn == 'guttmans-lambda-6':
+            return {'L6': reliability.lambda_6()}
+        elif fn == 'icc':
+            return {'icc_table': self.icc_tables()[oid]}
         else:
             logger.warning(f"Unsupported calculation type. This command has no effect.")
+            return None
+
+    def reliability(self, oid: int, transposed: bool = False) -> ReliabilityStatistics:
+        """
+        Sufficient statistics of the measurements of one observer in one orientation, calculated once per orientation
+        and shared by all coefficients of that orientation.
+
+        :param oid: Identifier of the observer.
+        :param transposed: If False, questions are the items, as in Guttman's lambdas. If True, the original and the
+            repeated measurement are the items, as in Cronbach's alpha and ICC.
+        """
+        key = (oid, transposed)
+        if key not in self._reliability:
+            scores = self.scores[oid]
+            self._reliability[key] = ReliabilityStatistics(scores.T if transposed else scores)
+        return self._reliability[key]
+
+    def icc_tables(self) -> dict[int, pd.DataFrame]:
+        """
+        ICC tables of all observers, calculated once. Questions with a missing measurement are left out, and the
+        measurements of observers with the same number of remaining questions are stacked and passed to
+        `intraclass_correlations` at once, so the mean squares and F distributions of a batch are evaluated together.
+
+        :return: A dictionary with the ICC table of each observer, see `icc`.
+        """
+        if self._icc_tables is None:
+            ratings = {oid: _complete_targets(scores) for oid, scores in self.scores.items()}
+            batches = dict()
+            for oid, data in ratings.items():
+                batches.setdefault(data.shape, []).append(oid)
+
+            self._icc_tables = dict()
+            for oids in batches.values():
+                statistics = intraclass_correlations(np.stack([ratings[oid] for oid in oids]))
+                for i, oid in enumerate(oids):
+                    self._icc_tables[oid] = icc_table({key: value[i] for key, value in statistics.items()}).round(3)
+        return self._icc_tables
+
+    def results(self, statistics: Optional[List[str]] = None, n_jobs: Optional[int] = 1) -> pd.DataFrame:
+        """
+        Calculates a battery of statistics for every observer with control measurements.
+
+        With more than one job, measurements of all observers are copied once into a single shared memory block, which
+        worker processes read without copying, and each worker calculates the batteries of chunks of observers. The
+        results are the same as calculated in a single process.
+
+        :param statistics: Names of the statistics to calculate, all `statistics` by default.
+        :param n_jobs: Number of worker processes, all available CPUs if None.
+        :return: A DataFrame with one row per observer and one column per calculated value, i.e. Cronbach's alpha and
+            its 95% confidence interval, the ICC of each type, Guttman's lambdas, and the upper bound of lambda 4.
+        """
+        statistics = statistics or self.statistics
+        n_jobs = min(n_jobs or os.cpu_count() or 1, len(self.scores))
+        if n_jobs > 1:
+            return self._parallel_results(statistics, n_jobs)
+
+        rows = dict()
+        for oid in self.scores:
+            row = dict()
+            for fn in statistics:
+                r = self.compute(oid, fn)
+                if r is None:
+                    continue
+                if 'alpha' in r:
+                    row["Cronbach's alpha"] = r['alpha']
+                    row["Cronbach's alpha CI95%"] = r['95-percent-confidence-interval']
+                elif 'icc_table' in r:
+                    row.update(zip(r['icc_table']['Type'], r['icc_table']['ICC']))
+                else:
+                    row.update(r)
+            rows[oid] = row
+        return pd.DataFrame.from_dict(rows, orient='index').rename_axis('observer_id')
+
+    def _parallel_results(self, statistics: List[str], n_jobs: int) -> pd.DataFrame:
+        oids = list(self.scores)
+        offsets = np.concatenate([[0], np.cumsum([self.scores[oid].shape[1] for oid in oids])])
+        shape = (2, int(offsets[-1]))
+
+        memory = shared_memory.SharedMemory(create=True, size=max(shape[0] * shape[1] * 8, 1))
+        try:
+            measurements = np.ndarray(shape, dtype=float, buffer=memory.buf)
+            for oid, start, end in zip(oids, offsets[:-1], offsets[1:]):
+                measurements[:, start:end] = self.scores[oid]
+            del measurements
+
+            # several chunks per worker balance observers with different numbers of questions
+            chunks = np.array_split(np.arange(len(oids)), min(len(oids), 4 * n_jobs))
+            logger.info(f"Calculating intra-observer agreement of {len(oids)} observers in {len(chunks)} chunks on "
+                        f"{n_jobs} processes.")
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(memory.name, shape, self.qtype, oids, offsets.tolist())) as executor:
+                frames = list(executor.map(_run_observers, [chunk.tolist() for chunk in chunks], repeat(statistics)))
+        finally:
+            memory.close()
+            memory.unlink()
+        return pd.concat(frames)
+
+
+def _init_worker(name: str, shape: tuple, qtype: int, oids: List[int], offsets: List[int]):
+    # the shared memory block is kept open by the worker, and measurements of observers are views of it
+    memory = shared_memory.SharedMemory(name=name)
+    _state.clear()
+    _state.update({
+        "memory": memory,
+        "measurements": np.ndarray(shape, dtype=float, buffer=memory.buf),
+        "qtype": qtype,
+        "oids": oids,
+        "offsets": offsets,
+    })
+
+
+def _run_observers(indices: List[int], statistics: List[str]) -> pd.DataFrame:
+    measurements, offsets = _state["measurements"], _state["offsets"]
+    scores = {_state["oids"][i]: measurements[:, offsets[i]:offsets[i + 1]] for i in indices}
+    return IntraObserverSession(_state["qtype"], list(scores), scores=scores).results(statistics)
 
 
 def cronbachs_alpha(scores_per_observer: list[list[float]]) -> dict[any, any]:
@@ -148,228 +359,90 @@ def cronbachs_alpha(scores_per_observer: list[list[float]]) -> dict[any, any]:
     1) Original from paper: alpha = k/(k-1) * (1 - (sum variance_over_persons_of_the_n_items)/variance_over_person_of_the_sum_of_n_items) - formula is identical to Guttman Lambda 3
     2) Formula from Wikipedia and others: alpha = k*c / (v + (k-1)*c), where v is average item variance, c is average covariance between items
     3) Formula from blog: alpha = k*r / (1 + (k-1)*r), where r is mean correlation
-    We used the pre-implemented formula from pingouin.
+    We use the first formula, with the same confidence interval as pingouin. Each list of scores is an item, i.e. a
+    column of `ReliabilityStatistics`.
 
     Used this link for referent implementation: https://www.educative.io/answers/how-to-implement-cronbachs-alpha-for-reliability-in-python
     """
-    # Transform the list of lists into a DataFrame
-    df = pd.DataFrame({f'P{i+1}': col for i, col in enumerate(scores_per_observer)})
-
-    cronbach = pg.cronbach_alpha(data=df)
-
-    return {'alpha': cronbach[0], '95-percent-confidence-interval': cronbach[1]}
+    alpha, interval = ReliabilityStatistics(np.asarray(scores_per_observer, dtype=float).T).cronbachs_alpha()
+    return {'alpha': alpha, '95-percent-confidence-interval': interval}
 
 
 def guttman_lambda_1(scores_per_observer: list[list[float]]) -> dict[any, any]:
     """
-    Formula from the original paper.
-
-    For a given trial, let s_1^2 , s_2^2, ..., s_n^2 be the variances over persons of the n items in the test,
-    and let s_t^2 be the variance over persons of the sum of the items.
-
-    Lambda 1 can be computed from the following formula:
-
-    L1 = 1 - (sum[1..n] s_j^2)/s_t^2
+    Formula from the original paper, see `ReliabilityStatistics.lambda_1`.
 
     http://moodle3.f.bg.ac.rs/pluginfile.php/1053/mod_resource/content/1/Callender_Osburn_-_An_Empirical_COmparison_of_Coefficient_Alpha_Gutman_s_Lambda_-_2_and_Msplit_Maximized_Split-Half_Reliability_Estimates.pdf
     """
-    n_items = len(scores_per_observer[0])
-    n_persons = len(scores_per_observer)
-
-    # The variances over persons of the n items in the test
-    s_j2 = np.var(scores_per_observer, axis=0, ddof=0)
-    assert len(s_j2) == n_items, 'Guttman lambda 1: lengths do not match, we should get a list of length n_items'
-    sum_s_j2 = np.sum(s_j2) # The variance over persons of the sum of the items
-    sum_items = np.sum(scores_per_observer, axis=1)
-    assert len(sum_items) == n_persons, 'Guttman lambda 1: lengths do not match, we should get a list of length n_persons'
-    s_t2 = np.var(sum_items)
-
-    L1 = 1- sum_s_j2/s_t2
-
-    return {'L1': L1}
+    return {'L1': ReliabilityStatistics(scores_per_observer).lambda_1()}
 
 
 def guttman_lambda_2(scores_per_observer: list[list[float]]) -> dict[any, any]:
     """
-    Formula from the original paper.
-
-    The sum of squares of the covariances between items for the given trial is denoted by C_2
-    L2 = L1 + sqrt(n/(n-1) C_2)/s_t^2
+    Formula from the original paper, see `ReliabilityStatistics.lambda_2`.
     """
-    n_items = len(scores_per_observer[0])
-    n_persons = len(scores_per_observer)
-
-    cov = np.cov(np.array(scores_per_observer).T)
-    assert cov.shape == (n_items, n_items), 'Guttman lambda 2: Covariance matrix shape is invalid, it should be of shape (n_items, n_items)'
-    cov2 = np.power(cov, 2)
-    C2 = np.sum(cov2) - np.sum(np.diag(cov2))
-
-    # The variance over persons of the sum of the items
-    sum_items = np.sum(scores_per_observer, axis=1)
-    assert len(sum_items) == n_persons, 'Guttman lambda 2: lengths do not match, we should get a list of length n_persons'
-    s_t2 = np.var(sum_items)
-
-    L1 = guttman_lambda_1(scores_per_observer)['L1']
-
-    L2 = L1 + np.sqrt(n_items/(n_items-1)*C2)/s_t2
-
-    return {'L2': L2}
+    return {'L2': ReliabilityStatistics(scores_per_observer).lambda_2()}
 
 
 def guttman_lambda_3(scores_per_observer: list[list[float]]) -> dict[any, any]:
     """
-    Formula from the original paper.
-
-    L3 = n/(n-1) * L1
+    Formula from the original paper, see `ReliabilityStatistics.lambda_3`.
     """
-    n_items = len(scores_per_observer[0])
-    n_persons = len(scores_per_observer)
+    return {'L3': ReliabilityStatistics(scores_per_observer).lambda_3()}
 
-    L1 = guttman_lambda_1(scores_per_observer)['L1']
 
-    L3 = n_items/(n_items-1) * L1
-
-    return {'L3': L3}
-
-
-def guttman_lambda_4(scores_per_observer: list[list[float]]) -> dict[any, any]:
+def guttman_lambda_4(scores_per_observer: list[list[float]], n_starts: int = 8, seed: Optional[int] = 0) \
+        -> dict[any, any]:
     """
-    Formula from the original paper.
-
-    The formula for L4 requires that the test be scored as two halves.
-    The respective variances of the two parts for the single trial are denoted by s_a^2 and s_b^2
-    L4 = max 2(1-(s_a^2 + s_b^2)/s_t^2)
+    Formula from the original paper, see `ReliabilityStatistics.lambda_4`.
 
     Note that if there are 2k items (even number), there are C(2k,k)/2 different split-half partitions of the 2k items.
     If there are 2k+1 items (odd number), there are C(2k+1,k) different splits.
     E.g. if there are 10 questions in the questionnaire, there are C(10,5)/2 = 126 possible split-half partitions.
     https://real-statistics.com/reliability/internal-consistency-reliability/split-half-methodology/guttman-reliability/
 
-    Here, we will split into equal first and second part.
-
-    TODO: calculate C(2k,k)/2 instead of C(2k,k)
+    :param scores_per_observer: Scores of persons (rows) on items (columns).
+    :param n_starts: Number of splits the local search starts from.
+    :param seed: Seed of the random starting splits.
+    :return: A dictionary with L4 and its upper bound, which equals L4 if all splits were evaluated.
     """
-    n_items = len(scores_per_observer[0])
-    n_persons = len(scores_per_observer)
-
-    # The variance over persons of the sum of the items
-    sum_items = np.sum(scores_per_observer, axis=1)
-    assert len(sum_items) == n_persons, 'Guttman lambda 4: lengths do not match, we should get a list of length n_persons'
-    s_t2 = np.var(sum_items)
-
-    def split_sublists(scores, partition):
-        split = []
-        for i in range(len(scores)):
-            row = scores[i]
-            # print(row)
-            split.append([row[j] for j in partition])
-        return split
-
-    L4_list = []
-
-    # Generate all combinations of size n/2
-    from itertools import combinations
-    items = [*range(n_items)]
-
-    # FIXME this loop takes too long even for moderately small sizes of item list
-    for i, comb in enumerate(combinations(items, n_items//2)):
-        print(f"iter {i}")
-        partition_a = list(comb)
-        partition_b = list(set(items) - set(comb))
-
-        scores_a = split_sublists(scores_per_observer, partition_a)
-        scores_b = split_sublists(scores_per_observer, partition_b)
-
-        s_a2 = np.sum(np.var(scores_a, axis=1))
-        s_b2 = np.sum(np.var(scores_b, axis=1))
-
-        L4_curr = 2*(1-(s_a2 + s_b2)/s_t2)
-        L4_list.append(L4_curr)
-
-    L4 = max(L4_list)
-
-    return {'L4': L4}
+    L4, L4_upper_bound = ReliabilityStatistics(scores_per_observer).lambda_4(n_starts=n_starts, seed=seed)
+    return {'L4': L4, 'L4-upper-bound': L4_upper_bound}
 
 
 def guttman_lambda_5(scores_per_observer: list[list[float]]) -> dict[any, any]:
     """
-    Formula from the original paper.
-
-    Let C_2j be the sum of the squares of the covariances of item j with the remaining n-1 items
-    Let C_2 be the largest of the C_2j.
-    L5 = L1 + 2*sqrt(C_2)/s_t^2
+    Formula from the original paper, see `ReliabilityStatistics.lambda_5`.
     """
-    n_items = len(scores_per_observer[0])
-    n_persons = len(scores_per_observer)
-
-    # The variance over persons of the sum of the items
-    sum_items = np.sum(scores_per_observer, axis=1)
-    assert len(sum_items) == n_persons, 'Guttman lambda 5: lengths do not match, we should get a list of length n_persons'
-    s_t2 = np.var(sum_items)
-
-    cov = np.cov(np.array(scores_per_observer).T)
-    assert cov.shape == (n_items, n_items), 'Guttman lambda 5: Covariance matrix shape is invalid, it should be of shape (n_items, n_items)'
-    cov2 = np.power(cov, 2)
-
-    C_2j = np.sum(cov2, axis=0) - np.diag(cov2)
-    C_2 = max(C_2j)
-
-    L1 = guttman_lambda_1(scores_per_observer)['L1']
-
-    L5 = L1 + 2*np.sqrt(C_2) / s_t2
-
-    return {'L5': L5}
+    return {'L5': ReliabilityStatistics(scores_per_observer).lambda_5()}
 
 
 def guttman_lambda_6(scores_per_observer: list[list[float]]) -> dict[any, any]:
     """
-    Formula from the original paper.
-
-    Let e_j2 be the variance of the errors of estimate of item j from its linear multiple regression on the remaining n-1 items.
-    L6 = 1 - (sum[1..n] e_j2)/s_t^2
+    Formula from the original paper, see `ReliabilityStatistics.lambda_6`.
 
     https://www.cogn-iq.org/statistical-tools/guttman-lambda-6.html
     """
-    n_items = len(scores_per_observer[0])
-    n_persons = len(scores_per_observer)
-
-    # The variance over persons of the sum of the items
-    sum_items = np.sum(scores_per_observer, axis=1)
-    assert len(sum_items) == n_persons, 'Guttman lambda 6: lengths do not match, we should get a list of length n_persons'
-    s_t2 = np.var(sum_items)
-
-    data = np.array(scores_per_observer)
-    e_j2 = []
-
-    from sklearn.linear_model import LinearRegression
-    for j in range(n_items):
-        X = np.delete(data, j, 1)
-        y = data[:, j]
-
-        model = LinearRegression().fit(X, y)
-
-        error = y - model.predict(X)
-        error_variance = np.var(error)
-        e_j2.append(error_variance)
-
-    L6 = 1 - np.sum(e_j2) / s_t2
-    return {'L6': L6}
+    return {'L6': ReliabilityStatistics(scores_per_observer).lambda_6()}
 
 
 def icc(scores_per_observer: list[list[float]]) -> dict[any, any]:
     """
     Calculate intraclass correlation (ICC) score.
 
+    Each list of scores is a rater and each question a target, and the ICC table is the same as calculated by
+    `pingouin.intraclass_corr`, see `reliability.intraclass_correlations`.
+
     Used this link for referent implementation: https://real-statistics.com/reliability/interrater-reliability/intraclass-correlation/
     """
-    # Transform the list of lists into a DataFrame
-    df = pd.DataFrame({f'P{i+1}': col for i, col in enumerate(scores_per_observer)}).reset_index()
-    df = df.melt(id_vars=['index'], var_name='Rater', value_name='Score')
-    df = df.rename(columns={'index': 'Question'})
-
-    corr = pg.intraclass_corr(data=df, targets='Question', raters='Rater', ratings='Score').round(3)
-    print(corr)
-    return {'icc_table': corr}
+    ratings = _complete_targets(np.asarray(scores_per_observer, dtype=float))
+    return {'icc_table': icc_table(intraclass_correlations(ratings)).round(3)}
+
+
+def _complete_targets(scores: np.ndarray) -> np.ndarray:
+    # targets x raters array of the questions measured by all raters
+    ratings = scores.T
+    return ratings[~np.isnan(ratings).any(axis=1)]
 
 
 def testing_scores(test_num):
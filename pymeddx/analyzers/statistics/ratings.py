@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from typing import List, Sequence, Tuple
+from sqlalchemy import asc
+
+from analyzers.metrics.diagnostic_score import DiagnosticScore
+from model.question import QuestionType2, QuestionType3
+from model.response import ResponseType1, ResponseType2, ResponseType3
+from utils.database import engine, session
+from utils.logger import logger
+
+
+class RatingsMatrix:
+    """
+    Ratings of items by observers, aligned by item rather than by the position of a response, so observers that rated
+    different items, e.g. because they answered different surveys, are compared only on the items they both rated.
+
+    Ratings are stored as an items x observers matrix of integer category codes, where -1 marks an item the observer
+    did not rate. Statistics of all observer pairs are calculated from products of one-hot encoded codes, in which
+    missing ratings are zero rows, so every pair is evaluated on its overlapping items only. One-hot encoded ratings
+    are sparse, since categories may be many, e.g. image ids of type 2 and type 3 questionnaires.
+    """
+
+    # columns identifying an item, for each questionnaire type
+    item_columns = {
+        1: ["question_id"],
+        2: ["question_id"],
+        3: ["question_id", "img1_id", "img2_id"],
+    }
+
+    def __init__(self, item_ids: pd.Index, observer_ids: np.ndarray, categories: np.ndarray, codes: np.ndarray):
+        self.item_ids = item_ids
+        self.observer_ids = observer_ids
+        self.categories = categories
+        self.codes = codes
+
+    def __repr__(self):
+        return "<Ratings matrix ({} items, {} observers, {} categories, {} ratings)>".format(
+            self.n_items, self.n_observers, self.n_categories, int(self.observed.sum())
+        )
+
+    @property
+    def n_items(self):
+        return self.codes.shape[0]
+
+    @property
+    def n_observers(self):
+        return self.codes.shape[1]
+
+    @property
+    def n_categories(self):
+        return len(self.categories)
+
+    @property
+    def observed(self):
+        """
+        Items x observers boolean mask of given ratings.
+        """
+        return self.codes >= 0
+
+    @staticmethod
+    def from_frame(data: pd.DataFrame, items: Sequence[str], missing: bool = False) -> "RatingsMatrix":
+        """
+        Builds a ratings matrix from one row per rating.
+
+        :param data:
+            DataFrame containing 'observer_id', 'value' and the item columns. If an observer rated an item more than
+            once, the first rating is kept.
+        :param items:
+            Columns identifying an item.
+        :param missing:
+            If True, empty values are treated as missing ratings, otherwise they are a category of their own.
+        """
+        item_codes, item_ids = pd.MultiIndex.from_frame(data[list(items)]).factorize(sort=True) \
+            if len(items) > 1 else pd.factorize(data[items[0]], sort=True)
+        observer_codes, observer_ids = pd.factorize(data['observer_id'], sort=True)
+        category_codes, categories = pd.factorize(data['value'], sort=True, use_na_sentinel=missing)
+
+        cells = item_codes.astype(np.int64) * len(observer_ids) + observer_codes
+        first = ~pd.Series(cells).duplicated().to_numpy()
+        if not np.all(first):
+            logger.warning(f"Found {np.count_nonzero(~first)} repeated ratings of the same item by the same observer. "
+                           f"Only the first rating of each item is used.")
+
+        dtype = np.int16 if len(categories) < np.iinfo(np.int16).max else np.int32
+        codes = np.full((len(item_ids), len(observer_ids)), -1, dtype=dtype)
+        codes[item_codes[first], observer_codes[first]] = category_codes[first]
+        return RatingsMatrix(pd.Index(item_ids), np.asarray(observer_ids), np.asarray(categories), codes)
+
+    @staticmethod
+    def load(qtype: int, missing: bool = False) -> "RatingsMatrix":
+        """
+        Loads ratings of all observers for non-redundant questions in a single query. Items are questions for type 1
+        and type 2 questionnaires, and ranked image pairs of a question for type 3 questionnaires. Ratings are
+        diagnostic scores for type 1 questionnaires, and chosen images otherwise.
+
+        :param qtype:
+            The type of questionnaire to load ratings of.
+        :param missing:
+            If True, empty values are treated as missing ratings, see `from_frame`.
+        :raises NotImplementedError:
+            If `qtype` is not supported.
+        """
+        query_map = {
+            1: session.query(ResponseType1.question_id, ResponseType1.observer_id, DiagnosticScore.value)
+                .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)
+                .where(ResponseType1.is_redundant == False)
+                .order_by(asc(ResponseType1.id)),
+            2: session.query(ResponseType2.question_id, ResponseType2.observer_id, ResponseType2.choice.label('value'))
+                .join(QuestionType2, ResponseType2.question_id == QuestionType2.id)
+                .where(QuestionType2.is_redundant == False)
+                .order_by(asc(ResponseType2.id)),
+            3: session.query(ResponseType3.question_id, ResponseType3.img1_id, ResponseType3.img2_id,
+                             ResponseType3.observer_id, ResponseType3.choice.label('value'))
+                .join(QuestionType3, ResponseType3.question_id == QuestionType3.id)
+                .where(QuestionType3.is_redundant == False)
+                .order_by(asc(ResponseType3.id)),
+        }
+        query = query_map.get(qtype)
+        if query is None:
+            raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
+
+        data = pd.read_sql(query.statement, engine)
+        ratings = RatingsMatrix.from_frame(data, RatingsMatrix.item_columns[qtype], missing=missing)
+        logger.info(f"Loaded {len(data)} ratings of {ratings.n_items} items by {ratings.n_observers} observers.")
+        return ratings
+
+    def values(self) -> np.ndarray:
+        """
+        :return: An items x observers float matrix of rated values, NaN where an item was not rated. Categories have
+            to be numeric.
+        """
+        values = np.full(self.codes.shape, np.nan)
+        observed = self.observed
+        values[observed] = self.categories.astype(float)[self.codes[observed]]
+        return values
+
+    def overlap(self) -> np.ndarray:
+        """
+        :return: An observers x observers matrix with the number of items rated by both observers of each pair.
+        """
+        observed = self.observed.astype(float)
+        return (observed.T @ observed).astype(np.int64)
+
+    def value_counts(self) -> np.ndarray:
+        """
+        :return: An items x categories matrix with the number of times each category was given to each item.
+        """
+        observed = self.observed
+        items = np.nonzero(observed)[0]
+        return np.bincount(
+            items * self.n_categories + self.codes[observed],
+            minlength=self.n_items * self.n_categories
+        ).reshape(self.n_items, self.n_categories)
+
+    def onehot(self) -> sparse.csr_matrix:
+        """
+        :return: A sparse items x (observers * categories) matrix, where [t, i * n_categories + a] is 1 if observer i
+            rated item t with category a.
+        """
+        observed = self.observed
+        items, observers = np.nonzero(observed)
+        return sparse.csr_matrix(
+            (np.ones(len(items)), (items, observers * self.n_categories + self.codes[observed].astype(np.int64))),
+            shape=(self.n_items, self.n_observers * self.n_categories)
+        )
+
+    def confusion_cells(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Calculates the nonzero cells of the confusion matrices of all observer pairs from the sparse Gram matrix of the
+        one-hot encoded ratings, so the cost depends on the number of co-rated items rather than on the number of
+        categories. Items not rated by both observers of a pair are not counted.
+
+        :return: A tuple of arrays (first, second, rows, columns, counts) with one element per cell, where observer
+            first rated counts items with category rows, which observer second rated with category columns. Only pairs
+            with first < second are returned.
+        """
+        onehot = self.onehot()
+        gram = (onehot.T @ onehot).tocoo()
+        first, rows = np.divmod(gram.row.astype(np.int64), self.n_categories)
+        second, columns = np.divmod(gram.col.astype(np.int64), self.n_categories)
+        upper = first < second
+        return first[upper], second[upper], rows[upper], columns[upper], gram.data[upper]
+
+    def pairs_without_overlap(self) -> List[tuple]:
+        """
+        :return: A list of pairs of observer ids that did not rate any common item.
+        """
+        i, j = np.nonzero(np.triu(self.overlap() == 0, k=1))
+        return [(self.observer_ids[a], self.observer_ids[b]) for a, b in zip(i, j)]
@@ -0,0 +1,358 @@
+import itertools
+import math
+
+import numpy as np
+import pandas as pd
+
+from scipy.stats import f
+from typing import Dict, Optional
+
+
+# largest number of split-halves for which Guttman's lambda 4 is calculated exhaustively, see `lambda_4`
+lambda_4_exhaustive_splits = 2 ** 17
+
+# number of split-halves evaluated at once in the exhaustive search
+lambda_4_batch = 2 ** 13
+
+# ridge added to a singular covariance matrix in `lambda_6`, relative to its largest eigenvalue
+lambda_6_ridge = 1e-12
+
+# forms of intraclass correlation calculated by `intraclass_correlations`, in the order of the results
+icc_types = {
+    "ICC1": "Single raters absolute",
+    "ICC2": "Single random raters",
+    "ICC3": "Single fixed raters",
+    "ICC1k": "Average raters absolute",
+    "ICC2k": "Average random raters",
+    "ICC3k": "Average fixed raters",
+}
+
+
+class ReliabilityStatistics:
+    """
+    Sufficient statistics of scores of persons (rows) on items (columns), from which all reliability coefficients are
+    calculated: the covariance matrix of the items C and the variance of the sum of the items s_t^2, which is the sum of
+    all elements of C. Scores are converted to an array and C is calculated only once, so calculating every coefficient
+    costs a single covariance computation, and the eigendecomposition of C is shared by lambda 4 and lambda 6.
+
+    Population covariances (ddof=0) are used, except for the squared covariances in lambda 2 and lambda 5, which use
+    sample covariances (ddof=1), as in the original implementation of these coefficients.
+    """
+
+    def __init__(self, scores):
+        self.scores = np.asarray(scores, dtype=float)
+        self.n_persons, self.n_items = self.scores.shape
+        self.cov = np.atleast_2d(np.cov(self.scores, rowvar=False, ddof=0))
+        self.s_t2 = self.cov.sum()
+        self._eigh = None
+
+    def __repr__(self):
+        return "<Reliability statistics ({} persons, {} items, total variance: {})>".format(
+            self.n_persons, self.n_items, self.s_t2
+        )
+
+    def eigh(self):
+        """
+        :return: Eigenvalues of the covariance matrix in ascending order, clipped at zero, and the eigenvectors.
+        """
+        if self._eigh is None:
+            eigenvalues, eigenvectors = np.linalg.eigh(self.cov)
+            self._eigh = np.clip(eigenvalues, 0, None), eigenvectors
+        return self._eigh
+
+    def _squared_sample_covariances(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.cov * self.n_persons / (self.n_persons - 1)) ** 2
+
+    def lambda_1(self):
+        """
+        For a given trial, let s_1^2 , s_2^2, ..., s_n^2 be the variances over persons of the n items in the test,
+        and let s_t^2 be the variance over persons of the sum of the items.
+
+        L1 = 1 - (sum[1..n] s_j^2)/s_t^2
+        """
+        return 1 - np.trace(self.cov) / self.s_t2
+
+    def lambda_2(self):
+        """
+        The sum of squares of the covariances between items for the given trial is denoted by C_2
+
+        L2 = L1 + sqrt(n/(n-1) C_2)/s_t^2
+        """
+        cov2 = self._squared_sample_covariances()
+        C2 = cov2.sum() - np.trace(cov2)
+        return self.lambda_1() + np.sqrt(self.n_items / (self.n_items - 1) * C2) / self.s_t2
+
+    def lambda_3(self):
+        """
+        L3 = n/(n-1) * L1
+        """
+        return self.n_items / (self.n_items - 1) * self.lambda_1()
+
+    def split_half(self, first_half):
+        """
+        Split-half reliability of a split of the items into two halves a and b, 4 cov(a, b)/s_t^2, which is
+        2(1-(s_a^2 + s_b^2)/s_t^2) for the variances s_a^2 and s_b^2 of the sums of the items of the halves.
+
+        :param first_half: Indices or a boolean mask of the items of the first half.
+        """
+        signs = -np.ones(self.n_items)
+        signs[first_half] = 1
+        return 1 - signs @ self.cov @ signs / self.s_t2
+
+    def lambda_4(self, n_starts: int = 8, seed: Optional[int] = 0):
+        """
+        The largest split-half reliability over splits of the items into two halves of n//2 and n - n//2 items.
+
+        L4 = max 2(1-(s_a^2 + s_b^2)/s_t^2)
+
+        With a split written as a vector s with s_j = 1 for items of the first half and s_j = -1 for items of the second
+        half, s_a^2 + s_b^2 = (s_t^2 + s'Cs)/2, so L4 = 1 - min(s'Cs)/s_t^2 and the value of a split is a quadratic
+        form of the covariance matrix. If there are at most `lambda_4_exhaustive_splits` splits, all of them are
+        evaluated in batches. Otherwise, the best split is searched for by swapping items between the halves, starting
+        from a greedy split and `n_starts` - 1 random splits, so the value is a lower bound of L4. Since s's = n, s'Cs
+        is at least n times the smallest eigenvalue of C, which gives an upper bound of L4.
+
+        :param n_starts: Number of splits the local search starts from.
+        :param seed: Seed of the random starting splits.
+        :return: A tuple (L4, upper bound of L4), where the upper bound equals L4 if all splits were evaluated.
+        """
+        n_items = self.n_items
+        n_splits = math.comb(n_items, n_items // 2) // (2 if n_items % 2 == 0 else 1)
+        if n_splits <= lambda_4_exhaustive_splits:
+            L4 = 1 - _lambda_4_exhaustive(self.cov) / self.s_t2
+            return L4, L4
+
+        rng = np.random.default_rng(seed)
+        starts = [_lambda_4_greedy_split(self.cov)]
+        for _ in range(n_starts - 1):
+            signs = -np.ones(n_items)
+            signs[rng.permutation(n_items)[:n_items // 2]] = 1
+            starts.append(signs)
+        form = min(_lambda_4_local_search(self.cov, signs) for signs in starts)
+
+        bound = n_items * self.eigh()[0][0]
+        return 1 - form / self.s_t2, 1 - bound / self.s_t2
+
+    def lambda_5(self):
+        """
+        Let C_2j be the sum of the squares of the covariances of item j with the remaining n-1 items
+        Let C_2 be the largest of the C_2j.
+
+        L5 = L1 + 2*sqrt(C_2)/s_t^2
+        """
+        cov2 = self._squared_sample_covariances()
+        C_2 = np.max(cov2.sum(axis=0) - np.diag(cov2))
+        return self.lambda_1() + 2 * np.sqrt(C_2) / self.s_t2
+
+    def lambda_6(self):
+        """
+        Let e_j2 be the variance of the errors of estimate of item j from its linear multiple regression on the
+        remaining n-1 items.
+
+        L6 = 1 - (sum[1..n] e_j2)/s_t^2
+
+        The error variance of item j is e_j2 = 1/(C^-1)_jj, i.e. the variance of item j times one minus its squared
+        multiple correlation with the remaining items, so the errors of all items are obtained from the
+        eigendecomposition of C instead of n regressions. If C is singular, e.g. if there are fewer persons than items
+        or an item has the same score for all persons, a ridge of `lambda_6_ridge` times the largest eigenvalue is
+        added to its diagonal, which gives the errors of least squares regressions up to the ridge.
+        """
+        eigenvalues, eigenvectors = self.eigh()
+        if eigenvalues[-1] == 0:
+            # all items are constant, so they are estimated without errors
+            e_j2 = np.zeros(self.n_items)
+        else:
+            if eigenvalues[0] <= lambda_6_ridge * eigenvalues[-1]:
+                eigenvalues = eigenvalues + lambda_6_ridge * eigenvalues[-1]
+            e_j2 = 1 / (eigenvectors ** 2 / eigenvalues).sum(axis=1)
+        return 1 - np.sum(e_j2) / self.s_t2
+
+    def cronbachs_alpha(self, ci: float = 0.95):
+        """
+        alpha = k/(k-1) * (1 - (sum variance_over_persons_of_the_n_items)/variance_over_person_of_the_sum_of_n_items),
+        which is identical to Guttman's lambda 3. The confidence interval is based on the F distribution, as in
+        `pingouin.cronbach_alpha`, and its bounds are rounded to three decimals.
+
+        :param ci: Confidence level of the interval.
+        :return: A tuple (alpha, array of the lower and upper bound of the confidence interval).
+        """
+        alpha = self.lambda_3()
+        df1 = self.n_persons - 1
+        df2 = df1 * (self.n_items - 1)
+        lower = 1 - (1 - alpha) * f.isf((1 - ci) / 2, df1, df2)
+        upper = 1 - (1 - alpha) * f.isf(1 - (1 - ci) / 2, df1, df2)
+        return alpha, np.round([lower, upper], 3)
+
+    def guttman_lambdas(self, **kwargs):
+        """
+        :param kwargs: Options of `lambda_4`.
+        :return: A dictionary with all Guttman's lambdas and the upper bound of lambda 4.
+        """
+        L4, L4_upper_bound = self.lambda_4(**kwargs)
+        return {
+            'L1': self.lambda_1(),
+            'L2': self.lambda_2(),
+            'L3': self.lambda_3(),
+            'L4': L4,
+            'L4-upper-bound': L4_upper_bound,
+            'L5': self.lambda_5(),
+            'L6': self.lambda_6(),
+        }
+
+
+def intraclass_correlations(ratings: np.ndarray, confidence: float = 0.95) -> Dict[str, np.ndarray]:
+    """
+    Calculates the six forms of intraclass correlation of Shrout and Fleiss, with their F-tests and confidence
+    intervals, in the same way as `pingouin.intraclass_corr`.
+
+    The mean squares of the two-way ANOVA (targets, raters and residual) are calculated directly from the target, rater
+    and grand means of the wide array of ratings, instead of fitting an ANOVA model to ratings in the long format. The
+    calculation is vectorized over leading dimensions, so ICCs of a batch of observers are calculated at once.
+
+    :param ratings: An array of shape (..., n, k) with ratings of n targets by k raters, without missing values.
+    :param confidence: Confidence level of the intervals.
+    :return: A dictionary with arrays of shape (..., 6), with values of the forms in `icc_types` in the last dimension:
+        `ICC`, `F`, `df1`, `df2` and `pval` of the F-test, and `lower` and `upper` bounds of the confidence interval.
+    """
+    ratings = np.asarray(ratings, dtype=float)
+    n, k = ratings.shape[-2:]
+    grand = ratings.mean(axis=(-2, -1), keepdims=True)
+    targets = ratings.mean(axis=-1, keepdims=True)
+    raters = ratings.mean(axis=-2, keepdims=True)
+
+    ssb = k * ((targets - grand) ** 2).sum(axis=(-2, -1))
+    ssj = n * ((raters - grand) ** 2).sum(axis=(-2, -1))
+    sse = ((ratings - targets - raters + grand) ** 2).sum(axis=(-2, -1))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        msb = ssb / (n - 1)
+        msj = ssj / (k - 1)
+        mse = sse / ((n - 1) * (k - 1))
+        msw = (ssj + sse) / (n * (k - 1))
+
+        icc1 = (msb - msw) / (msb + (k - 1) * msw)
+        icc2 = (msb - mse) / (msb + (k - 1) * mse + k * (msj - mse) / n)
+        icc3 = (msb - mse) / (msb + (k - 1) * mse)
+        icc1k = (msb - msw) / msb
+        icc2k = (msb - mse) / (msb + (msj - mse) / n)
+        icc3k = (msb - mse) / msb
+
+        # F-tests of the one-way (ICC1) and two-way (ICC2, ICC3) models
+        f1k = msb / msw
+        f3k = msb / mse
+        df1 = n - 1
+        df1kd = n * (k - 1)
+        df2kd = (n - 1) * (k - 1)
+        p1k = f.sf(f1k, df1, df1kd)
+        p3k = f.sf(f3k, df1, df2kd)
+
+        # confidence intervals of ICC1 and ICC3
+        alpha = 1 - confidence
+        f1l = f1k / f.ppf(1 - alpha / 2, df1, df1kd)
+        f1u = f1k * f.ppf(1 - alpha / 2, df1kd, df1)
+        f3l = f3k / f.ppf(1 - alpha / 2, df1, df2kd)
+        f3u = f3k * f.ppf(1 - alpha / 2, df2kd, df1)
+
+        # confidence interval of ICC2, with the approximate degrees of freedom v
+        fj = msj / mse
+        vn = df2kd * (k * icc2 * fj + n * (1 + (k - 1) * icc2) - k * icc2) ** 2
+        vd = df1 * k ** 2 * icc2 ** 2 * fj ** 2 + (n * (1 + (k - 1) * icc2) - k * icc2) ** 2
+        v = vn / vd
+        f2u = f.ppf(1 - alpha / 2, n - 1, v)
+        f2l = f.ppf(1 - alpha / 2, v, n - 1)
+        l2 = n * (msb - f2u * mse) / (f2u * (k * msj + (k * n - k - n) * mse) + n * msb)
+        u2 = n * (f2l * msb - mse) / (k * msj + (k * n - k - n) * mse + n * f2l * msb)
+
+        lower = [(f1l - 1) / (f1l + (k - 1)), l2, (f3l - 1) / (f3l + (k - 1)),
+                 1 - 1 / f1l, l2 * k / (1 + l2 * (k - 1)), 1 - 1 / f3l]
+        upper = [(f1u - 1) / (f1u + (k - 1)), u2, (f3u - 1) / (f3u + (k - 1)),
+                 1 - 1 / f1u, u2 * k / (1 + u2 * (k - 1)), 1 - 1 / f3u]
+
+    shape = msb.shape + (len(icc_types),)
+    return {
+        "ICC": np.stack([icc1, icc2, icc3, icc1k, icc2k, icc3k], axis=-1),
+        "F": np.stack([f1k, f3k, f3k, f1k, f3k, f3k], axis=-1),
+        "df1": np.full(shape, df1),
+        "df2": np.broadcast_to(np.array([df1kd, df2kd, df2kd, df1kd, df2kd, df2kd]), shape).copy(),
+        "pval": np.stack([p1k, p3k, p3k, p1k, p3k, p3k], axis=-1),
+        "lower": np.stack(lower, axis=-1),
+        "upper": np.stack(upper, axis=-1),
+    }
+
+
+def icc_table(statistics: Dict[str, np.ndarray], confidence: float = 0.95) -> pd.DataFrame:
+    """
+    Arranges intraclass correlations of one set of ratings in the same table as `pingouin.intraclass_corr`, with
+    confidence intervals rounded to two decimals.
+
+    :param statistics: Results of `intraclass_correlations` for a single set of ratings, i.e. arrays of shape (6,).
+    :param confidence: Confidence level of the intervals.
+    """
+    return pd.DataFrame({
+        "Type": list(icc_types),
+        "Description": list(icc_types.values()),
+        "ICC": statistics["ICC"],
+        "F": statistics["F"],
+        "df1": statistics["df1"],
+        "df2": statistics["df2"],
+        "pval": statistics["pval"],
+        f"CI{confidence:.0%}": list(np.round(np.stack([statistics["lower"], statistics["upper"]], axis=-1), 2)),
+    })
+
+
+def _lambda_4_exhaustive(cov: np.ndarray) -> float:
+    # the smallest s'Cs over all splits, for an even number of items the first item is kept in the second half, since
+    # swapping the halves gives the same split
+    n_items = len(cov)
+    items = range(1, n_items) if n_items % 2 == 0 else range(n_items)
+    splits = itertools.combinations(items, n_items // 2)
+
+    best = np.inf
+    while True:
+        batch = np.array(list(itertools.islice(splits, lambda_4_batch)), dtype=int).reshape(-1, n_items // 2)
+        if len(batch) == 0:
+            return best
+        signs = -np.ones((len(batch), n_items))
+        signs[np.arange(len(batch))[:, None], batch] = 1
+        best = min(best, ((signs @ cov) * signs).sum(axis=1).min())
+
+
+def _lambda_4_greedy_split(cov: np.ndarray) -> np.ndarray:
+    # items are placed one by one, starting with the items of the largest variance, in the half where they increase
+    # s'Cs the least, as long as the half is not full
+    n_items = len(cov)
+    capacity = {1: n_items // 2, -1: n_items - n_items // 2}
+    signs = np.zeros(n_items)
+    g = np.zeros(n_items)
+    for j in np.argsort(-np.diag(cov), kind="stable"):
+        sign = -1 if g[j] > 0 else 1
+        if capacity[sign] == 0:
+            sign = -sign
+        capacity[sign] -= 1
+        signs[j] = sign
+        g += sign * cov[:, j]
+    return signs
+
+
+def _lambda_4_local_search(cov: np.ndarray, signs: np.ndarray) -> float:
+    # swaps the pair of items from different halves that decreases s'Cs the most, until no swap decreases it
+    signs = signs.copy()
+    diagonal = np.diag(cov)
+    g = cov @ signs
+    form = signs @ g
+    tolerance = 1e-12 * max(np.abs(diagonal).sum(), np.finfo(float).tiny)
+    for _ in range(10 * len(cov)):
+        first, second = np.nonzero(signs > 0)[0], np.nonzero(signs < 0)[0]
+        change = 4 * (diagonal[first, None] + diagonal[None, second] - g[first, None] + g[None, second]
+                      - 2 * cov[np.ix_(first, second)])
+        if change.size == 0:
+            break
+        i, j = np.unravel_index(np.argmin(change), change.shape)
+        if change[i, j] >= -tolerance:
+            break
+        i, j = first[i], second[j]
+        signs[i], signs[j] = -1, 1
+        g += 2 * (cov[:, j] - cov[:, i])
+        form += change.min()
+    return form
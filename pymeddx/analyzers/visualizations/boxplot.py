@@ -1,39 +1,28 @@
-import pandas as pd
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
 
 from typing import Optional, Union, List
 from pathlib import Path
 
 from utils.logger import logger
-from utils.database import session, engine
-from model.response import ResponseType1
-from model.question import QuestionType1
-from model.image import Image
-from model.copeland_score import CopelandScores, CopelandScore
-
-from analyzers.metrics.diagnostic_score import DiagnosticScore
+from model.copeland_score import CopelandScores
+from model.score_summary import ScoreSummaries
 
 
 def boxplot_observers(qtype, output_dir, **kwargs):
-    query_map = {
-        1: session.query(ResponseType1.id, ResponseType1.observer_id, DiagnosticScore.value)
-            .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)
-            .statement
+    # precomputed score summaries (metric, level) of each questionnaire type
+    summary_map = {
+        1: ("dv", "observer")
         # TODO Add a maping for type 2
     }
 
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
+    # Fetch the summaries based on qtype or raise error if unsupported
+    summary = summary_map.get(qtype)
+    if summary is None:
         raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
-    # Load data from database
-    data = pd.read_sql(stmt, engine)
-    if qtype == 2:
-        data.rename(columns={'avg_1': 'value'}, inplace=True)
-
     boxplot(
-        data=data,
+        summaries=ScoreSummaries.get(*summary),
         by='observer_id',
         column='value',
         type='observers',
@@ -42,34 +31,23 @@ def boxplot_observers(qtype, output_dir, **kwargs):
     )
 
 
-def boxplot_datasets(qtype, output_dir, **kwargs):
-    query_map = {
-        1: session.query(ResponseType1.id, QuestionType1.id, Image.id, Image.dataset, DiagnosticScore.value)
-            .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)
-            .join(QuestionType1, ResponseType1.question_id == QuestionType1.id)
-            .join(Image, QuestionType1.image_id == Image.id)
-            .statement,
-        2: session.query(CopelandScore.id, CopelandScore.value, Image.model, Image.dataset)
-            .join(Image, CopelandScore.image_id == Image.id)
-            .where(Image.model != "")
-            .statement
+def boxplot_datasets(qtype, output_dir, run_id=CopelandScores.default_run, **kwargs):
+    summary_map = {
+        1: ("dv", "dataset", ScoreSummaries.default_run),
+        2: ("cs", "dataset", run_id)
     }
 
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
-        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
-
-    # Load data from database
-    data = pd.read_sql(stmt, engine)
+    # rankings (type 3) are scored in the same way as pairwise comparisons (type 2)
+    summary_map[3] = summary_map[2]
 
-    if qtype == 2:
-        data.rename(columns={'avg_1': 'value'}, inplace=True)
+    # Fetch the summaries based on qtype or raise error if unsupported
+    summary = summary_map.get(qtype)
+    if summary is None:
+        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
     boxplot(
-        data=data,
-        # by=['model', 'dataset'],
-        by=['dataset'],
+        summaries=ScoreSummaries.get(*summary),
+        by='dataset',
         column='value',
         type="datasets",
         output_dir=output_dir,
@@ -77,31 +55,26 @@ def boxplot_datasets(qtype, output_dir, **kwargs):
     )
 
 
-def boxplot_models(qtype, output_dir, **kwargs):
-    query_map = {
+def boxplot_models(qtype, output_dir, run_id=CopelandScores.default_run, **kwargs):
+    summary_map = {
         1: None,
-        2: session.query(CopelandScore.id, CopelandScore.value, Image.model, Image.dataset)
-            .join(Image, CopelandScore.image_id == Image.id)
-            .where(Image.model != "")
-            .statement
+        2: ("cs", "model", run_id)
     }
 
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
-        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
-
-    # Load data from database
-    data = pd.read_sql(stmt, engine)
+    # rankings (type 3) are scored in the same way as pairwise comparisons (type 2)
+    summary_map[3] = summary_map[2]
 
     if qtype == 1:
         logger.info(f"Boxplot model diagrams are unsupported for QType {qtype}.")
         return
-    elif qtype == 2:
-        data.rename(columns={'avg_1': 'value'}, inplace=True)
+
+    # Fetch the summaries based on qtype or raise error if unsupported
+    summary = summary_map.get(qtype)
+    if summary is None:
+        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
     boxplot(
-        data=data,
+        summaries=ScoreSummaries.get(*summary),
         by='model',
         column='value',
         type="models",
@@ -111,39 +84,59 @@ def boxplot_models(qtype, output_dir, **kwargs):
 
 
 def boxplot(
-        data: pd.DataFrame,
-        by: Union[List[str], str],
-        column: Union[List[str], str],
+        summaries: List,
+        by: str,
+        column: str,
         type: str,
         output_dir: Optional[Union[str, Path]] = None,
         **kwargs
 ):
     """
-    Create a boxplot for diagnostic scores across different observers.
+    Create a boxplot from precomputed score summaries, one box per summary.
 
-    :param qtype: Integer specifying the type of response to query (e.g., 1 for ResponseType1).
+    Quartiles are calculated from the score histograms stored in the summaries, and whiskers extend to the most
+    extreme scores within 1.5 interquartile ranges from the box, as in a boxplot drawn from the scores themselves.
+    Scores beyond the whiskers are drawn as outlier points, each distinct score repeated by its count.
+
+    :param summaries: A list of ScoreSummary objects.
+    :param by: Name of the grouping, used as the default x-axis label.
+    :param column: Name of the score, used as the default y-axis label.
+    :param type: A string identifier of the boxplot, used in naming the output file.
     :param output_dir: Path to the directory where the plot will be saved. If None, plot will be displayed.
-    :raises NotImplementedError: If qtype is unsupported.
     """
+    if len(summaries) == 0:
+        logger.error(f"Cannot plot the '{type}' boxplot because there are no score summaries. Calculate the metrics "
+                     f"first, then try plotting again.")
+        return
 
-    # Prepare the box plot
-    if isinstance(by, str):
-        by = [by]
-    if isinstance(column, str):
-        column = [column]
-
-    # Create box plot using Plotly Express
-    fig = px.box(
-        data_frame=data,
-        x=by[0] if by else None,
-        y=column[0],  # Assuming `column` contains a single value
-        title=kwargs.get('title', f'Box Plot of {column[0]}'),
-        labels={by[0]: kwargs.get('xlabel', by[0]), column[0]: kwargs.get('ylabel', column[0])}
-    )
-
-    # Set x-axis and y-axis labels
-    fig.update_xaxes(title_text=kwargs.get('xlabel', by[0] if by else ''))
-    fig.update_yaxes(title_text=kwargs.get('ylabel', column[0]))
+    boxes = {
+        "x": [], "y": [], "q1": [], "median": [], "q3": [], "lowerfence": [], "upperfence": [], "mean": [], "sd": []
+    }
+    for summary in summaries:
+        values, counts = summary.distribution()
+        q1, median, q3 = (summary.quantile(q) for q in (0.25, 0.5, 0.75))
+        iqr = q3 - q1
+        boxes["x"].append(summary.key)
+        boxes["q1"].append(q1)
+        boxes["median"].append(median)
+        boxes["q3"].append(q3)
+        lowerfence = values[values >= q1 - 1.5 * iqr].min()
+        upperfence = values[values <= q3 + 1.5 * iqr].max()
+        boxes["lowerfence"].append(lowerfence)
+        boxes["upperfence"].append(upperfence)
+        boxes["mean"].append(summary.mean)
+        boxes["sd"].append(np.sqrt(summary.variance))
+
+        # the histogram is exact, so the outliers are the same points a boxplot of the scores themselves would draw
+        outliers = (values < lowerfence) | (values > upperfence)
+        boxes["y"].append(np.repeat(values[outliers], counts[outliers]).tolist())
+
+    fig = go.Figure(go.Box(name=column, boxmean="sd", boxpoints="outliers", **boxes))
+    fig.update_layout(title=kwargs.get('title', f'Box Plot of {column}'))
+
+    # Set x-axis and y-axis labels, groups are shown as categories even if their keys are numeric
+    fig.update_xaxes(title_text=kwargs.get('xlabel', by), type="category")
+    fig.update_yaxes(title_text=kwargs.get('ylabel', column))
 
     # Optionally, add custom x-tick and y-tick labels
     xtick_labels = kwargs.get('xtick_labels')
@@ -5,30 +5,28 @@ from pathlib import Path
 import plotly.express as px
 
 from utils.logger import logger
-from utils.database import session, engine
-from model.response import ResponseType1
-from model.question import QuestionType1
-from model.image import Image
-from model.copeland_score import CopelandScore
-
-from analyzers.metrics.diagnostic_score import DiagnosticScore
+from model.copeland_score import CopelandScores
+from model.score_summary import ScoreSummaries
 
 
 def histogram(
-    stmt: str,
-    by: Union[List[str], str],
-    column: Union[List[str], str],
+    summaries: List,
+    by: Optional[str],
+    column: str,
     filename: str,
     output_dir: Optional[Union[str, Path]] = None,
     **kwargs
 ):
     """
-        Generates and displays or saves a histogram plot based on data retrieved from a database query.
+        Generates and displays or saves a histogram plot from precomputed score summaries.
+
+        Summaries store the number of occurrences of each distinct score, so the histogram has a bar for each distinct
+        score instead of a fixed number of bins.
 
-        :param stmt: The SQL statement as a string, used to query data from the database.
-        :param by: Column(s) to group data by for separate histograms for each unique group value. Can be a single
-                   string or a list of strings.
-        :param column: Column(s) to plot in the histogram. Assumes a single value within `column`.
+        :param summaries: A list of ScoreSummary objects.
+        :param by: Name of the grouping with a separate histogram for each summary. If `None`, counts of all summaries
+                   are added in a single histogram.
+        :param column: Name of the score, used as the default x-axis label.
         :param filename: A string identifier for the histogram type, used in naming the output file if saved.
         :param output_dir: Optional. Path to save the generated histogram as an HTML file. If `None`, the plot is
                            displayed directly instead.
@@ -41,31 +39,39 @@ def histogram(
 
         :return: None.
         """
+    if len(summaries) == 0:
+        logger.error(f"Cannot plot the '{filename}' histogram because there are no score summaries. Calculate the "
+                     f"metrics first, then try plotting again.")
+        return
 
-    # Load data from database
-    data = pd.read_sql(stmt, engine)
+    data = pd.concat([
+        pd.DataFrame({by or 'key': summary.key, column: values, 'count': counts})
+        for summary in summaries
+        for values, counts in [summary.distribution()]
+    ], ignore_index=True)
 
     # Plot histogram for all values in `column`
     if by is None:
-        fig = px.histogram(
+        data = data.groupby(column, as_index=False)['count'].sum()
+        fig = px.bar(
             data_frame=data,
-            x=column,  # Assuming `column` contains a single value; adjust as needed
-            nbins=len(range(-6, 7)),  # Number of bins corresponding to the range
-            title=kwargs.get('title', f'Histogram of {column[0]}'),
-            labels={column[0]: kwargs.get('xlabel', column[0]), column[1]: kwargs.get('ylabel', column[1])}
+            x=column,
+            y='count',
+            title=kwargs.get('title', f'Histogram of {column}'),
+            labels={column: kwargs.get('xlabel', column), 'count': kwargs.get('ylabel', 'count')}
         )
     else:
-        fig = px.histogram(
+        fig = px.bar(
             data_frame=data,
-            x=column,  # Assuming `column` contains a single value; adjust as needed
-            nbins=len(range(-6, 7)),  # Number of bins corresponding to the range
-            title=kwargs.get('title', f'Histogram of {column[0]}'),
-            labels={column[0]: kwargs.get('xlabel', column[0]), column[1]: kwargs.get('ylabel', column[1])},
+            x=column,
+            y='count',
+            title=kwargs.get('title', f'Histogram of {column}'),
+            labels={column: kwargs.get('xlabel', column), 'count': kwargs.get('ylabel', 'count')},
             facet_col=by
         )
 
     # Set x-axis and y-axis labels
-    fig.update_xaxes(title_text=kwargs.get('xlabel', column[0]))
+    fig.update_xaxes(title_text=kwargs.get('xlabel', column))
     fig.update_yaxes(title_text=kwargs.get('ylabel', 'Frequency'))
 
     # Optionally, add custom x-tick and y-tick labels
@@ -86,20 +92,19 @@ def histogram(
 
 
 def histogram_observers(qtype, output_dir, **kwargs):
-    query_map = {
-        1: session.query(ResponseType1.id, ResponseType1.observer_id, DiagnosticScore.value)
-            .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)
-            .statement
+    # precomputed score summaries (metric, level) of each questionnaire type
+    summary_map = {
+        1: ("dv", "observer")
         # TODO Add a maping for type 2
     }
 
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
+    # Fetch the summaries based on qtype or raise error if unsupported
+    summary = summary_map.get(qtype)
+    if summary is None:
         raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
     histogram(
-        stmt=stmt,
+        summaries=ScoreSummaries.get(*summary),
         by='observer_id',
         column='value',
         filename='observers',
@@ -108,33 +113,24 @@ def histogram_observers(qtype, output_dir, **kwargs):
     )
 
 
-def histogram_datasets(qtype, output_dir, **kwargs):
+def histogram_datasets(qtype, output_dir, run_id=CopelandScores.default_run, **kwargs):
 
-    query_map = {
-        1: session.query(ResponseType1.id, QuestionType1.id, Image.id, Image.dataset, DiagnosticScore.value)
-            .join(DiagnosticScore, DiagnosticScore.response_id == ResponseType1.id)
-            .join(QuestionType1, ResponseType1.question_id == QuestionType1.id)
-            .join(Image, QuestionType1.image_id == Image.id)
-            .statement,
-        2: session.query(CopelandScore.id, CopelandScore.value, Image.model, Image.dataset)
-            .join(Image, CopelandScore.image_id == Image.id)
-            .where(Image.model != "")
-            .statement
+    summary_map = {
+        1: ("dv", "dataset", ScoreSummaries.default_run),
+        2: ("cs", "dataset", run_id)
     }
 
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
-        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
+    # rankings (type 3) are scored in the same way as pairwise comparisons (type 2)
+    summary_map[3] = summary_map[2]
 
-    if qtype == 1:
-        by = 'dataset'
-    else:
-        by = 'dataset'
+    # Fetch the summaries based on qtype or raise error if unsupported
+    summary = summary_map.get(qtype)
+    if summary is None:
+        raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
     histogram(
-        stmt=stmt,
-        by=by,
+        summaries=ScoreSummaries.get(*summary),
+        by='dataset',
         column='value',
         filename='datasets',
         output_dir=output_dir,
@@ -142,25 +138,25 @@ def histogram_datasets(qtype, output_dir, **kwargs):
     )
 
 
-def histogram_models(qtype, output_dir, **kwargs):
-    query_map = {
+def histogram_models(qtype, output_dir, run_id=CopelandScores.default_run, **kwargs):
+    summary_map = {
         1: None,
-        2: session.query(CopelandScore.id, CopelandScore.value, Image.model, Image.dataset)
-            .join(Image, CopelandScore.image_id == Image.id)
-            .where(Image.model != "")
-            .statement
+        2: ("cs", "model", run_id)
     }
 
-    # Fetch the query based on qtype or raise error if unsupported
-    stmt = query_map.get(qtype)
-    if stmt is None:
+    # rankings (type 3) are scored in the same way as pairwise comparisons (type 2)
+    summary_map[3] = summary_map[2]
+
+    # Fetch the summaries based on qtype or raise error if unsupported
+    summary = summary_map.get(qtype)
+    if summary is None:
         raise NotImplementedError(f"Questionnaire type {qtype} is not supported")
 
     histogram(
-        stmt=stmt,
+        summaries=ScoreSummaries.get(*summary),
         by='model',
         column='value',
         filename='models',
         output_dir=output_dir,
         **kwargs
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import regex as re
+
+from bisect import bisect_right
+
+from model.image import Images
+
+
+class SurveyAssets:
+    """
+    A table of distinct images embedded in a single exported survey.
+
+    Base64 image payloads are moved out of the survey JSON and replaced with lightweight `asset://<key>` references.
+    In the lazy mode, the payloads are emitted separately, either as non-executable script blocks keyed by asset id
+    (html export) or as a sidecar file (json export), so that the survey object the browser has to parse stays small
+    regardless of the number of pages. Payloads are resolved in the browser only when a page that references them is
+    shown. Otherwise, the payloads are emitted once per survey in a table (`surveyAssets`) that is embedded into the
+    exported html.
+
+    Questions generated in the linked storage mode do not contain image payloads at all, but image placeholders
+    (see `placeholder`). Placeholders are resolved from the image store during export, either into inline payloads
+    (`resolve`) or into asset references (`extract`).
+    """
+
+    supported_image_loading = ["inline", "lazy"]
+
+    reference_prefix = "asset://"
+
+    # matches both cornerstone (base64://...) and data URI (data:image/png;base64,...) image payloads, the payload
+    # can be an image placeholder ({{image:<image id>}}) or base64 encoded image content
+    payload_re = re.compile(
+        r"(base64://|data:image/[a-zA-Z0-9+.-]+;base64,)(?:\{\{image:(\d+)\}\}|([A-Za-z0-9+/=]+))"
+    )
+    placeholder_re = re.compile(r"\{\{image:(\d+)\}\}")
+
+    # matches the beginning of each survey page in a minified survey json
+    page_re = re.compile(r"name:\s*\"page-")
+
+    def __init__(self, lazy=False):
+        self.lazy = lazy
+        self.assets = dict()        # asset key -> base64 payload
+        self.first_page = dict()    # asset key -> index of the first page that references the asset
+
+    def __len__(self):
+        return len(self.assets)
+
+    @staticmethod
+    def placeholder(image):
+        """
+        A placeholder that is stored in question json instead of the base64 encoded image content when questions are
+        generated in the linked storage mode.
+        """
+        return f"{{{{image:{image.id}}}}}"
+
+    @staticmethod
+    def resolve(survey_json):
+        """
+        Replace every image placeholder in a survey json with base64 encoded content of the image from the image
+        store.
+
+        :param survey_json: Survey json string as stored in the database.
+        :return: Survey json string with inlined images.
+        """
+        if "{{image:" not in survey_json:   # questions are generated with inlined images
+            return survey_json
+        payloads = SurveyAssets._load_payloads(survey_json)
+        return SurveyAssets.placeholder_re.sub(lambda m: payloads[int(m.group(1))], survey_json)
+
+    def extract(self, survey_json):
+        """
+        Replace every base64 image payload or image placeholder in a survey json with a reference to the asset table.
+        Identical payloads are stored only once.
+
+        :param survey_json: Survey json string as stored in the database.
+        :return: Survey json string where image payloads are replaced with `asset://<key>` references.
+        """
+        page_starts = [m.start() for m in SurveyAssets.page_re.finditer(survey_json)]
+        payloads = SurveyAssets._load_payloads(survey_json) if "{{image:" in survey_json else dict()
+
+        def _replace(match):
+            if match.group(2) is not None:
+                image_id = int(match.group(2))
+                key = f"im{image_id}"
+                payload = payloads[image_id]
+            else:
+                payload = match.group(3)
+                key = hashlib.sha1(payload.encode("ascii")).hexdigest()[:16]
+            if key not in self.assets:
+                self.assets[key] = payload
+                self.first_page[key] = bisect_right(page_starts, match.start())
+            return SurveyAssets.reference_prefix + key
+
+        return SurveyAssets.payload_re.sub(_replace, survey_json)
+
+    @staticmethod
+    def _load_payloads(survey_json):
+        # encode each image referenced by a placeholder only once
+        image_ids = {int(image_id) for image_id in SurveyAssets.placeholder_re.findall(survey_json)}
+        return {image.id: image.encode_to_base64() for image in Images.get_by_ids(image_ids)}
+
+    def table_js(self):
+        """
+        JS declaration of the survey asset table. The table holds cornerstone compatible image ids of all assets if
+        assets are not loaded lazily, otherwise it is empty and it is populated as the assets are resolved.
+        """
+        if self.lazy:
+            return "var surveyAssets = {};"
+        return f"var surveyAssets = {self.to_json()};"
+
+    def head_script_blocks(self):
+        """
+        Script blocks for assets referenced by the first page. These should be placed before the survey is
+        initialized so that the first question can be shown without waiting for the rest of the document.
+        """
+        if not self.lazy or len(self.first_page) == 0:
+            return ""
+        first = min(self.first_page.values())
+        return SurveyAssets._script_blocks(
+            (key, payload) for key, payload in self.assets.items() if self.first_page[key] == first
+        )
+
+    def tail_script_blocks(self):
+        """
+        Script blocks for assets referenced by all the pages except the first one. These should be placed at the
+        end of the document body.
+        """
+        if not self.lazy or len(self.first_page) == 0:
+            return ""
+        first = min(self.first_page.values())
+        return SurveyAssets._script_blocks(
+            (key, payload) for key, payload in self.assets.items() if self.first_page[key] != first
+        )
+
+    def to_json(self):
+        """
+        Serialize the asset table as a json object mapping asset keys to cornerstone compatible image ids.
+        """
+        return json.dumps({key: "base64://" + payload for key, payload in self.assets.items()})
+
+    @staticmethod
+    def _script_blocks(assets):
+        # script blocks of an unknown type are not executed nor parsed by the browser, their content is read on demand
+        return "\n".join(
+            f"<script type=\"text/plain\" id=\"asset-{key}\">{payload}</script>" for key, payload in assets
+        )
+
+    @staticmethod
+    def loader_js():
+        """
+        JS functions used to resolve asset references in an exported survey and to prefetch the assets of the next
+        survey page. The functions expect the asset table (see `table_js`) to be declared.
+        """
+        return """
+      // Returns cornerstone image id for an asset reference, the link itself if it is not an asset reference,
+      // or null if the asset block is not parsed yet.
+      function resolveAsset(link) {
+        if (typeof link !== "string" || link.indexOf("asset://") !== 0) return link;
+        let key = link.substring("asset://".length);
+        if (!(key in surveyAssets)) {
+          let block = document.getElementById("asset-" + key);
+          if (!block) return null;
+          surveyAssets[key] = "base64://" + block.textContent;
+          // the payload is cached, so the block text is not needed anymore
+          block.parentNode.removeChild(block);
+        }
+        return surveyAssets[key];
+      }
+
+      // Calls the callback with resolved asset as soon as the asset block is available.
+      function withAsset(link, callback) {
+        let resolved = resolveAsset(link);
+        if (resolved !== null) {
+          callback(resolved);
+        } else {
+          document.addEventListener("DOMContentLoaded", function () {
+            callback(resolveAsset(link));
+          });
+        }
+      }
+
+      // Resolve assets of the page that follows the current one while the observer is answering.
+      function prefetchNextPageAssets(sender) {
+        let next = sender.visiblePages[sender.currentPageNo + 1];
+        if (!next) return;
+        setTimeout(function () {
+          let links = JSON.stringify(next.toJSON()).match(/asset:\\/\\/[0-9a-z]+/g) || [];
+          links.forEach(function (link) {
+            resolveAsset(link);
+          });
+        }, 0);
+      }
+"""
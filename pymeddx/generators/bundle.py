@@ -0,0 +1,113 @@
+import io
+import json
+import tarfile
+import time
+import zipfile
+
+from pathlib import Path
+
+from utils.logger import logger
+
+
+class SurveyBundle:
+    """
+    A single file that holds many exported surveys.
+
+    Exported survey files are streamed into the bundle one by one as they are rendered, so the bundle is written
+    sequentially and no temporary files are created. Supported bundle formats are:
+     - `zip` - deflate compressed zip archive,
+     - `tar.gz` - gzip compressed tar archive written as a stream,
+     - `ndjson` - newline delimited json, one `{"name": ..., "content": ...}` record per exported file. The last line
+       is an index `{"index": [{"name": ..., "offset": ..., "length": ...}, ...]}` with byte offsets and lengths of
+       all records, so a single file can be read without parsing the whole stream.
+    """
+
+    supported_formats = ["zip", "tar.gz", "ndjson"]
+
+    def __init__(self, path, bundle_format):
+        if bundle_format not in SurveyBundle.supported_formats:
+            logger.error(f"Unsupported bundle format '{bundle_format}'. Supported formats are "
+                         f"{SurveyBundle.supported_formats}")
+            raise ValueError(f"Unsupported bundle format '{bundle_format}'. Supported formats are "
+                             f"{SurveyBundle.supported_formats}")
+        self.path = Path(path)
+        self.bundle_format = bundle_format
+        self.index = list()
+        self._offset = 0
+        if bundle_format == "zip":
+            self._archive = zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_DEFLATED)
+        elif bundle_format == "tar.gz":
+            self._archive = tarfile.open(str(self.path), "w|gz")
+        else:
+            self._archive = open(self.path, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def filename(name, bundle_format):
+        return f"{name}.{bundle_format}"
+
+    def write(self, filename, content):
+        """
+        Append an exported file to the bundle.
+
+        :param filename: Name of the exported file within the bundle.
+        :param content: Content of the exported file.
+        """
+        data = content.encode("utf8")
+        if self.bundle_format == "zip":
+            self._archive.writestr(filename, data)
+        elif self.bundle_format == "tar.gz":
+            info = tarfile.TarInfo(name=filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._archive.addfile(info, io.BytesIO(data))
+        else:
+            record = (json.dumps({"name": filename, "content": content}) + "\n").encode("utf8")
+            self._archive.write(record)
+            self.index.append({"name": filename, "offset": self._offset, "length": len(record)})
+            self._offset += len(record)
+
+    def close(self):
+        if self.bundle_format == "ndjson":
+            self._archive.write((json.dumps({"index": self.index}) + "\n").encode("utf8"))
+        self._archive.close()
+
+    @staticmethod
+    def export(where, name, files, bundle_format, observers=None):
+        """
+        Stream exported files into one bundle. If observers are given, a small manifest is written next to the bundle
+        for each observer, naming the bundle and the surveys in it. Surveys are not assigned to observers, so every
+        observer gets the same surveys and they are written only once, to the shared bundle.
+
+        :param where: Directory to save the bundle and manifests to.
+        :param name: Bundle name without the extension.
+        :param files: An iterable of (filename, content) pairs.
+        :param bundle_format: Bundle format, see `supported_formats`.
+        :param observers: A list of observers. If given, a manifest `observer-<id>-<name>.manifest.json` is created for
+            each observer.
+        :return: A list of paths of the created bundle and manifests.
+        """
+        bundle_path = Path(where) / SurveyBundle.filename(name, bundle_format)
+        filenames = list()
+        with SurveyBundle(bundle_path, bundle_format) as bundle:
+            for filename, content in files:
+                bundle.write(filename, content)
+                filenames.append(filename)
+                logger.info(f"Survey {filename} added to the bundle!")
+        logger.info(f"Survey bundle {bundle_path} saved!")
+
+        paths = [bundle_path]
+        for observer in observers or []:
+            manifest_path = Path(where) / f"observer-{observer.id}-{name}.manifest.json"
+            with open(manifest_path, "w", encoding="utf8") as fout:
+                json.dump({"observer_id": observer.id, "observer": observer.name, "bundle": bundle_path.name,
+                           "surveys": filenames}, fout, indent=2)
+            paths.append(manifest_path)
+        if observers:
+            logger.info(f"Saved manifests of the bundle {bundle_path} for {len(observers)} observers!")
+        return paths
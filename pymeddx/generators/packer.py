@@ -0,0 +1,150 @@
+from model.question import QuestionType1, QuestionType2, QuestionType3
+from utils.logger import logger
+from utils.tools import load_js
+
+
+class SurveyPacker:
+    """
+    Splits questions into surveys so that each exported survey stays within a page budget and/or a byte budget.
+
+    The size of an exported survey is estimated from the probed sizes of the image files, for the export type the
+    surveys are meant for. Html export, as well as json export with lazily loaded images, stores images shared by
+    several questions only once, so each distinct image is counted once per survey, and each html survey carries the
+    image viewer and the html template. Json export with inline images embeds the images into the json of every
+    question, so each image is counted once per question that shows it. On top of the images, each question carries
+    its own json.
+    """
+
+    # export types the size of a survey can be estimated for
+    supported_export_types = ["html", "json"]
+
+    # html template, survey settings and asset loading code that are exported with every survey
+    template_overhead = 16 * 1024
+
+    def __init__(self, max_pages=None, max_bytes=None, export_type="html"):
+        if max_pages is not None and max_pages <= 0:
+            logger.error(f"Maximum number of pages per survey must be positive, but it is {max_pages}.")
+            raise ValueError(f"Maximum number of pages per survey must be positive, but it is {max_pages}.")
+        if export_type not in SurveyPacker.supported_export_types:
+            logger.error(f"Cannot estimate survey size for export type '{export_type}'. Supported types are "
+                         f"{SurveyPacker.supported_export_types}.")
+            raise ValueError(f"Cannot estimate survey size for export type '{export_type}'. Supported types are "
+                             f"{SurveyPacker.supported_export_types}.")
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.export_type = export_type
+        self.survey_overhead = 0
+        if max_bytes is not None:
+            self.survey_overhead = SurveyPacker.template_overhead
+            if export_type == "html":
+                self.survey_overhead += len(load_js())
+            if max_bytes <= self.survey_overhead:
+                logger.error(f"Maximum survey size of {max_bytes} bytes is too small. Each survey requires at least "
+                             f"{self.survey_overhead} bytes for the image viewer and the survey template.")
+                raise ValueError(f"Maximum survey size of {max_bytes} bytes is too small. Each survey requires at "
+                                 f"least {self.survey_overhead} bytes for the image viewer and the survey template.")
+        self._encoded_sizes = dict()
+
+    def pack_first_fit(self, questions):
+        """
+        Pack questions into surveys using the first-fit bin packing. Each question is added to the first survey it fits
+        in, so the relative order of the questions is preserved within each survey. If questions are shuffled before
+        packing, survey content is shuffled as well.
+
+        :param questions: A list of questions.
+        :return: A list of surveys, where each survey is a list of questions.
+        """
+        bins = list()
+        for question in questions:
+            for survey_bin in bins:
+                if self._fits(survey_bin, question):
+                    self._add(survey_bin, question)
+                    break
+            else:
+                survey_bin = self._new_bin()
+                if not self._fits(survey_bin, question):
+                    self._warn_oversized(question)
+                self._add(survey_bin, question)
+                bins.append(survey_bin)
+        return [survey_bin["questions"] for survey_bin in bins]
+
+    def pack_contiguous(self, units):
+        """
+        Split a sequence of question units into contiguous surveys. A unit is a list of questions that must end up in
+        the same survey, e.g. a question and its redundant copies. Units are never split.
+
+        :param units: A list of question units, where each unit is a list of questions.
+        :return: A list of surveys, where each survey is a list of questions.
+        """
+        bins = list()
+        survey_bin = self._new_bin()
+        for unit in units:
+            if len(survey_bin["questions"]) != 0 and not self._fits(survey_bin, *unit):
+                bins.append(survey_bin)
+                survey_bin = self._new_bin()
+            if len(survey_bin["questions"]) == 0 and not self._fits(survey_bin, *unit):
+                self._warn_oversized(*unit)
+            self._add(survey_bin, *unit)
+        if len(survey_bin["questions"]) != 0:
+            bins.append(survey_bin)
+        return [survey_bin["questions"] for survey_bin in bins]
+
+    def _new_bin(self):
+        return {"questions": list(), "images": set(), "size": self.survey_overhead}
+
+    def _fits(self, survey_bin, *questions):
+        if self.max_pages is not None and len(survey_bin["questions"]) + len(questions) > self.max_pages:
+            return False
+        if self.max_bytes is not None and self._size_after(survey_bin, *questions) > self.max_bytes:
+            return False
+        return True
+
+    def _add(self, survey_bin, *questions):
+        survey_bin["size"] = self._size_after(survey_bin, *questions)
+        for question in questions:
+            survey_bin["questions"].append(question)
+            survey_bin["images"].update(image.id for image in SurveyPacker._images(question))
+
+    def _size_after(self, survey_bin, *questions):
+        if self.max_bytes is None:
+            return survey_bin["size"]
+        size = survey_bin["size"]
+        images = set(survey_bin["images"])
+        for question in questions:
+            size += self._question_overhead(question)
+            for image in SurveyPacker._images(question):
+                if self.export_type == "json":
+                    # inline json export embeds images into each question
+                    size += self._encoded_size(image)
+                elif image.id not in images:
+                    images.add(image.id)
+                    size += self._encoded_size(image)
+        return size
+
+    def _encoded_size(self, image):
+        # size of base64 encoded image file
+        if image.id not in self._encoded_sizes:
+            self._encoded_sizes[image.id] = 4 * ((image.fullpath.stat().st_size + 2) // 3)
+        return self._encoded_sizes[image.id]
+
+    def _question_overhead(self, question):
+        # question json without embedded images, the json stores placeholders instead of images if questions are
+        # generated in the linked storage mode
+        if question.json is None or "{{image:" in question.json:
+            return 0 if question.json is None else len(question.json)
+        return max(len(question.json) - sum(self._encoded_size(image) for image in SurveyPacker._images(question)), 0)
+
+    def _warn_oversized(self, *questions):
+        logger.warning(f"Questions {[question.id for question in questions]} exceed the survey budget on their own "
+                       f"(at most {self.max_pages} pages, {self.max_bytes} bytes). They are placed in a separate "
+                       f"survey.")
+
+    @staticmethod
+    def _images(question):
+        if isinstance(question, QuestionType1):
+            return [question.image]
+        elif isinstance(question, QuestionType2):
+            return [question.im0, question.im1, question.im2]
+        elif isinstance(question, QuestionType3):
+            return [question.im0] + list(question.candidates)
+        return []
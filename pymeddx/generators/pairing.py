@@ -0,0 +1,256 @@
+import random
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from analyzers.metrics.copeland_score import load_comparisons
+from analyzers.metrics.ranking import bradley_terry
+from model.image import Images
+from model.question import QuestionType2
+from model.response import ResponseType2
+from utils.database import session
+from utils.logger import logger
+from utils.tools import fisher_yates_shuffle
+
+
+supported_designs = ["full", "adaptive", "cyclic", "balanced", "random"]
+
+# incomplete designs that are generated up front, each image is compared with a fixed number of other images
+static_designs = ["cyclic", "balanced", "random"]
+
+
+def adaptive_pairs():
+    """
+    Selects the next round of image pairs to be compared for each image group, using responses imported so far.
+
+    Pairs are selected like in a Swiss tournament. In the first round images of a group are paired at random. In each
+    following round images are sorted by their Bradley-Terry strength estimated from the responses so far, and each
+    image is paired with the closest ranked image it has not been compared with yet, so each round asks at most n/2
+    questions for a group of n images. A group is resolved once every two adjacent images in its current ranking have
+    been compared, which typically happens after O(log n) rounds, i.e. after O(n log n) comparisons instead of n(n-1)/2
+    for a full round robin.
+
+    Groups with pending questions, i.e. questions that are not answered yet, are skipped until the responses are
+    imported, since the next round depends on them.
+
+    :return: A dictionary mapping group id to a list of image pairs to generate questions for. Groups without new pairs
+        are omitted.
+    """
+    min_group_id, max_group_id = Images.get_min_image_group(), Images.get_max_image_group()
+    if min_group_id is None:
+        return dict()
+
+    comparisons = load_comparisons()
+    pairs = dict()
+    for gid in range(min_group_id, max_group_id + 1):
+        images = Images.get_whole_group(gid)
+        if images is None:
+            continue
+
+        asked, n_pending = _asked_pairs(gid)
+        if n_pending != 0:
+            logger.info(f"Group {gid} has {n_pending} pending questions. Import their responses before generating the "
+                        f"next round of questions for the group.")
+            continue
+
+        scores = _group_scores(images, comparisons[comparisons["group_id"] == gid])
+        round_pairs = _swiss_round(images, scores, asked)
+        if len(round_pairs) == 0:
+            logger.info(f"Ranking of group {gid} is resolved after {len(asked)} compared pairs.")
+            continue
+        logger.info(f"Selected {len(round_pairs)} pairs in group {gid} ({len(asked)} pairs compared so far).")
+        pairs[gid] = round_pairs
+    return pairs
+
+
+def _asked_pairs(gid):
+    # pairs of images that already have a question, and number of questions without responses
+    questions = session.query(QuestionType2).where(
+        QuestionType2.group == gid,
+        QuestionType2.is_redundant == False
+    ).all()
+    answered = {
+        question_id for question_id, in session.query(ResponseType2.question_id).join(
+            QuestionType2, QuestionType2.id == ResponseType2.question_id
+        ).where(
+            QuestionType2.group == gid
+        ).distinct()
+    }
+    asked = {frozenset((q.im1_id, q.im2_id)) for q in questions}
+    n_pending = sum(1 for q in questions if q.id not in answered)
+    return asked, n_pending
+
+
+def _group_scores(images, comparisons):
+    # Bradley-Terry log-strengths of group images, all images have equal strength before the first responses
+    position = {image.id: i for i, image in enumerate(images)}
+    img1_won = (comparisons["choice"] == comparisons["img1_id"]).to_numpy()
+    img2_won = (comparisons["choice"] == comparisons["img2_id"]).to_numpy()
+    i = comparisons["img1_id"].map(position).to_numpy()
+    j = comparisons["img2_id"].map(position).to_numpy()
+    winners = np.concatenate([i[img1_won], j[img2_won]]).astype(int)
+    losers = np.concatenate([j[img1_won], i[img2_won]]).astype(int)
+    wins = sparse.coo_matrix(
+        (np.ones(len(winners)), (winners, losers)), shape=(len(images), len(images))
+    ).tocsr()
+    scores, _ = bradley_terry(wins)
+    return scores
+
+
+def _swiss_round(images, scores, asked):
+    if len(asked) == 0:
+        order = fisher_yates_shuffle(list(images))
+    else:
+        order = [images[i] for i in np.lexsort(([image.id for image in images], -scores))]
+        adjacent = [frozenset((a.id, b.id)) for a, b in zip(order[:-1], order[1:])]
+        if all(pair in asked for pair in adjacent):
+            return []
+
+    # pair each image with the closest ranked unpaired image it has not been compared with yet
+    round_pairs = list()
+    unpaired = list(order)
+    while len(unpaired) > 1:
+        first = unpaired.pop(0)
+        for k, second in enumerate(unpaired):
+            if frozenset((first.id, second.id)) not in asked:
+                round_pairs.append((first, second))
+                unpaired.pop(k)
+                break
+    return round_pairs
+
+
+def static_pairs(design, degree, max_attempts=1000):
+    """
+    Selects image pairs of each image group using an incomplete comparison design, in which each image is compared with
+    `degree` other images from its group instead of all of them. Supported designs are:
+     - `cyclic` - images are placed on a circle in random order and each image is compared with its `degree` nearest
+       neighbours,
+     - `balanced` - like `cyclic`, but the distances between compared images on the circle are spread evenly, so each
+       image is compared with both close and distant images (a balanced circulant design),
+     - `random` - a random regular comparison graph.
+
+    Each design is checked up front, so that every image is compared exactly `degree` times, no pair is compared twice
+    and all images of a group are connected by comparisons. Otherwise, rankings of the images would not be comparable.
+
+    :param design: One of `static_designs`.
+    :param degree: Number of images each image is compared with.
+    :param max_attempts: Maximum number of attempts to generate a connected random regular graph.
+    :return: A dictionary mapping group id to a list of image pairs.
+    """
+    if design not in static_designs:
+        logger.error(f"Unsupported comparison design '{design}'. Supported designs are {static_designs}.")
+        raise ValueError(f"Unsupported comparison design '{design}'. Supported designs are {static_designs}.")
+    if degree is None or degree < 1:
+        logger.error(f"Comparison design '{design}' requires a positive degree, but it is {degree}.")
+        raise ValueError(f"Comparison design '{design}' requires a positive degree, but it is {degree}.")
+
+    min_group_id, max_group_id = Images.get_min_image_group(), Images.get_max_image_group()
+    if min_group_id is None:
+        return dict()
+
+    pairs = dict()
+    for gid in range(min_group_id, max_group_id + 1):
+        images = Images.get_whole_group(gid)
+        if images is None:
+            continue
+        n = len(images)
+        if degree >= n - 1:
+            logger.warning(f"Group {gid} has {n} images, so each image is compared with all other images.")
+            pairs[gid] = [(images[i], images[j]) for i in range(n) for j in range(i + 1, n)]
+            continue
+        if n * degree % 2 != 0:
+            logger.error(f"Cannot compare each of {n} images in group {gid} with {degree} other images, since the "
+                         f"number of images or the degree must be even.")
+            raise ValueError(f"Cannot compare each of {n} images in group {gid} with {degree} other images, since "
+                             f"the number of images or the degree must be even.")
+
+        order = fisher_yates_shuffle(list(images))
+        if design == "random":
+            for _ in range(max_attempts):
+                edges = _random_regular_edges(n, degree)
+                if edges is not None and _is_connected(n, edges):
+                    break
+            else:
+                logger.error(f"Could not generate a connected random comparison graph for group {gid} in "
+                             f"{max_attempts} attempts. Try a different degree.")
+                raise ValueError(f"Could not generate a connected random comparison graph for group {gid} in "
+                                 f"{max_attempts} attempts. Try a different degree.")
+        else:
+            edges = _circulant_edges(n, _circulant_offsets(design, n, degree))
+
+        _check_design(gid, n, edges, degree)
+        pairs[gid] = [(order[i], order[j]) for i, j in edges]
+        logger.info(f"Selected {len(edges)} pairs in group {gid} using the '{design}' design with degree {degree}.")
+    return pairs
+
+
+def _circulant_offsets(design, n, degree):
+    # distances on the circle, each distance below n/2 adds two comparisons per image, distance n/2 adds one
+    available = list(range(1, (n + 1) // 2))
+    m = degree // 2
+    if design == "cyclic":
+        offsets = available[:m]
+    else:
+        offsets = [available[i] for i in np.round(np.linspace(0, len(available) - 1, m)).astype(int)] if m != 0 else []
+    if degree % 2 == 1:
+        offsets.append(n // 2)
+    return offsets
+
+
+def _circulant_edges(n, offsets):
+    edges = list()
+    for d in offsets:
+        for i in range(n if 2 * d != n else n // 2):
+            edges.append((i, (i + d) % n))
+    return edges
+
+
+def _random_regular_edges(n, degree):
+    # dense graphs are generated as complements of sparse ones
+    if degree > (n - 1) / 2:
+        sparse_edges = _random_regular_edges(n, n - 1 - degree)
+        if sparse_edges is None:
+            return None
+        sparse_edges = set(sparse_edges)
+        return [(i, j) for i in range(n) for j in range(i + 1, n) if (i, j) not in sparse_edges]
+
+    # stubs are paired at random, skipping pairs that would create a loop or a repeated pair, and the attempt is
+    # abandoned if no suitable pair is found
+    stubs = [i for i in range(n) for _ in range(degree)]
+    edges = set()
+    while len(stubs) != 0:
+        for _ in range(100):
+            i, j = random.sample(range(len(stubs)), 2)
+            edge = (min(stubs[i], stubs[j]), max(stubs[i], stubs[j]))
+            if stubs[i] != stubs[j] and edge not in edges:
+                break
+        else:
+            return None
+        edges.add(edge)
+        for k in sorted((i, j), reverse=True):
+            stubs.pop(k)
+    return sorted(edges)
+
+
+def _is_connected(n, edges):
+    rows, cols = zip(*edges) if len(edges) != 0 else ((), ())
+    graph = sparse.coo_matrix((np.ones(len(edges)), (rows, cols)), shape=(n, n))
+    n_components, _ = connected_components(graph, directed=False)
+    return n_components == 1
+
+
+def _check_design(gid, n, edges, degree):
+    # coverage: each image is compared with exactly `degree` distinct images, connectivity: rankings are comparable
+    pairs = {frozenset(edge) for edge in edges}
+    degrees = np.bincount(np.asarray(edges).ravel(), minlength=n)
+    if len(pairs) != len(edges) or any(len(pair) != 2 for pair in pairs) or not np.all(degrees == degree):
+        logger.error(f"Comparison design of group {gid} does not compare each image with exactly {degree} other "
+                     f"images.")
+        raise ValueError(f"Comparison design of group {gid} does not compare each image with exactly {degree} "
+                         f"other images.")
+    if not _is_connected(n, edges):
+        logger.error(f"Comparison design of group {gid} is not connected, so rankings of its images would not be "
+                     f"comparable.")
+        raise ValueError(f"Comparison design of group {gid} is not connected, so rankings of its images would not "
+                         f"be comparable.")
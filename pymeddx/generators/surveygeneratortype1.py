@@ -8,57 +8,66 @@ from string import Template
 
 from model.survey import *
 from model.question import *
+from model.observer import Observers
 from utils.database import session
 from utils.logger import logger
 from utils.tools import fisher_yates_shuffle, load_js
+from generators.assets import SurveyAssets
+from generators.bundle import SurveyBundle
+from generators.packer import SurveyPacker
 
 
 class SurveyGenerator:
 
     supported_export_types = ["html", "json"]
 
-    def __init__(self, questions_per_survey, survey_type):
+    def __init__(self, questions_per_survey, survey_type, max_bytes=None, size_export_type="html"):
         self.questions_per_survey = questions_per_survey
 
         if survey_type not in Survey.valid_types:
             logger.error(f"Survey type can be in {Survey.valid_types} but you require {survey_type}.")
             raise ValueError(f"Survey type can be in {Survey.valid_types} but you require {survey_type}.")
         self.survey_type = survey_type
+        self.packer = SurveyPacker(max_pages=questions_per_survey, max_bytes=max_bytes, export_type=size_export_type)
 
     def generate_all(self, n_surveys=None):
         """
         Generates surveys and saves them to the database.
 
-        Surveys are generated by selecting `questions_per_survey` questions from database using Fisher-Yates shuffling
-        algorithm. If `survey_type` is set to `regular` candidate questions are those unassigned to any previously
-        generated survey. Otherwise, if `survey_type` is set to `control`, candidate questions are picked from those
-        questions already assigned to existing regular surveys.
+        Candidate questions are shuffled using Fisher-Yates shuffling algorithm and packed into surveys of at most
+        `questions_per_survey` questions using first-fit bin packing. If `max_bytes` is set, a question is added to a
+        survey only if the estimated size of the exported survey stays within the budget, so surveys with large images
+        may contain fewer questions. If `survey_type` is set to `regular` candidate questions are those unassigned to
+        any previously generated survey. Otherwise, if `survey_type` is set to `control`, candidate questions are
+        picked from those questions already assigned to existing regular surveys.
 
         :param n_surveys: Maximum number of survey that should be generated. If the requested number is larger then
             a possible number of surveys that can be generated, the method generate as many surveys as it can.
         :return:
         """
         n_original, n_repeated = 0, 0
-        while True:     # iterate while there are more questions to include in some of the surveys
+        if self.survey_type == "regular":
+            questions = Questions.get_unassigned()
+        else:
+            questions = Questions.get_in_regular_survey()
+
+        if len(questions) == 0:     # all questions are already added to the survey
+            logger.info(f"There are no more unassigned questions satisfying the criteria for '{self.survey_type}' "
+                        f"in the database. Finishing.")
+
+        # packing keeps the relative order of questions, so the content of each survey is shuffled as well
+        shuffled_questions = fisher_yates_shuffle(questions)
+        for survey_questions in self.packer.pack_first_fit(shuffled_questions):
             if self.survey_type == "regular":
-                questions = Questions.get_unassigned()
                 survey = RegularSurvey(auth_page=False)
             else:
-                questions = Questions.get_in_regular_survey()
                 survey = ControlSurvey(auth_page=False)
 
-            if len(questions) == 0:     # all questions are already added to the survey
-                logger.info(f"There are no more unassigned questions satisfying the criteria for '{self.survey_type}' "
-                            f"in the database. Finishing.")
-                break
-
             # save a survey to database so that it is assigned valid id
             session.add(survey)
             session.commit()
-            shuffled_questions = fisher_yates_shuffle(questions)
 
-            for i in range(0, min(self.questions_per_survey, len(shuffled_questions))):
-                question = shuffled_questions[i]
+            for question in survey_questions:
                 survey.questions.append(question)
                 logger.info(f"Added question {question.id} to survey {survey.id}.")
 
@@ -101,7 +110,6 @@ class SurveyGenerator:
         else:
             logger.info("")
             logger.info("*" * 100)
-            ssize_intra = len(questions)
             logger.info(
                 f"Expected sample size for intra-observer agreement methods is {ssize_intra} (per observer).")
             logger.info(
@@ -114,12 +122,21 @@ class SurveyGenerator:
             logger.info("*" * 100)
 
     @staticmethod
-    def export_surveys(where, export_type="json", survey_type="regular"):
+    def export_surveys(where, export_type="json", survey_type="regular", image_loading="inline", bundle=None,
+                       per_observer=False):
         """
 
         :param where:
         :param export_type:
         :param survey_type:
+        :param image_loading: How images are embedded into exported surveys. If `inline`, images are part of the
+            survey json. If `lazy`, survey json contains only references to images and image payloads are exported
+            separately (script blocks for html export, sidecar `.assets.json` file for json export) and loaded only
+            when a survey page is shown.
+        :param bundle: If set, all exported files are streamed into a single bundle file of the given format (see
+            `SurveyBundle.supported_formats`) instead of being saved one by one.
+        :param per_observer: If set, a manifest of the bundle is created for each observer in the database. Surveys
+            are not assigned to observers, so all observers share the same bundle, see `SurveyBundle.export`.
         :return:
         """
         # check if directory to export to is ok
@@ -138,22 +155,66 @@ class SurveyGenerator:
             raise ValueError(f"Cannot export survey to '{export_type}'. Supported types are "
                              f"{SurveyGenerator.supported_export_types}")
 
-        # load image viewer js content
-        image_viewer_js = load_js()
+        # check if image loading mode is valid
+        if image_loading not in SurveyAssets.supported_image_loading:
+            logger.error(f"Unsupported image loading mode '{image_loading}'. Supported modes are "
+                         f"{SurveyAssets.supported_image_loading}")
+            raise ValueError(f"Unsupported image loading mode '{image_loading}'. Supported modes are "
+                             f"{SurveyAssets.supported_image_loading}")
+
+        # check if bundle format is valid
+        if bundle is not None and bundle not in SurveyBundle.supported_formats:
+            logger.error(f"Unsupported bundle format '{bundle}'. Supported formats are "
+                         f"{SurveyBundle.supported_formats}")
+            raise ValueError(f"Unsupported bundle format '{bundle}'. Supported formats are "
+                             f"{SurveyBundle.supported_formats}")
+        if per_observer and bundle is None:
+            logger.error("Per observer export requires a bundle format to be set.")
+            raise ValueError("Per observer export requires a bundle format to be set.")
 
         # export content
         surveys = session.query(Survey).where(Survey.type == survey_type).all()
+        files = SurveyGenerator._render_surveys(surveys, export_type, image_loading)
+        if bundle is None:
+            for survey_filename, content in files:
+                with open(Path(where) / survey_filename, "w", encoding="utf8") as fout:
+                    fout.write(content)
+                    logger.info(f"Survey {survey_filename} saved!")
+        else:
+            observers = Observers.get_observers() if per_observer else None
+            if observers is not None and len(observers) == 0:
+                logger.warning(f"There are no observers in a database to export surveys for. Skipping.")
+                return
+            SurveyBundle.export(where, f"{survey_type}-surveys.t1", files, bundle, observers=observers)
+
+    @staticmethod
+    def _render_surveys(surveys, export_type, image_loading):
+        """
+        Renders exported files of the given surveys one at a time, so that the files can be written out as they are
+        rendered.
+
+        :return: A generator of (filename, content) pairs.
+        """
+        # load image viewer js content
+        image_viewer_js = load_js()
+
         for survey in surveys:
             if type(survey) == RegularSurvey:
                 prefix = "regular"
             else:
                 prefix = "control"
+
+            survey_json = survey.json
+            assets = SurveyAssets(lazy=(image_loading == "lazy"))
+            if image_loading == "lazy":
+                survey_json = assets.extract(survey_json)
+            else:
+                survey_json = SurveyAssets.resolve(survey_json)
+
             if export_type == "json":
-                survey_filename = f"{prefix}-survey-{survey.id}.t1.json"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w", encoding="utf8") as fout:
-                    fout.write(survey.json)
-                    logger.info(f"Survey {survey_filename} saved!")
+                yield f"{prefix}-survey-{survey.id}.t1.json", survey_json
+                if image_loading == "lazy":
+                    yield f"{prefix}-survey-{survey.id}.t1.assets.json", assets.to_json()
             else:  # html
                 # $head - html head section
                 # $body - html body section
@@ -166,15 +227,15 @@ class SurveyGenerator:
                     "head": SurveyGenerator._generate_html_head_template(),
                     "body": SurveyGenerator._genenerate_html_body_template().substitute({
                         "image_viewer_js": image_viewer_js,
-                        "survey_json": survey.json,
+                        "asset_table_js": assets.table_js(),
+                        "asset_loader_js": SurveyAssets.loader_js(),
+                        "survey_assets_head": assets.head_script_blocks(),
+                        "survey_assets_tail": assets.tail_script_blocks(),
+                        "survey_json": survey_json,
                         "jqueryselector": "$"
                     })
                 })
-                survey_filename = f"{prefix}-survey-{survey.id}.t1.html"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w", encoding="utf8") as fout:
-                    fout.write(html)
-                    logger.info(f"Survey {survey_filename} saved!")
+                yield f"{prefix}-survey-{survey.id}.t1.html", html
 
     @staticmethod
     def _copy_export_images(where, survey):
@@ -259,6 +320,10 @@ class SurveyGenerator:
     @staticmethod
     def _genenerate_html_body_template():
         # $image_viewer_js - a source code of a js library for medical image visualization
+        # $asset_table_js - a table of images shared by survey questions
+        # $asset_loader_js - js functions for resolving lazily loaded images
+        # $survey_assets_head - image payloads needed by the first survey page
+        # $survey_assets_tail - image payloads needed by the rest of survey pages
         # $survey_json - survey json string saved in a database
         # $jqueryselector - is to be substitutes with "$" as a workaround
         locale = localization.locale.get_locale_data()
@@ -266,6 +331,9 @@ class SurveyGenerator:
 <body>
     <!-- replace this with built-in js code -->
     <script>$image_viewer_js</script>
+    <script>$asset_table_js</script>
+    <script>$asset_loader_js</script>
+    $survey_assets_head
     
     <!-- a container where the survey will be inserted -->
     <div id="surveyContainer"></div>
@@ -325,7 +393,7 @@ class SurveyGenerator:
         survey.onAfterRenderQuestion.add(function (sender, options) {{
             if (options.question.name.includes('-img')) {{
                 let imgElement = options.htmlElement.querySelector('#base64');
-                let imageId = imgElement.src;
+                let imageId = imgElement.getAttribute('src');
                 let resetWLButtonText = "{locale["iview_reset_wl_button_text"]}";
                 let resetZoomButtonText = "{locale["iview_reset_zoom_button_text"]}";
                 let resetPanButtonText = "{locale["iview_reset_pan_button_text"]}";
@@ -340,25 +408,34 @@ class SurveyGenerator:
                 let helpDialogRestoreMessage = "{locale["iview_help_dialog_restore_message"]}";
                 let closeHelpButtonText = "{locale["iview_close_help_button_text"]}";
                 
-                initViewer(
-                    imageId, 
-                    resetWLButtonText, 
-                    resetZoomButtonText, 
-                    resetPanButtonText, 
-                    resetRotationButtonText, 
-                    resetAllButtonText,
-                    helpButtonText,
-                    closeHelpButtonText,
-                    helpDialogTitle,
-                    helpDialogWLMessage,
-                    helpDialogPanMessage,
-                    helpDialogZoomMessage,
-                    helpDialogRotateMessage,
-                    helpDialogRestoreMessage
-                );
+                withAsset(imageId, function (resolvedImageId) {{
+                    initViewer(
+                        resolvedImageId, 
+                        resetWLButtonText, 
+                        resetZoomButtonText, 
+                        resetPanButtonText, 
+                        resetRotationButtonText, 
+                        resetAllButtonText,
+                        helpButtonText,
+                        closeHelpButtonText,
+                        helpDialogTitle,
+                        helpDialogWLMessage,
+                        helpDialogPanMessage,
+                        helpDialogZoomMessage,
+                        helpDialogRotateMessage,
+                        helpDialogRestoreMessage
+                    );
+                }});
             }} 
         }});
+        
+        // resolve images of the next page in advance
+        survey.onCurrentPageChanged.add(function (sender, options) {{
+            prefetchNextPageAssets(sender);
+        }});
+        prefetchNextPageAssets(survey);
     </script>
+    $survey_assets_tail
 </body>
 """)
 
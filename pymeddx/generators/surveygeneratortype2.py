@@ -7,20 +7,32 @@ from string import Template
 
 from model.survey import *
 from model.question import *
+from model.observer import Observers
 from utils.database import session
 from utils.logger import logger
 from utils.tools import fisher_yates_shuffle, load_js
+from generators.assets import SurveyAssets
+from generators.bundle import SurveyBundle
+from generators.packer import SurveyPacker
 
 
 class SurveyGenerator:
 
     supported_export_types = ["html", "json"]
 
+    # type of questions the surveys are generated from
+    qtype = 2
+
+    def __init__(self, max_bytes=None, max_pages=None, size_export_type="html"):
+        self.packer = SurveyPacker(max_pages=max_pages, max_bytes=max_bytes, export_type=size_export_type)
+
     def generate_all(self, n_surveys=None):
         """
         Generates surveys and saves them to the database.
 
-        Surveys are generated by image group - each survey contain all questions generated for one image group.
+        Surveys are generated by image group - each survey contain all questions generated for one image group. If
+        `max_bytes` or `max_pages` is set, questions of an image group are split into several surveys so that each
+        survey stays within the budget. A question and its redundant copies are always placed in the same survey.
 
         :param n_surveys: Maximum number of survey that should be generated. If the requested number is larger then
             a possible number of surveys that can be generated, the method generate as many surveys as it can.
@@ -34,48 +46,74 @@ class SurveyGenerator:
         # iterate while there are more question groups to include in the survey
         while current_image_group <= max_image_group:
 
-            questions = Questions.get_by_image_group(gid=current_image_group, unassigned=True)
+            questions = Questions.get_by_image_group(gid=current_image_group, unassigned=True, qtype=self.qtype)
             # print(f">>> Dobavio pitanja za grupu {current_image_group}.")
             if questions is None or len(questions) == 0:
                 logger.info(f"All questions assigned with group id {current_image_group} are already assigned to an "
                             f"existing survey. Skipping.")
                 current_image_group += 1
                 continue
-
-            # save a survey to database so that it is assigned valid id
             current_image_group += 1
-            survey = RegularSurvey(auth_page=False)
-            session.add(survey)
-            session.commit()
 
-            questions = fisher_yates_shuffle(questions)
+            # split shuffled question units into contiguous chunks that fit the budget, and shuffle questions
+            # within each chunk so that redundant copies are not placed next to their originals
+            units = fisher_yates_shuffle(SurveyGenerator._redundancy_units(questions))
+            for chunk in self.packer.pack_contiguous(units):
+                # save a survey to database so that it is assigned valid id
+                survey = RegularSurvey(auth_page=False)
+                session.add(survey)
+                session.commit()
 
-            for i in range(0, len(questions)):
-                question = questions[i]
-                survey.questions.append(question)
-                logger.info(f"Added question {question.id} to survey {survey.id}.")
+                chunk = fisher_yates_shuffle(chunk)
 
-            # generate survey json and update the survey in the database
-            survey.generate()
+                for i in range(0, len(chunk)):
+                    question = chunk[i]
+                    survey.questions.append(question)
+                    logger.info(f"Added question {question.id} to survey {survey.id}.")
 
-            # replace survey id placeholders in questions associated to survey with the survey id
-            survey.json = survey.json.replace("^_^", str(survey.id))
+                # generate survey json and update the survey in the database
+                survey.generate()
 
-            session.commit()
+                # replace survey id placeholders in questions associated to survey with the survey id
+                survey.json = survey.json.replace("^_^", str(survey.id))
 
-            # stop survey generation if required number of surveys is reached
-            if n_surveys is not None:
-                n_surveys -= 1
-                if n_surveys == 0:
-                    break
+                session.commit()
+
+                # stop survey generation if required number of surveys is reached
+                if n_surveys is not None:
+                    n_surveys -= 1
+                    if n_surveys == 0:
+                        return
 
     @staticmethod
-    def export_surveys(where, export_type="json", survey_type="regular"):
+    def _redundancy_units(questions):
+        # group each question with its redundant copies, the copies are used to measure intra-observer agreement
+        # within a single survey
+        units = {question.id: [question] for question in questions if not question.is_redundant}
+        for question in questions:
+            if question.is_redundant:
+                if question.ref_question_id in units:
+                    units[question.ref_question_id].append(question)
+                else:
+                    units[question.id] = [question]
+        return list(units.values())
+
+    @classmethod
+    def export_surveys(cls, where, export_type="json", survey_type="regular", image_loading="inline", bundle=None,
+                       per_observer=False):
         """
 
         :param where:
         :param export_type:
         :param survey_type:
+        :param image_loading: How images are embedded into exported surveys. If `inline`, images are part of the
+            survey json. If `lazy`, survey json contains only references to images and image payloads are exported
+            separately (script blocks for html export, sidecar `.assets.json` file for json export) and loaded only
+            when a survey page is shown.
+        :param bundle: If set, all exported files are streamed into a single bundle file of the given format (see
+            `SurveyBundle.supported_formats`) instead of being saved one by one.
+        :param per_observer: If set, a manifest of the bundle is created for each observer in the database. Surveys
+            are not assigned to observers, so all observers share the same bundle, see `SurveyBundle.export`.
         :return:
         """
         # check if directory to export to is ok
@@ -94,12 +132,51 @@ class SurveyGenerator:
             raise ValueError(f"Cannot export survey to '{export_type}'. Supported types are "
                              f"{SurveyGenerator.supported_export_types}")
 
-        # export content
-        surveys = session.query(Survey).where(Survey.type == survey_type).all()
+        # check if image loading mode is valid
+        if image_loading not in SurveyAssets.supported_image_loading:
+            logger.error(f"Unsupported image loading mode '{image_loading}'. Supported modes are "
+                         f"{SurveyAssets.supported_image_loading}")
+            raise ValueError(f"Unsupported image loading mode '{image_loading}'. Supported modes are "
+                             f"{SurveyAssets.supported_image_loading}")
+
+        # check if bundle format is valid
+        if bundle is not None and bundle not in SurveyBundle.supported_formats:
+            logger.error(f"Unsupported bundle format '{bundle}'. Supported formats are "
+                         f"{SurveyBundle.supported_formats}")
+            raise ValueError(f"Unsupported bundle format '{bundle}'. Supported formats are "
+                             f"{SurveyBundle.supported_formats}")
+        if per_observer and bundle is None:
+            logger.error("Per observer export requires a bundle format to be set.")
+            raise ValueError("Per observer export requires a bundle format to be set.")
+
+        # export content of surveys generated from questions of the generator type
+        survey_ids = session.query(Question.regular_survey_id).where(Question.type == cls.qtype)
+        surveys = session.query(Survey).where(Survey.type == survey_type, Survey.id.in_(survey_ids)).all()
         if len(surveys) == 0:
             logger.warning(f"There are no surveys in a database to be exported. Skipping.")
             exit(1)
 
+        files = cls._render_surveys(surveys, export_type, image_loading)
+        if bundle is None:
+            for survey_filename, content in files:
+                with open(Path(where) / survey_filename, "w", encoding="utf8") as fout:
+                    fout.write(content)
+                    logger.info(f"Survey {survey_filename} saved!")
+        else:
+            observers = Observers.get_observers() if per_observer else None
+            if observers is not None and len(observers) == 0:
+                logger.warning(f"There are no observers in a database to export surveys for. Skipping.")
+                return
+            SurveyBundle.export(where, f"{survey_type}-surveys.t{cls.qtype}", files, bundle, observers=observers)
+
+    @classmethod
+    def _render_surveys(cls, surveys, export_type, image_loading):
+        """
+        Renders exported files of the given surveys one at a time, so that the files can be written out as they are
+        rendered.
+
+        :return: A generator of (filename, content) pairs.
+        """
         image_viewer_js = load_js()
 
         for survey in surveys:
@@ -107,12 +184,20 @@ class SurveyGenerator:
                 prefix = "regular"
             else:
                 prefix = "control"
+
+            survey_json = survey.json
+            assets = SurveyAssets(lazy=(image_loading == "lazy"))
+            if image_loading == "lazy" or export_type == "html":
+                # questions of the same image group share the reference image and each compared image appears in
+                # multiple questions, so images are stored once per survey and questions reference them by key
+                survey_json = assets.extract(survey_json)
+            else:
+                survey_json = SurveyAssets.resolve(survey_json)
+
             if export_type == "json":
-                survey_filename = f"{prefix}-survey-{survey.id}.t2.json"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w", encoding="utf8") as fout:
-                    fout.write(survey.json)
-                    logger.info(f"Survey {survey_filename} saved!")
+                yield f"{prefix}-survey-{survey.id}.t{cls.qtype}.json", survey_json
+                if image_loading == "lazy":
+                    yield f"{prefix}-survey-{survey.id}.t{cls.qtype}.assets.json", assets.to_json()
             else:  # html
                 # $head - html head section
                 # $body - html body section
@@ -122,18 +207,18 @@ class SurveyGenerator:
                     $body
 </html>
                 """).substitute({
-                    "head": SurveyGenerator._generate_html_head_template(),
-                    "body": SurveyGenerator._genenerate_html_body_template().substitute({
+                    "head": cls._generate_html_head_template(),
+                    "body": cls._genenerate_html_body_template().substitute({
                         "image_viewer_js": image_viewer_js,
-                        "survey_json": survey.json,
+                        "asset_table_js": assets.table_js(),
+                        "asset_loader_js": SurveyAssets.loader_js(),
+                        "survey_assets_head": assets.head_script_blocks(),
+                        "survey_assets_tail": assets.tail_script_blocks(),
+                        "survey_json": survey_json,
                         "jqueryselector": "$"
                     })
                 })
-                survey_filename = f"{prefix}-survey-{survey.id}.t2.html"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w", encoding="utf8") as fout:
-                    fout.write(html)
-                    logger.info(f"Survey {survey_filename} saved!")
+                yield f"{prefix}-survey-{survey.id}.t{cls.qtype}.html", html
 
     @staticmethod
     def _generate_html_head_template():
@@ -197,26 +282,17 @@ class SurveyGenerator:
           });
           viewer.loadImage(imageId)
       };
-      
-      function cornerstoneTransformBase64(base64String) {
-        // A typical data URI prefix looks like "data:image/png;base64," 
-        // (or "data:image/jpeg;base64," etc.)
-        const prefixRegex = /^data:image\/[a-zA-Z0-9+.-]+;base64,/;
-
-        // Remove the standard data URI prefix if it exists
-        const stripped = base64String.replace(prefixRegex, "");
-
-        // Prepend "base://" string required for cornerstone base64 image loader
-        const cornerstoneTansformedBase64 = "base64://" + stripped;
-
-        return cornerstoneTansformedBase64;
-      }
      </script>
   </head>
 """
 
     @staticmethod
     def _genenerate_html_body_template():
+        # $image_viewer_js - a source code of a js library for medical image visualization
+        # $asset_table_js - a table of images shared by survey questions
+        # $asset_loader_js - js functions for resolving lazily loaded images
+        # $survey_assets_head - image payloads needed by the first survey page
+        # $survey_assets_tail - image payloads needed by the rest of survey pages
         # $survey_json - survey json string saved in a database
         # $jqueryselector - is to be substitutes with "$" as a workaround
         locale = localization.locale.get_locale_data()
@@ -224,6 +300,9 @@ class SurveyGenerator:
   <body>
     <!-- replace this with built-in js code -->
     <script>$image_viewer_js</script>
+    <script>$asset_table_js</script>
+    <script>$asset_loader_js</script>
+    $survey_assets_head
     
     <div id="surveyContainer"></div>
     
@@ -357,9 +436,6 @@ class SurveyGenerator:
               const choice = options.question.choices.find(c => c.value === imgAlt);
               if (!choice) console.error("There are no choices for this image for some reason... Exiting.");
 
-              // Retrieve the Base64 code from the choice object
-              const base64Data = cornerstoneTransformBase64(choice.imageLink);
-
               // Replace the default image with a custom viewer
               let container = document.createElement("div");
               container.id = "viewer-" + imgAlt; 
@@ -384,7 +460,9 @@ class SurveyGenerator:
               let helpDialogRestoreMessage = "{locale["iview_help_dialog_restore_message"]}";
               let closeHelpButtonText = "{locale["iview_close_help_button_text"]}";
               
-              initViewer(
+              // Retrieve the Base64 code from the survey asset table
+              withAsset(choice.imageLink, function (base64Data) {{
+                initViewer(
                     container.id,
                     base64Data, 
                     resetWLButtonText, 
@@ -401,8 +479,16 @@ class SurveyGenerator:
                     helpDialogRotateMessage,
                     helpDialogRestoreMessage
                 );
+              }});
             }});
         }});
+
+      // resolve images of the next page in advance
+      survey
+        .onCurrentPageChanged
+        .add(function (sender, options) {{
+            prefetchNextPageAssets(sender);
+        }});
         
       survey.locale = "{locale["localization"]}"
       
@@ -410,7 +496,9 @@ class SurveyGenerator:
           model: survey,
           onComplete: sendDataToDisk
       }});
+      prefetchNextPageAssets(survey);
     </script>
+    $survey_assets_tail
   </body>
 """)
 
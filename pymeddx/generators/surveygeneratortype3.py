@@ -0,0 +1,175 @@
+import localization.locale
+
+from string import Template
+
+from generators.surveygeneratortype2 import SurveyGenerator as SurveyGeneratorType2
+
+
+class SurveyGenerator(SurveyGeneratorType2):
+    """
+    Generates surveys from type 3 (ranking) questions.
+
+    Surveys are generated and exported in the same way as type 2 surveys, by image group, with a question and its
+    redundant copies placed in the same survey. Only the html template differs, since each page shows the reference
+    image, k candidate images and a ranking question instead of an image pair.
+    """
+
+    qtype = 3
+
+    @staticmethod
+    def _genenerate_html_body_template():
+        # $image_viewer_js - a source code of a js library for medical image visualization
+        # $asset_table_js - a table of images shared by survey questions
+        # $asset_loader_js - js functions for resolving lazily loaded images
+        # $survey_assets_head - image payloads needed by the first survey page
+        # $survey_assets_tail - image payloads needed by the rest of survey pages
+        # $survey_json - survey json string saved in a database
+        # $jqueryselector - is to be substitutes with "$" as a workaround
+        locale = localization.locale.get_locale_data()
+        return Template(f"""
+  <body>
+    <!-- replace this with built-in js code -->
+    <script>$image_viewer_js</script>
+    <script>$asset_table_js</script>
+    <script>$asset_loader_js</script>
+    $survey_assets_head
+
+    <div id="surveyContainer"></div>
+
+    <!-- Init survey -->
+    <script>
+      Survey
+        .StylesManager
+        .applyTheme("modern");
+
+      Survey
+        .Serializer
+        .addProperty("imagepicker", "imageTag:text")
+
+      Survey
+        .Serializer
+        .addProperty("survey", "surveyID:number")
+
+      var surveyJSON = $survey_json
+      function downloadSurveyData(data, filename = 'survey-results.json') {{
+            let jsonData = JSON.stringify(data, null, 2); // Pretty print JSON data
+            let blob = new Blob([jsonData], {{ type: "application/json" }});
+
+            // Create a link element to trigger the download
+            let link = document.createElement('a');
+            link.href = URL.createObjectURL(blob);
+            link.download = filename;
+
+            // Programmatically click the link to trigger the download
+            document.body.appendChild(link);
+            link.click();
+
+            // Clean up
+            document.body.removeChild(link);
+      }}
+
+      function sendDataToDisk(sender) {{
+          // Serialize the survey data
+          let surveyData = sender.data;
+          let formattedData = {{
+              "ResultCount": 1,
+              "HappenedAt": Date.now(),
+              "Data": [
+                  surveyData
+              ]
+          }};
+
+          surveyFilename = window.location.pathname
+          surveyFilename = surveyFilename.substring(surveyFilename.lastIndexOf('/') + 1)
+          let responseFilename = 'responses-' + surveyFilename
+
+          // Trigger file download with the survey data
+          downloadSurveyData(formattedData, responseFilename);
+      }}
+      var survey = new Survey.Model(surveyJSON);
+
+      survey
+        .onAfterRenderQuestion
+        .add(function (sender, options) {{
+            if (!options.question.imageTag) return;
+
+            // the reference image is shown next to the candidates, candidates are shown in a grid with their labels
+            let size = options.question.imageTag === "original" ? 420 : 300;
+            options.htmlElement.parentElement.attributes.style.value =
+                options.question.imageTag === "original" ? "flex: 1; width: 100%" : "flex: 2; width: 100%";
+
+            // replace images inisde the image picker with medical image viewer
+            let images = options.htmlElement.querySelectorAll("img");
+            images.forEach((img) => {{
+
+              let imgAlt = img.alt;
+
+              // Find the matching choice from the question definition
+              const choice = options.question.choices.find(c => c.value === imgAlt);
+              if (!choice) console.error("There are no choices for this image for some reason... Exiting.");
+
+              // Replace the default image with a custom viewer
+              let container = document.createElement("div");
+              container.id = "viewer-" + options.question.name + "-" + imgAlt;
+              container.style.width = size;
+              container.style.height = size;
+              container.className = "sv-imagepicker__image";
+              container.style.pointerEvents = "auto";
+              img.parentElement.replaceChild(container, img);
+
+              // Initialize image viewer
+              let resetWLButtonText = "{locale["iview_reset_wl_button_text"]}";
+              let resetZoomButtonText = "{locale["iview_reset_zoom_button_text"]}";
+              let resetPanButtonText = "{locale["iview_reset_pan_button_text"]}";
+              let resetRotationButtonText = "{locale["iview_reset_rotation_button_text"]}";
+              let resetAllButtonText = "{locale["iview_reset_all_button_text"]}";
+              let helpButtonText = "{locale["iview_help_button_text"]}";
+              let helpDialogTitle = "{locale["iview_help_dialog_title"]}";
+              let helpDialogWLMessage = "{locale["iview_help_dialog_wl_message"]}";
+              let helpDialogPanMessage = "{locale["iview_help_dialog_pan_message"]}";
+              let helpDialogZoomMessage = "{locale["iview_help_dialog_zoom_message"]}";
+              let helpDialogRotateMessage = "{locale["iview_help_dialog_rotate_message"]}";
+              let helpDialogRestoreMessage = "{locale["iview_help_dialog_restore_message"]}";
+              let closeHelpButtonText = "{locale["iview_close_help_button_text"]}";
+
+              // Retrieve the Base64 code from the survey asset table
+              withAsset(choice.imageLink, function (base64Data) {{
+                initViewer(
+                    container.id,
+                    base64Data,
+                    resetWLButtonText,
+                    resetZoomButtonText,
+                    resetPanButtonText,
+                    resetRotationButtonText,
+                    resetAllButtonText,
+                    helpButtonText,
+                    closeHelpButtonText,
+                    helpDialogTitle,
+                    helpDialogWLMessage,
+                    helpDialogPanMessage,
+                    helpDialogZoomMessage,
+                    helpDialogRotateMessage,
+                    helpDialogRestoreMessage
+                );
+              }});
+            }});
+        }});
+
+      // resolve images of the next page in advance
+      survey
+        .onCurrentPageChanged
+        .add(function (sender, options) {{
+            prefetchNextPageAssets(sender);
+        }});
+
+      survey.locale = "{locale["localization"]}"
+
+      $jqueryselector("#surveyContainer").Survey({{
+          model: survey,
+          onComplete: sendDataToDisk
+      }});
+      prefetchNextPageAssets(survey);
+    </script>
+    $survey_assets_tail
+  </body>
+""")
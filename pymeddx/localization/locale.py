@@ -12,6 +12,9 @@ with open(os.path.join(localization_dir, "type1_localization.json"), "r") as loc
 with open(os.path.join(localization_dir, "type2_localization.json"), 'r') as locale_file:
     type2_locale_data = json.load(locale_file)
 
+with open(os.path.join(localization_dir, "type3_localization.json"), 'r') as locale_file:
+    type3_locale_data = json.load(locale_file)
+
 locale_data = None
 
 def update_locale_data(qtype):
@@ -20,6 +23,8 @@ def update_locale_data(qtype):
         locale_data = type1_locale_data
     elif qtype == 2:
         locale_data = type2_locale_data
+    elif qtype == 3:
+        locale_data = type3_locale_data
     else:
         locale_data = None
         
@@ -4,19 +4,47 @@ import click
 
 import analyzers.visualizations.boxplot as bplot
 import analyzers.visualizations.histogram as hist
+import analyzers.metrics.copeland_score as cscore
+import analyzers.metrics.diagnostic_score as dscore
+import analyzers.metrics.ranking as ranking
+import analyzers.statistics.bootstrap as bootstrap
+import generators.pairing as pairing
 import localization.locale
 from analyzers.metrics.copeland_score import copeland_score
 from analyzers.metrics.diagnostic_score import (DiagnosticScore,
-                                                DiagnosticScores)
+                                                DiagnosticScores,
+                                                diagnostic_score)
 from generators.surveygeneratortype1 import SurveyGenerator as SGen1
 from generators.surveygeneratortype2 import SurveyGenerator as SGen2
+from generators.surveygeneratortype3 import SurveyGenerator as SGen3
 from model.copeland_score import CopelandScore, CopelandScores
 from model.observer import Observers
 from model.question import *
 from model.response import Responses
-from utils.database import engine, Base
+from utils.database import engine, Base, update_statistics
+from utils.logger import logger
+from sqlalchemy import inspect, text
 
 Base.metadata.create_all(engine)
+inspector = inspect(engine)
+# Copeland scores of databases created before scores were stored per run have no run id, and every calculation
+# appended a new score of each image, so only the latest score of each image is kept in the default run
+if "run_id" not in [column["name"] for column in inspector.get_columns("copeland_score")]:
+    logger.info("Migrating Copeland scores of an existing database to scores stored per run.")
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE copeland_score ADD COLUMN run_id VARCHAR NOT NULL DEFAULT 'default'"))
+        connection.execute(text("DELETE FROM copeland_score WHERE id NOT IN "
+                                "(SELECT MAX(id) FROM copeland_score GROUP BY image_id, run_id)"))
+        connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_copeland_score_image_id_run_id "
+                                "ON copeland_score (image_id, run_id)"))
+    inspector = inspect(engine)
+# create_all does not add indexes to tables of an existing database
+missing_indexes = [index for table in Base.metadata.sorted_tables for index in table.indexes
+                   if not inspector.has_index(table.name, index.name)]
+for index in missing_indexes:
+    index.create(engine)
+if len(missing_indexes) != 0:
+    update_statistics()
 
 
 @click.group()
@@ -61,8 +89,8 @@ def observers(filepath):
 
 
 @load.command(short_help="Load image data to the database.")
-@click.option('-q', '--qtype', type=click.Choice(["1", "2"]), required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
+@click.option('-q', '--qtype', type=click.Choice(["1", "2", "3"]), required=True,
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
 @click.option('-d', '--directory', type=click.Path(exists=True), required=True,
               help="Path to the directory containing the images. Immediate parent directory will be considered as a "
                    "dataset name.")
@@ -87,8 +115,8 @@ def images(qtype, directory, extension, metadata_file):
 @load.command(short_help="Load questionnaire responses to the database.")
 @click.option('-d', '--directory', type=click.Path(exists=True), required=True,
               help="Path to the directory containing the responses.")
-@click.option('-q', '--qtype', type=click.Choice(["1", "2"]), required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
+@click.option('-q', '--qtype', type=click.Choice(["1", "2", "3"]), required=True,
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
 def responses(directory, qtype):
     """
     Load questionnaire responses to the database.
@@ -114,6 +142,8 @@ def responses(directory, qtype):
                 for response_file in observer_dir.glob("*.html"):
                     if qtype == 1:
                         Responses.load_from_file(response_file, observer_id=observer_dir_name, qtype=1)
+                    elif qtype == 3:
+                        Responses.load_from_file(response_file, observer_id=observer_dir_name, qtype=3)
                     else:
                         Responses.load_from_file(response_file, observer_id=observer_dir_name, qtype=2)
                 # Placeholder for loading responses into the database
@@ -125,6 +155,9 @@ def responses(directory, qtype):
             logger.info(f"Skipping. Invalid response directory naming scheme ('{observer_dir.name}'). The name of the "
                         f"file should be the same as an ID of the observer who generated responses.")
 
+    # statistics of the indexes let the query planner pair repeated measurements through the question indexes
+    update_statistics()
+
 
 @pymeddx.group(short_help="Generate questions or whole questionnaires.")
 def generate():
@@ -137,11 +170,28 @@ def generate():
 
 @generate.command(short_help="Generate questions.")
 @click.option('-q', '--qtype', type=int, required=True,
-              help="Type of questionnaire the questions are generated for. Currently supported values are 1 and 2.")
+              help="Type of questionnaire the questions are generated for. Currently supported values are 1, 2 and "
+                   "3.")
 @click.option('-r', '--repeat', type=int, required=False,
               help="Only applies to type 2 questionnaires. This option is used to specify how many times will each "
                    "image from the image group repeat when generating the questions.", default=5)
-def questions(qtype, repeat):
+@click.option('-t', '--storage', type=click.Choice(['inline', 'linked'], case_sensitive=False), required=False,
+              help="How images are stored in the generated questions. With `inline` questions contain base64 encoded "
+                   "images. With `linked` questions contain only image references that are resolved from the image "
+                   "store during questionnaire export.", default='inline')
+@click.option('-g', '--design', type=click.Choice(['full', 'adaptive', 'cyclic', 'balanced', 'random'],
+                                                  case_sensitive=False), required=False,
+              help="Only applies to type 2 questionnaires. Which image pairs are compared. With `full` all pairs of "
+                   "images in a group are compared. With `adaptive` only the next round of the most informative pairs "
+                   "is selected, based on the responses imported so far. With `cyclic`, `balanced` and `random` each "
+                   "image is compared with `--degree` other images of its group.", default='full')
+@click.option('-k', '--degree', type=int, required=False,
+              help="Only applies to `cyclic`, `balanced` and `random` designs. Number of images each image is "
+                   "compared with.")
+@click.option('-w', '--ranking-size', type=int, required=False,
+              help="Only applies to type 3 questionnaires. Number of images ranked in a single question. If not "
+                   "specified, all images of a group are ranked in a single question.")
+def questions(qtype, repeat, storage, design, degree, ranking_size):
     """
     Generate questions depending on the chosen questionnaire type. If
     generating type 2 questionnaire was chosen, you can specify how many
@@ -149,12 +199,21 @@ def questions(qtype, repeat):
     """
     print(f"Generating questions.")
     localization.locale.update_locale_data(qtype)
-    Questions.generate(qtype=qtype, n_repeat=repeat)
+    pairs = None
+    if qtype == 2 and design == 'adaptive':
+        pairs = pairing.adaptive_pairs()
+        if len(pairs) == 0:
+            logger.info("There are no image pairs left to compare. Rankings of all image groups are resolved or "
+                        "waiting for responses to pending questions.")
+            return
+    elif qtype == 2 and design in pairing.static_designs:
+        pairs = pairing.static_pairs(design, degree)
+    Questions.generate(qtype=qtype, n_repeat=repeat, storage=storage, pairs=pairs, ranking_size=ranking_size)
 
 
 @generate.command(short_help="Generate questionnaires.")
 @click.option('-q', '--qtype', type=int, required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
 @click.option('-s', '--qsubtype', type=click.Choice(['regular', 'control'], case_sensitive=False), required=False,
               help="Questionnaire subtype. Questionnaires of type 1 can be regular and control, but questionnaires"
                    "of type 2 can only be regular. Currently  supported values are `regular` and `control`.", default='regular')
@@ -163,17 +222,34 @@ def questions(qtype, repeat):
                    " until all questions have been used up.")
 @click.option('-k', '--kquestions', type=int, required=False,
               help="Number of questions per questionnaire. Used only in questionnaires type 1.", default=20)
-def questionnaire(qtype, qsubtype, nquestionnaire, kquestions):
+@click.option('-b', '--max-size', type=float, required=False,
+              help="Maximum size of an exported questionnaire in megabytes, estimated from the sizes of the image "
+                   "files. Questions that do not fit are placed in additional questionnaires. If not specified, the "
+                   "size is not limited.")
+@click.option('--size-format', type=click.Choice(['html', 'json']), required=False, default='html',
+              help="Export format `--max-size` refers to. Use `json` for json export with inline images, which embeds "
+                   "images into every question instead of once per questionnaire. Html export and exports with lazily "
+                   "loaded images are bounded by the default `html`.")
+@click.option('-p', '--max-pages', type=int, required=False,
+              help="Maximum number of questions per questionnaire. Used only in questionnaires type 2, questionnaires "
+                   "type 1 use `--kquestions`. If not specified, each questionnaire contains all questions of an image "
+                   "group.")
+def questionnaire(qtype, qsubtype, nquestionnaire, kquestions, max_size, size_format, max_pages):
     """
     Generate questionnaires of specified type from the database questions.
     """
     logger.info("Starting questionnaire generation...")
     localization.locale.update_locale_data(qtype)
+    max_bytes = None if max_size is None else int(max_size * 1024 * 1024)
     if qtype == 1:
-        survey_gen = SGen1(survey_type=qsubtype, questions_per_survey=kquestions)
+        survey_gen = SGen1(survey_type=qsubtype, questions_per_survey=kquestions, max_bytes=max_bytes,
+                           size_export_type=size_format)
         survey_gen.generate_all(n_surveys=nquestionnaire)
     elif qtype == 2:
-        survey_gen = SGen2()
+        survey_gen = SGen2(max_bytes=max_bytes, max_pages=max_pages, size_export_type=size_format)
+        survey_gen.generate_all(n_surveys=nquestionnaire)
+    elif qtype == 3:
+        survey_gen = SGen3(max_bytes=max_bytes, max_pages=max_pages, size_export_type=size_format)
         survey_gen.generate_all(n_surveys=nquestionnaire)
     else:
         logger.error(f"Unsupported questionnaire type {qtype}.")
@@ -186,22 +262,42 @@ def questionnaire(qtype, qsubtype, nquestionnaire, kquestions):
 @click.option('-f', '--format', type=click.Choice(['json', 'html']), required=False,
               help="Format of output data. Currently  supported values are `json` and `html`.", default="html")
 @click.option('-q', '--qtype', type=int, required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
 @click.option('-s', '--qsubtype', type=click.Choice(['regular', 'control'], case_sensitive=False), required=False,
               help="Questionnaire subtype. Questionnaires of type 1 can be regular and control, but questionnaires"
                    "of type 2 can only be regular. Currently  supported values are `regular` and `control`.", default='regular')
-def export(directory, format, qtype, qsubtype):
+@click.option('-i', '--image-loading', type=click.Choice(['inline', 'lazy'], case_sensitive=False), required=False,
+              help="How images are embedded into exported questionnaires. With `inline` images are part of the "
+                   "questionnaire json. With `lazy` the questionnaire json holds only image references and images are "
+                   "loaded when a questionnaire page is shown.", default='inline')
+@click.option('-b', '--bundle', type=click.Choice(['zip', 'tar.gz', 'ndjson'], case_sensitive=False), required=False,
+              help="If specified, all questionnaires are streamed into a single file of the given format instead of "
+                   "one file per questionnaire. Currently supported values are `zip`, `tar.gz` and `ndjson`.")
+@click.option('-o', '--per-observer', is_flag=True, default=False,
+              help="Also write a manifest for each observer in the database, naming the bundle and its "
+                   "questionnaires. Questionnaires are not assigned to observers, so all observers share one bundle. "
+                   "Requires `--bundle`.")
+def export(directory, format, qtype, qsubtype, image_loading, bundle, per_observer):
     """
     Exports questionnaire data to the specified directory. Currently
     supports questionnaire export in json and html formats.
     """
     logger.info("Starting questionnaire export...")
     localization.locale.update_locale_data(qtype)
+    if format == 'json' and image_loading == 'inline':
+        logger.info("Json export with inline images embeds images into every question. Questionnaires generated with "
+                    "`--max-size` stay within it only if they were generated with `--size-format json`.")
     if qtype == 1:
-        SGen1.export_surveys(directory, export_type=format, survey_type=qsubtype)
+        SGen1.export_surveys(directory, export_type=format, survey_type=qsubtype, image_loading=image_loading,
+                             bundle=bundle, per_observer=per_observer)
     elif qtype == 2:
         # there are no type 2 control surveys
-        SGen2.export_surveys(directory, export_type=format, survey_type='regular')
+        SGen2.export_surveys(directory, export_type=format, survey_type='regular', image_loading=image_loading,
+                             bundle=bundle, per_observer=per_observer)
+    elif qtype == 3:
+        # like type 2, there are no type 3 control surveys
+        SGen3.export_surveys(directory, export_type=format, survey_type='regular', image_loading=image_loading,
+                             bundle=bundle, per_observer=per_observer)
     else:
         logger.error(f"Unsupported questionnaire type {qtype}.")
         raise ValueError(f"Unsupported questionnaire type {qtype}.")
@@ -219,44 +315,58 @@ def analyze():
 
 @analyze.command(short_help="Calculate all the metrics.")
 @click.option('-q', '--qtype', type=int, required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
-@click.option('-m', '--mtype', type=click.Choice(['dv', 'cs'], case_sensitive=False), required=True,
-              help="Type of metric calculation to be ran. Currently supported values are 'dv' for 'diagnostic-value'"
-                   "and 'cs' for 'copeland-score'.")
-def metrics(qtype, mtype):
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
+@click.option('-m', '--mtype', type=click.Choice(['dv', 'cs', 'bt', 'elo', 'kemeny'], case_sensitive=False),
+              required=True,
+              help="Type of metric calculation to be ran. Currently supported values are 'dv' for 'diagnostic-value', "
+                   "'cs' for 'copeland-score', 'bt' for Bradley-Terry model, 'elo' for Elo rating and 'kemeny' for "
+                   "Kemeny ranking approximation.")
+@click.option('-r', '--run-id', type=str, required=False, default="default",
+              help="Identifier under which Copeland scores are saved. Rerunning the calculation with the same run id "
+                   "replaces the scores of that run, while scores saved under other run ids are kept. Used only in "
+                   "questionnaires type 2.")
+@click.option('--ci', type=click.FloatRange(0, 1, min_open=True, max_open=True), required=False, default=None,
+              help="Confidence level of bootstrap confidence intervals, e.g. 0.95. Intervals are not calculated if "
+                   "not specified.")
+@click.option('--resample', type=click.Choice(bootstrap.resampling_units), required=False, default='cases',
+              help="What is resampled when calculating confidence intervals, cases (images or questions), observers, "
+                   "or both.")
+@click.option('--n-resamples', type=int, required=False, default=10000,
+              help="Number of bootstrap resamples used to calculate confidence intervals.")
+def metrics(qtype, mtype, run_id, ci, resample, n_resamples):
     """
     Calculate the metrics of the loaded responses using one of the available
-    methods. The support values are 'dv' for diagnostic-value and 'cs' for
-    'copeland-score'.
+    methods. The support values are 'dv' for diagnostic-value, 'cs' for
+    'copeland-score', and 'bt', 'elo' and 'kemeny' for pairwise ranking methods.
     """
     if qtype == 1:
         if mtype == 'dv':
-            responses = Responses.get_all_responses(type=qtype)
-            if len(responses) == 0:
+            scores_df = diagnostic_score()
+            if scores_df is None:
                 logger.error("Cannot calculate the diagnostic score because there are no responses in the database. "
                              "Please import responses first, then try calculating the diagnostic score again.")
                 return
-            for r in responses:
-                if r.diagnostic_score is None or len(r.diagnostic_score) == 0:
-                    diagnostic_score = DiagnosticScore(r)
-                    DiagnosticScores.insert(diagnostic_score)
-                    logger.debug(f"Inserted diagnostic score to the database: ({r.id}, {diagnostic_score})")
+            DiagnosticScores.bulk_insert(scores_df)
+            logger.debug(f"Inserted {len(scores_df)} diagnostic scores to the database.")
+            dscore.update_score_summaries(scores_df)
             logger.info(f"Diagnostic value calculation done!")
+            if ci is not None:
+                intervals = bootstrap.diagnostic_score_means(unit=resample, n_resamples=n_resamples, confidence=ci)
+                logger.info(f"\nMean diagnostic scores of datasets with {ci:.0%} bootstrap confidence intervals "
+                            f"(resampled {resample}):\n{intervals.to_string()}")
         else:
             logger.error(f"Unsupported metric type '{mtype}' for qtype {qtype}. Consider using a different "
                          f"questionnaire type.")
             return
-    elif qtype == 2:
+    elif qtype in [2, 3]:
+        # rankings (type 3) are expanded into pairwise comparisons, so both types are scored together
         if mtype == 'cs':
             cscores_df = copeland_score()
             logger.info(f"Copeland score calculation done!")
-            for index, row in cscores_df.iterrows():
-                img_id = row['img_id']
-                cscore = row['copeland_score']
-                cs = CopelandScore(img_id=img_id, value=cscore)
-                CopelandScores.insert(cs)
-                logger.debug(f"Inserted copeland score to the database: ({int(img_id)}, {cscore})")
-            model_scores = CopelandScores.get_score_group_by_models()
+            CopelandScores.upsert(cscores_df, run_id=run_id)
+            logger.debug(f"Saved {len(cscores_df)} Copeland scores to the database under run '{run_id}'.")
+            cscore.update_score_summaries(cscores_df, run_id=run_id)
+            model_scores = CopelandScores.get_score_group_by_models(run_id=run_id)
             if len(model_scores) != 0:
                 logger.info(f"\nList of models and associated Copeland scores sorted in descending order.")
                 logger.info(f"The presented scores are averaged across images produced by the same model.")
@@ -265,23 +375,60 @@ def metrics(qtype, mtype):
             else:
                 logger.error(f"Copeland scores per models could not be printed because the resulting list is empty. "
                              f"Check if Copeland scores has been calculated or if images have assigned model names.")
+            if ci is not None:
+                intervals = bootstrap.copeland_model_means(unit=resample, n_resamples=n_resamples, confidence=ci)
+                logger.info(f"\nMean Copeland scores of models with {ci:.0%} bootstrap confidence intervals "
+                            f"(resampled {resample}):\n{intervals.to_string()}")
+        elif mtype in ranking.supported_methods:
+            scores_df, diagnostics = ranking.ranking_scores(mtype)
+            logger.info(f"Ranking with method '{mtype}' done in {diagnostics['runtime']:.3f} seconds.")
+            for key, value in diagnostics.items():
+                logger.info(f"[{mtype}] {key}: {value}")
+            if ci is not None:
+                logger.warning(f"Confidence intervals are not supported for method '{mtype}'. Ignoring 'ci'.")
+            model_scores = ranking.model_leaderboard(scores_df)
+            if len(model_scores) != 0:
+                logger.info(f"\nList of models and associated '{mtype}' scores sorted in descending order.")
+                logger.info(f"The presented scores are averaged across images produced by the same model.")
+                for i, (model, score) in enumerate(model_scores):
+                    logger.info(f"[{i}] {model}: {score}")
+            else:
+                logger.error(f"Scores per models could not be printed because the resulting list is empty. "
+                             f"Check if there are responses or if images have assigned model names.")
         else:
             logger.error(f"Unsupported metric type '{mtype}' for qtype {qtype}.")
             raise ValueError(f"Unsupported metric type '{mtype}' for qtype {qtype}.")
     else:
-        logger.error(f"Unsupported qtype type '{qtype}'. Currently supported types are ['1', '2'].")
+        logger.error(f"Unsupported qtype type '{qtype}'. Currently supported types are ['1', '2', '3'].")
         return
 
 
 @analyze.command(short_help="Run statistical tests.")
 @click.option('-q', '--qtype', type=int, required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
 @click.option('-s', '--stype', type=click.Choice(['inter', 'intra']), required=True,
               help='Run inter-observer or intra-observer statistical analyzes.')
 @click.option('-o', '--oid', type=int, multiple=True,
               help="Identifier of the observer to include in calculation. Currently used only to select observers for "
                    "intra-observer agreement calculations.")
-def stats(qtype, stype, oid):
+@click.option('--all-observers', is_flag=True, default=False,
+              help="Calculate intra-observer agreement of all observers with control measurements, in parallel "
+                   "processes. Replaces 'oid'.")
+@click.option('--ci', type=click.FloatRange(0, 1, min_open=True, max_open=True), required=False, default=None,
+              help="Confidence level of bootstrap confidence intervals, e.g. 0.95. Intervals are not calculated if "
+                   "not specified.")
+@click.option('--resample', type=click.Choice(bootstrap.resampling_units), required=False, default='cases',
+              help="What is resampled when calculating confidence intervals, cases (images or questions), observers, "
+                   "or both.")
+@click.option('--n-resamples', type=int, required=False, default=10000,
+              help="Number of bootstrap resamples used to calculate confidence intervals.")
+@click.option('--kappa-weights', type=click.Choice(['linear', 'quadratic']), required=False, default=None,
+              help="Weights of Cohen's kappa for ordinal ratings, e.g. diagnostic scores. Unweighted kappa is "
+                   "calculated if not specified.")
+@click.option('--alpha-level', type=click.Choice(['nominal', 'ordinal', 'interval', 'ratio']), required=False,
+              default='nominal',
+              help="Level of measurement used to calculate Krippendorff's alpha, 'nominal' by default.")
+def stats(qtype, stype, oid, all_observers, ci, resample, n_resamples, kappa_weights, alpha_level):
     """
     Run statistical tests on the loaded response data. Calculates the
     cohens-kappa and the krippendorff-alpha for inter-observer agreement and Guttman's lambda, Cronbach's alpha and ICC
@@ -301,42 +448,60 @@ def stats(qtype, stype, oid):
         from analyzers.statistics.interobserver import stats_wrapper
 
         logger.info(f"Calculating Cohen's kappa...")
-        r = stats_wrapper(qtype=qtype, fn='cohens-kappa')
+        r = stats_wrapper(qtype=qtype, fn='cohens-kappa', weights=kappa_weights, ci=ci, resample=resample,
+                          n_resamples=n_resamples)
         logger.info(f"Pairwise observer agreement:\n{r['pairwise_observers']}")
+        if 'confidence_intervals' in r:
+            logger.info(f"Pairwise observer agreement with {ci:.0%} bootstrap confidence intervals:\n"
+                        f"{r['confidence_intervals'].to_string(index=False)}")
         logger.info('')
 
         logger.info(f"Calculating Krippendorff alpha...")
-        r = stats_wrapper(qtype=qtype, fn='krippendorff-alpha', pairwise=True)
+        r = stats_wrapper(qtype=qtype, fn='krippendorff-alpha', pairwise=True, level=alpha_level)
 
         logger.info(f"Inter-observer agreement of all observers: {r['all_observers']}")
         if 'pairwise_observers' in r:
             logger.info(f"Pairwise observer agreement:\n{r['pairwise_observers']}")
     elif stype.lower() == 'intra':
-        from analyzers.statistics.intraobserver import stats_wrapper
+        from analyzers.statistics.intraobserver import IntraObserverSession
+
+        if ci is not None:
+            logger.warning("Confidence intervals are not supported for intra-observer agreement. Ignoring 'ci'.")
+        if all_observers and len(oid) != 0:
+            logger.warning("The 'oid' parameter is not applicable when 'all-observers' is set. Ignoring 'oid'.")
+        elif not all_observers and len(oid) == 0:
+            logger.error(f"No observers are specified. Exiting.")
+            return
 
         logger.info('(Guttman) Check that the inequality holds: 0 < L1 < L3 <= L2')
-        logger.info('(Cronbach) Check that the equality holds: Cronbach Alpha = Guttmans L3')
-
-        stats_wrapper(qtype=qtype, fn='actionbars-alpha', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='icc', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='guttmans-lambda-1', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='guttmans-lambda-2', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='guttmans-lambda-3', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='guttmans-lambda-4', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='guttmans-lambda-5', observer_ids=oid)
-        stats_wrapper(qtype=qtype, fn='guttmans-lambda-6', observer_ids=oid)
+        logger.info("(Cronbach) Alpha treats the two measurements as items and Guttman's lambdas treat the questions "
+                    "as items, so alpha is not expected to equal L3")
+
+        # paired measurements are loaded once and shared by all statistics
+        if all_observers:
+            analysis = IntraObserverSession(qtype=qtype)
+            r = analysis.results(n_jobs=None)
+            if not r.empty:
+                logger.info(f"Intra-observer agreement of all observers:\n{r.to_string()}")
+        else:
+            analysis = IntraObserverSession(qtype=qtype, observer_ids=oid)
+            r = analysis.results()
+            if not r.empty:
+                logger.info(f"Intra-observer agreement:\n{r.T.to_string()}")
     else:
         logger.error(f"Unsupported statistical analysis type.")
 
 
 @analyze.command(short_help="Draw boxplot or histogram.")
 @click.option('-q', '--qtype', type=int, required=True,
-              help="Questionnaire type. Currently supported values are 1 and 2.")
+              help="Questionnaire type. Currently supported values are 1, 2 and 3.")
 @click.option('-d', '--directory', type=click.Path(exists=True), required=True,
               help="Path to the directory where to save the visuals.")
 @click.option('-v', '--vtype', type=click.Choice(['boxplot', 'histogram']), required=True,
               help="Questionnaire type. Currently supported values are 1 and 2.")
-def visual(qtype, directory, vtype):
+@click.option('-r', '--run-id', type=str, required=False, default="default",
+              help="Identifier of the run whose Copeland scores are plotted. Used only in questionnaires type 2.")
+def visual(qtype, directory, vtype, run_id):
     """
     Draws boxplot or histogram of the calculated data.
     """
@@ -382,7 +547,7 @@ def visual(qtype, directory, vtype):
                 ylabel="Count",
                 output_dir=directory
             )
-    elif qtype == 2:
+    elif qtype in [2, 3]:
         if vtype == 'boxplot':
             logger.info(f"Plotting boxplot for Copeland score.")
             bplot.boxplot_models(
@@ -390,7 +555,8 @@ def visual(qtype, directory, vtype):
                 title="Copeland score per Models",
                 xlabel="Models",
                 ylabel="Copeland score",
-                output_dir=directory
+                output_dir=directory,
+                run_id=run_id
             )
         elif vtype == 'histogram':
             logger.info(f"Plotting histograms for Copeland score.")
@@ -399,7 +565,8 @@ def visual(qtype, directory, vtype):
                 title="Copeland Score Distribution",
                 xlabel="Copeland Score",
                 ylabel="Value",
-                output_dir=directory
+                output_dir=directory,
+                run_id=run_id
             )
 
 
@@ -1,5 +1,5 @@
 from .response import Response
-from .question import Question, QuestionType1, QuestionType2
+from .question import Question, QuestionType1, QuestionType2, QuestionType3
 from .survey import Survey, RegularSurvey, ControlSurvey
 from .observer import Observer
 from .diagnosis import Diagnosis
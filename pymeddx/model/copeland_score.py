@@ -1,24 +1,28 @@
-from model.image import Image, Images
+from model.image import Images
+from model.score_summary import ScoreSummaries
 from utils.database import Base, session
 
-from sqlalchemy import func
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, UniqueConstraint
 from sqlalchemy import Integer, String
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import relationship
 
 
 class CopelandScore(Base):
     __tablename__ = "copeland_score"
+    __table_args__ = (UniqueConstraint("image_id", "run_id"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     value = Column(Integer, nullable=False)
+    run_id = Column(String, nullable=False, default="default")
 
     image_id = Column(Integer, ForeignKey("image.id"), nullable=False)
     image = relationship("Image", back_populates="copeland_score")
 
-    def __init__(self, img_id, value):
+    def __init__(self, img_id, value, run_id="default"):
         self.image = Images.get_by_id(img_id)
         self.value = value
+        self.run_id = run_id
 
     def __repr__(self):
         return "<Copeland score for image {}: {}>".format(self.image_id, self.value)
@@ -26,6 +30,8 @@ class CopelandScore(Base):
 
 class CopelandScores:
 
+    default_run = "default"
+
     @staticmethod
     def insert(copeland_score):
         try:
@@ -37,16 +43,46 @@ class CopelandScores:
             session.commit()
 
     @staticmethod
-    def get_score_group_by_models(return_statement=False):
+    def upsert(scores_df, run_id=default_run):
         """
-        Calculate the average Copeland score grouped by model.
+        Saves Copeland scores of a run in a single statement. Scores of images that already have a score in the same
+        run are replaced, so rerunning the calculation with the same run id does not create duplicates. Scores saved
+        under other run ids are kept.
 
-        This function queries the database to compute the average Copeland score for images,
-        grouped by the model used to generate them. Only images with a non-empty model name
-        are considered, effectively excluding reference images (which do not have an assigned
-        model name). The results are ordered in descending order of the average Copeland score.
+        :param scores_df: A dataframe with columns `img_id` and `copeland_score`.
+        :param run_id: Identifier of the run the scores belong to.
+        """
+        if len(scores_df) == 0:
+            return
+        records = [
+            {"image_id": int(img_id), "value": float(value), "run_id": run_id}
+            for img_id, value in zip(scores_df["img_id"], scores_df["copeland_score"])
+        ]
+        stmt = insert(CopelandScore)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CopelandScore.image_id, CopelandScore.run_id],
+            set_={"value": stmt.excluded.value}
+        )
+        try:
+            session.execute(stmt, records)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.commit()
+
+    @staticmethod
+    def get_score_group_by_models(return_statement=False, run_id=default_run):
+        """
+        Get the average Copeland score grouped by model.
+
+        Averages are read from the score summaries that are refreshed whenever Copeland scores of a run are calculated,
+        so scores are not aggregated on every call. Only images with a non-empty model name are considered,
+        effectively excluding reference images (which do not have an assigned model name). The results are ordered in
+        descending order of the average Copeland score.
 
         :param return_statement (bool): If True, returns the SQL statement for the query instead of executing it.
+        :param run_id (str): Only the scores saved under this run id are considered.
 
         :return:
             Union[sqlalchemy.sql.elements.TextClause, List[Tuple[str, float]]]:
@@ -55,32 +91,20 @@ class CopelandScores:
                 - model (str): The name of the model.
                 - average_copeland_score (float): The average Copeland score for the model.
         """
-        query = (
-            session.query(
-                Image.model,
-                func.avg(CopelandScore.value)
-            ).join(Image, CopelandScore.image_id == Image.id)
-                .filter(Image.model != "")  # exclude refence images, they are input and thus does not have assigned model name
-                .group_by(Image.model)
-                .order_by(func.avg(CopelandScore.value).desc())
-        )
-        if return_statement:
-            return query.statement
-        else:
-            results = query.all()
-            return results
+        return ScoreSummaries.get_means("cs", "model", run_id=run_id, return_statement=return_statement)
 
     @staticmethod
-    def get_score_group_by_datasets(return_statement=False):
+    def get_score_group_by_datasets(return_statement=False, run_id=default_run):
         """
-        Calculate the average Copeland score grouped by dataset.
+        Get the average Copeland score grouped by dataset.
 
-        This function queries the database to calculate the average Copeland score for each dataset.
-        Images are grouped by their associated dataset, and only images produced by a network
-        (i.e., those with a non-empty model name) are considered. Reference images are excluded
-        as they serve as input images without an assigned model.
+        Averages are read from the score summaries that are refreshed whenever Copeland scores of a run are calculated,
+        so scores are not aggregated on every call. Only images produced by a network (i.e., those with a non-empty
+        model name) are considered. Reference images are excluded as they serve as input images without an assigned
+        model.
 
         :param return_statement (bool): If True, returns the SQL statement for the query instead of executing it.
+        :param run_id (str): Only the scores saved under this run id are considered.
 
         :return:
             Union[sqlalchemy.sql.elements.TextClause, List[Tuple[str, float]]]:
@@ -89,20 +113,7 @@ class CopelandScores:
                 - dataset (str): The dataset name.
                 - average_copeland_score (float): The average Copeland score for the dataset.
         """
-        query = (
-            session.query(
-                Image.dataset,
-                func.avg(CopelandScore.value)
-            ).join(Image, CopelandScore.image_id == Image.id)
-                .filter(Image.model.isnot(None))    # exclude refence images, they are input and thus does not have assigned model name
-                .group_by(Image.dataset)
-                .order_by(func.avg(CopelandScore.value).desc())
-        )
-        if return_statement:
-            return query.statement
-        else:
-            results = query.all()
-            return results
+        return ScoreSummaries.get_means("cs", "dataset", run_id=run_id, return_statement=return_statement)
 
     @staticmethod
     def get_score_group_by_observers(return_statement=False):
@@ -213,8 +213,8 @@ class Images:
                     else:
                         logger.warning(f"[WARNING] The image on path '{img.fullpath}' does not exist, so it cannot "
                                        f"be stored in a database.")
-        # image loading for questionnaire type 2
-        elif qtype == 2:
+        # image loading for questionnaire types 2 and 3, which use the same image groups
+        elif qtype in [2, 3]:
             images = list()
             for img_path in img_paths:
                 if img_path.suffix.lower() in extensions:
@@ -349,6 +349,15 @@ class Images:
             logger.warning(f"Image with ID {iid} could not be found in a database.")
         return r
 
+    @staticmethod
+    def get_by_ids(iids):
+        """
+        Get images from database by a collection of ids.
+        """
+        if len(iids) == 0:
+            return []
+        return session.query(Image).where(Image.id.in_(list(iids))).all()
+
     @staticmethod
     def get_original_for_segmap(segmap):
         """
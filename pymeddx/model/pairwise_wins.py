@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from utils.database import Base, session
+
+from sqlalchemy import Column, ForeignKey, func
+from sqlalchemy import Integer
+from sqlalchemy.dialects.sqlite import insert
+
+
+class PairwiseWin(Base):
+    """
+    Number of times each image of a compared pair was chosen over the other one, summed over all observers. Pairs are
+    stored once, with `image_a_id` lower than `image_b_id`. `n_compared` is the number of comparisons of the pair,
+    including comparisons in which neither image was chosen.
+    """
+    __tablename__ = "pairwise_wins"
+
+    group_id   = Column(Integer, primary_key=True)
+    image_a_id = Column(Integer, ForeignKey("image.id"), primary_key=True)
+    image_b_id = Column(Integer, ForeignKey("image.id"), primary_key=True)
+    wins_a     = Column(Integer, nullable=False, default=0)
+    wins_b     = Column(Integer, nullable=False, default=0)
+    n_compared = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<Pairwise wins in group {} (image {}: {}, image {}: {})>".format(
+            self.group_id, self.image_a_id, self.wins_a, self.image_b_id, self.wins_b
+        )
+
+
+class PairwiseWins:
+
+    @staticmethod
+    def add(comparisons):
+        """
+        Adds outcomes of pairwise comparisons to the win counts in a single statement. Counts of pairs that are
+        already in the table are incremented, so importing responses of one more observer only touches the pairs that
+        observer compared.
+
+        :param comparisons: A dataframe with columns `group_id`, `img1_id`, `img2_id` and `choice`, one row per
+            comparison.
+        """
+        if len(comparisons) == 0:
+            return
+        img1, img2 = comparisons["img1_id"].to_numpy(), comparisons["img2_id"].to_numpy()
+        outcomes = pd.DataFrame({
+            "group_id": comparisons["group_id"].to_numpy(),
+            "image_a_id": np.minimum(img1, img2),
+            "image_b_id": np.maximum(img1, img2),
+        })
+        outcomes["wins_a"] = (comparisons["choice"].to_numpy() == outcomes["image_a_id"].to_numpy()).astype(int)
+        outcomes["wins_b"] = (comparisons["choice"].to_numpy() == outcomes["image_b_id"].to_numpy()).astype(int)
+        outcomes["n_compared"] = 1
+        counts = outcomes.groupby(["group_id", "image_a_id", "image_b_id"], as_index=False)[
+            ["wins_a", "wins_b", "n_compared"]
+        ].sum()
+
+        records = [
+            {key: int(value) for key, value in record.items()}
+            for record in counts.to_dict(orient="records")
+        ]
+        stmt = insert(PairwiseWin)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[PairwiseWin.group_id, PairwiseWin.image_a_id, PairwiseWin.image_b_id],
+            set_={
+                "wins_a": PairwiseWin.wins_a + stmt.excluded.wins_a,
+                "wins_b": PairwiseWin.wins_b + stmt.excluded.wins_b,
+                "n_compared": PairwiseWin.n_compared + stmt.excluded.n_compared
+            }
+        )
+        try:
+            session.execute(stmt, records)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.commit()
+
+    @staticmethod
+    def rebuild(comparisons):
+        """
+        Replaces all win counts with counts of the given comparisons.
+
+        :param comparisons: All pairwise comparisons, see `add`.
+        """
+        try:
+            session.query(PairwiseWin).delete()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.commit()
+        PairwiseWins.add(comparisons)
+
+    @staticmethod
+    def count_comparisons():
+        """
+        :return: Total number of comparisons the win counts were calculated from.
+        """
+        return session.query(func.coalesce(func.sum(PairwiseWin.n_compared), 0)).scalar()
+
+    @staticmethod
+    def get_all(return_statement=False):
+        """
+        :param return_statement: If True, returns the SQL statement for the query instead of executing it.
+        :return: Win counts of all compared pairs.
+        """
+        query = session.query(
+            PairwiseWin.group_id,
+            PairwiseWin.image_a_id,
+            PairwiseWin.image_b_id,
+            PairwiseWin.wins_a,
+            PairwiseWin.wins_b,
+            PairwiseWin.n_compared
+        ).order_by(
+            PairwiseWin.group_id,
+            PairwiseWin.image_a_id,
+            PairwiseWin.image_b_id
+        )
+        if return_statement:
+            return query.statement
+        return query.all()
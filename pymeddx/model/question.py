@@ -2,12 +2,13 @@ import base64
 import random
 import itertools
 import json
+import math
 import localization.locale
 from PIL import Image as PillowImage
 
 from datetime import datetime
 from pathlib import Path
-from sqlalchemy import Column, Integer, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, DateTime, Text, ForeignKey, Boolean, Table
 from sqlalchemy.orm import relationship
 from sqlalchemy import and_
 from string import Template
@@ -17,6 +18,13 @@ from utils.logger import logger
 from utils.tools import minify_json, fisher_yates_shuffle
 from model.image import Images
 from model.diagnosis import Diagnoses
+from generators.assets import SurveyAssets
+
+
+# candidate images ranked in a type 3 question
+qtype3_image = Table('qtype3_image', Base.metadata,
+                     Column("question_id", Integer, ForeignKey("qtype3.id")),
+                     Column("image_id", Integer, ForeignKey("image.id")))
 
 
 class Question(Base):
@@ -70,11 +78,21 @@ class QuestionType1(Question):
             "None" if self.image is None else self.image.filename
         )
 
-    def generate(self):
+    def generate(self, linked=False):
+        """
+        Generate JSON for a single survey question.
+
+        :param linked: If True, question JSON stores only an image placeholder instead of the base64 encoded image.
+            The placeholder is resolved from the image store during survey export.
+        """
         if self.image is not None:
+            if linked:
+                imhash = SurveyAssets.placeholder(self.image)
+            else:
+                imhash = self.image.encode_to_base64()
             question_json = QuestionType1._get_question_template().substitute({
                 "quid": self.id,
-                "imhash": "base64://" + self.image.encode_to_base64(),  # prefix base64:// is requred for cornerstone loading
+                "imhash": "base64://" + imhash,  # prefix base64:// is requred for cornerstone loading
                 "questions": QuestionType1._get_questions()
             })
             self.json = minify_json(question_json)
@@ -158,7 +176,7 @@ class QuestionType2(Question):
     group        = Column(Integer)
     is_redundant = Column(Boolean, nullable=False, default=False)
 
-    ref_question_id = Column(Integer, ForeignKey("qtype2.id"), nullable=True)
+    ref_question_id = Column(Integer, ForeignKey("qtype2.id"), nullable=True, index=True)
 
     im1_id = Column(Integer, ForeignKey("image.id"))    # comparison image id 1
     im2_id = Column(Integer, ForeignKey("image.id"))    # comparison image id 2
@@ -190,21 +208,29 @@ class QuestionType2(Question):
                 "None" if self.im2 is None else str(self.im2_id)
             )
 
-    def generate(self):
+    def generate(self, linked=False):
         """
         Generate JSON for a single survey question.
+
+        :param linked: If True, question JSON stores only image placeholders instead of the base64 encoded images.
+            The placeholders are resolved from the image store during survey export.
         :return:
         """
         if self.im0 is not None and self.im1 is not None and self.im2 is not None:
             im1path = str(Path(self.im1.root) / self.im1.filename)
             im2path = str(Path(self.im2.root) / self.im2.filename)
             im0path = str(Path(self.im0.root) / self.im0.filename)
-            with open(im1path, "rb") as im1f:
-                im1hash = "data:image/png;base64," + base64.b64encode(im1f.read()).decode('utf-8')
-            with open(im2path, "rb") as im2f:
-                im2hash = "data:image/png;base64," + base64.b64encode(im2f.read()).decode('utf-8')
-            with open(im0path, "rb") as im0f:
-                im0hash = "data:image/png;base64," + base64.b64encode(im0f.read()).decode('utf-8')
+            if linked:
+                im1hash = "data:image/png;base64," + SurveyAssets.placeholder(self.im1)
+                im2hash = "data:image/png;base64," + SurveyAssets.placeholder(self.im2)
+                im0hash = "data:image/png;base64," + SurveyAssets.placeholder(self.im0)
+            else:
+                with open(im1path, "rb") as im1f:
+                    im1hash = "data:image/png;base64," + base64.b64encode(im1f.read()).decode('utf-8')
+                with open(im2path, "rb") as im2f:
+                    im2hash = "data:image/png;base64," + base64.b64encode(im2f.read()).decode('utf-8')
+                with open(im0path, "rb") as im0f:
+                    im0hash = "data:image/png;base64," + base64.b64encode(im0f.read()).decode('utf-8')
             image_width, image_height = PillowImage.open(im1path).size
             question_json = QuestionType2._get_question_template().substitute({
                 "quid": self.id,
@@ -282,8 +308,149 @@ class QuestionType2(Question):
         return template
 
 
+class QuestionType3(Question):
+    """
+    Question that shows a reference image and k candidate images of the same image group, and asks an observer to rank
+    the candidates. A single ranking of k candidates implies k(k-1)/2 pairwise comparisons, so it replaces that many type
+    2 questions, while each image is embedded into the question only once.
+    """
+    __tablename__ = "qtype3"
+    __mapper_args__ = {'polymorphic_identity': 3}
+
+    id           = Column(Integer, ForeignKey("question.id"), primary_key=True)
+    group        = Column(Integer)
+    is_redundant = Column(Boolean, nullable=False, default=False)
+
+    ref_question_id = Column(Integer, ForeignKey("qtype3.id"), nullable=True, index=True)
+
+    im0_id = Column(Integer, ForeignKey("image.id"))    # reference image id
+
+    im0 = relationship("Image", foreign_keys=[im0_id])  # reference image
+    candidates = relationship("Image", secondary=qtype3_image, order_by="Image.id")  # ranked images
+
+    responses = relationship("ResponseType3", back_populates="question")
+
+    def __init__(self, gid, ref_im0, candidates, is_redundant=False, ref_question_id=None):
+        super(QuestionType3, self).__init__()
+        self.group = gid
+        self.is_redundant = is_redundant
+        self.ref_question_id = ref_question_id
+        self.im0 = ref_im0
+        self.im0_id = self.im0.id
+        self.candidates = list(candidates)
+
+    def __repr__(self):
+        return super().__repr__() + \
+            "\n<QuestionType3 (reference_image: '{}', candidate image ids: '{}')>".format(
+                "None" if self.im0 is None else str(self.im0_id),
+                [image.id for image in self.candidates]
+            )
+
+    def generate(self, linked=False):
+        """
+        Generate JSON for a single survey question.
+
+        :param linked: If True, question JSON stores only image placeholders instead of the base64 encoded images.
+            The placeholders are resolved from the image store during survey export.
+        """
+        if self.im0 is None or len(self.candidates) < 2:
+            logger.error(f"Cannot generate question {self.id} because it does not have a reference image or at least "
+                         f"two candidate images.")
+            raise ValueError(f"Cannot generate question {self.id} because it does not have a reference image or at "
+                             f"least two candidate images.")
+
+        locale = localization.locale.get_locale_data()
+        # candidates are shown in random order, so that the order does not suggest a ranking
+        candidates = fisher_yates_shuffle(list(self.candidates))
+        image_choices, rank_choices = list(), list()
+        for i, image in enumerate(candidates):
+            image_choices.append(Template("""{
+                value: "im$imid",
+                text: "$label",
+                imageLink: "$imhash"
+            }""").substitute({
+                "imid": image.id,
+                "label": f"{locale['candidate_label']} {i + 1}",
+                "imhash": QuestionType3._encode(image, linked)
+            }))
+            rank_choices.append(Template("""{
+                value: "im$imid",
+                text: "$label"
+            }""").substitute({"imid": image.id, "label": f"{locale['candidate_label']} {i + 1}"}))
+
+        question_json = QuestionType3._get_question_template().substitute({
+            "quid": self.id,
+            "im0hash": QuestionType3._encode(self.im0, linked),
+            "image_choices": ",".join(image_choices),
+            "rank_choices": ",".join(rank_choices)
+        })
+        self.json = minify_json(question_json)
+
+    @staticmethod
+    def _encode(image, linked):
+        if linked:
+            return "data:image/png;base64," + SurveyAssets.placeholder(image)
+        with open(image.fullpath, "rb") as imf:
+            return "data:image/png;base64," + base64.b64encode(imf.read()).decode('utf-8')
+
+    @staticmethod
+    def _get_questions():
+        raise NotImplementedError
+
+    @staticmethod
+    def _get_question_template():
+        # $quid          - question id
+        # $im0hash       - base64 hash of the reference image
+        # $image_choices - candidate images, one imagepicker choice per candidate
+        # $rank_choices  - ranking choices, one per candidate
+        locale = localization.locale.get_locale_data()
+        template = Template(f"""
+            elements: [
+                {{
+                    type: "imagepicker",
+                    name: "s^_^-q$quid-img",
+                    title: "{locale["reference_image"]}",
+                    hideNumber: true,
+                    choices: [
+                    {{
+                        value: "original",
+                        imageLink: "$im0hash"
+                    }}
+                    ],
+                    startWithNewLine: true,
+                    readOnly: true,
+                    imageTag: "original"
+                }},
+                {{
+                    type: "imagepicker",
+                    name: "s^_^-q$quid-candidates",
+                    title: "{locale["candidates_title"]}",
+                    hideNumber: true,
+                    showLabel: true,
+                    choices: [$image_choices],
+                    startWithNewLine: false,
+                    readOnly: true,
+                    imageTag: "candidates"
+                }},
+                {{
+                    type: "ranking",
+                    name: "s^_^-q$quid-ranking",
+                    title: "{locale["ranking_title"]}",
+                    hideNumber: true,
+                    choices: [$rank_choices],
+                    isRequired: true,
+                    requiredErrorText: "{locale["error_text"]}",
+                    startWithNewLine: true
+                }}
+            ]
+        """)
+        return template
+
+
 class Questions:
 
+    supported_storage = ["inline", "linked"]
+
     @staticmethod
     def insert(question):
         raise NotImplementedError
@@ -327,6 +494,9 @@ class Questions:
         if qtype == 1:
             with session.no_autoflush:
                 return session.query(QuestionType1).get(qid)
+        elif qtype == 3:
+            with session.no_autoflush:
+                return session.query(QuestionType3).get(qid)
         else:
             with session.no_autoflush:
                 return session.query(QuestionType2).get(qid)
@@ -374,14 +544,15 @@ class Questions:
                       .all()
 
     @staticmethod
-    def get_by_image_group(gid, unassigned=True):
+    def get_by_image_group(gid, unassigned=True, qtype=2):
+        question_class = QuestionType3 if qtype == 3 else QuestionType2
         if unassigned:
             # return all questions of the same group that are not already attached to some of the surveys
-            questions = session.query(QuestionType2).where(QuestionType2.group == gid).all()
+            questions = session.query(question_class).where(question_class.group == gid).all()
             return [q for q in questions if q.regular_survey is None]
         else:
             # return all questions of the same group
-            return session.query(QuestionType2).where(QuestionType2.group == gid).all()
+            return session.query(question_class).where(question_class.group == gid).all()
 
     @staticmethod
     def get_by_survey(sid):
@@ -401,7 +572,8 @@ class Questions:
 
 
     @staticmethod
-    def generate_questions_t2(gid, image_group, n_repeat, redundancy=50, n_redundancy=1, flip_images=True):
+    def generate_questions_t2(gid, image_group, n_repeat, redundancy=50, n_redundancy=1, flip_images=True,
+                              pairs=None):
         """
 
         :param gid:
@@ -409,12 +581,17 @@ class Questions:
         :param n_repeat:
         :param redundancy: Should be in percentages. How many questions will be repeated to create redundancy. It should
             be between 0 and 100.
+        :param pairs: A list of image pairs to generate questions for. If not specified, questions are generated for
+            all pairs of images in a group.
         :return:
         """
 
-        # generate all combinations of images in a group
-        # it will be total of 28 image pairs for a group of 8 images
-        image_group = [i for i in itertools.combinations(iterable=image_group, r=2)]
+        if pairs is None:
+            # generate all combinations of images in a group
+            # it will be total of 28 image pairs for a group of 8 images
+            image_group = [i for i in itertools.combinations(iterable=image_group, r=2)]
+        else:
+            image_group = list(pairs)
 
         # repeat some pairs to create redundancy, number of pairs is determined according to the redundancy parameter
         # which represents a percent of pairs to be repeated
@@ -489,7 +666,71 @@ class Questions:
         return questions
 
     @staticmethod
-    def generate(qtype, n_repeat, image_names=None):
+    def generate_questions_t3(gid, image_group, ranking_size=None, redundancy=50):
+        """
+        Generates type 3 questions for an image group. Images of the group are split into rankings of `ranking_size`
+        images. If the group has more images than `ranking_size`, images are placed on a circle in random order and
+        split into consecutive blocks, where each two neighbouring blocks share one image, so that all images of the
+        group are connected by comparisons.
+
+        :param gid: Image group id.
+        :param image_group: Images of the group.
+        :param ranking_size: Number of images ranked in a single question. If not specified, all images of the group
+            are ranked in a single question.
+        :param redundancy: Should be in percentages. How many questions will be repeated to create redundancy. It should
+            be between 0 and 100. The number of repeated questions is rounded up, so a group with a single ranking
+            is repeated as well.
+        :return: A list of generated questions.
+        """
+        ranking_size = len(image_group) if ranking_size is None else min(ranking_size, len(image_group))
+        if ranking_size < 2:
+            logger.error(f"Cannot generate ranking questions for group {gid} of {len(image_group)} images with ranking "
+                         f"size {ranking_size}. At least two images must be ranked in each question.")
+            raise ValueError(f"Cannot generate ranking questions for group {gid} of {len(image_group)} images with "
+                             f"ranking size {ranking_size}. At least two images must be ranked in each question.")
+        assert 0 <= redundancy <= 100
+
+        order = fisher_yates_shuffle(list(image_group))
+        if ranking_size == len(order):
+            blocks = [order]
+        else:
+            blocks = [
+                [order[(start + i) % len(order)] for i in range(ranking_size)]
+                for start in range(0, len(order) - 1, ranking_size - 1)
+            ]
+
+        # get original image for a segmentation mask group
+        original = Images.get_original_for_segmap(image_group[0])
+
+        # GENERATE REGULAR QUESTIONS
+        questions = list()
+        for i, block in enumerate(blocks):
+            questions.append(QuestionType3(gid=gid, ref_im0=original, candidates=block))
+            logger.debug(f"Question {i} ranks images {[image.id for image in block]} (non-redundant).")
+        Questions.bulk_insert(questions)
+        logger.debug(f"Inserted {len(questions)} questions to the database.")
+
+        # GENERATE REPEATED QUESTIONS
+        iindices = random.sample(range(0, len(questions)), math.ceil(redundancy * len(questions) / 100))
+        duplicates = list()
+        for idx in iindices:
+            duplicates.append(QuestionType3(
+                gid=gid,
+                is_redundant=True,
+                ref_question_id=questions[idx].id,
+                ref_im0=original,
+                candidates=questions[idx].candidates
+            ))
+            logger.debug(f"Question {idx} ranks images {[image.id for image in blocks[idx]]} (redundant).")
+        duplicates = fisher_yates_shuffle(duplicates)
+        Questions.bulk_insert(duplicates)
+        logger.debug(f"Inserted {len(duplicates)} duplicates to the database.")
+        questions.extend(duplicates)
+
+        return fisher_yates_shuffle(questions)
+
+    @staticmethod
+    def generate(qtype, n_repeat, image_names=None, storage="inline", pairs=None, ranking_size=None):
         """
         Generate questions of a given type for a given set of images. If set of images
         is specified, it must be provided as a list of image filenames. If not specified
@@ -499,16 +740,30 @@ class Questions:
             values are:
                 1 - question type for an experiment 1
                 2 - question type for an experiment 2
+                3 - ranking question type for an experiment 2
         :param n_repeat: An integer that specifies how many times will each image from the image group be
             repeated when generating questions.
         :param image_names: A list of string representing image filenames with extension. Filenames
             are case sensitive.
+        :param storage: How images are stored in question JSON. If `inline`, question JSON contains base64 encoded
+            images. If `linked`, question JSON contains only image placeholders which are resolved from the image
+            store during survey export.
+        :param pairs: Only for type 2 questions. A dictionary mapping image group id to a list of image pairs to
+            generate questions for. Groups that are not in the dictionary are skipped. If not specified, questions are
+            generated for all pairs of images in each group.
+        :param ranking_size: Only for type 3 questions. Number of images ranked in a single question. If not specified,
+            all images of a group are ranked in a single question.
         :return: A list of generated questions.
         """
         logger.info(f"Generating questions of type {qtype}.")
-        if qtype not in [1, 2]:
-            logger.error(f"Cannot generate question of type {qtype}. Valid question types are 1, 2.")
-            raise ValueError(f"Cannot generate question of type {qtype}. Valid question types are 1, 2.")
+        if qtype not in [1, 2, 3]:
+            logger.error(f"Cannot generate question of type {qtype}. Valid question types are 1, 2, 3.")
+            raise ValueError(f"Cannot generate question of type {qtype}. Valid question types are 1, 2, 3.")
+        if storage not in Questions.supported_storage:
+            logger.error(f"Unsupported question storage mode '{storage}'. Supported modes are "
+                         f"{Questions.supported_storage}.")
+            raise ValueError(f"Unsupported question storage mode '{storage}'. Supported modes are "
+                             f"{Questions.supported_storage}.")
 
         questions = list()
         if qtype == 1:
@@ -523,7 +778,7 @@ class Questions:
                 qt.image = image
                 questions.append(qt)
             Questions.bulk_insert(questions=questions)
-        elif qtype == 2:
+        elif qtype in [2, 3]:
             min_group_id = Images.get_min_image_group()
             if min_group_id is None:
                 logger.error(f"Skipping question generation because there are no groups associated with the "
@@ -537,12 +792,22 @@ class Questions:
                 if image_group is None:
                     logger.error(f"There are no images associated with a group {gid}. Aborting.")
                     raise ValueError(f"There are no images associated with a group {gid}. Aborting.")
-                qt = Questions.generate_questions_t2(gid, image_group, n_repeat)
+                if qtype == 3:
+                    questions.extend(Questions.generate_questions_t3(gid, image_group, ranking_size=ranking_size))
+                    continue
+                group_pairs = None if pairs is None else pairs.get(gid, [])
+                if group_pairs is not None and len(group_pairs) == 0:
+                    logger.info(f"There are no image pairs to compare in group {gid}. Skipping.")
+                    continue
+                qt = Questions.generate_questions_t2(gid, image_group, n_repeat, pairs=group_pairs)
                 questions.extend(qt)
 
-            n_model = len(Images.get_whole_group(min_group_id))
-            n_images = max_group_id - min_group_id + 1
-            ssize_inter = n_images * (n_model * (n_model - 1)) // 2
+            # each ranking of k images is analyzed as k(k-1)/2 pairwise comparisons
+            if qtype == 3:
+                ssize_inter = sum(len(q.candidates) * (len(q.candidates) - 1) // 2
+                                  for q in questions if not q.is_redundant)
+            else:
+                ssize_inter = sum(1 for question in questions if not question.is_redundant)
 
             logger.info("")
             logger.info("*" * 100)
@@ -566,7 +831,7 @@ class Questions:
         # logger.debug(f"Inserted {len(questions)} questions to the database.")
 
         # this step must come after the questions are inserted into the database because generation required question id
-        [question.generate() for question in questions]
+        [question.generate(linked=(storage == "linked")) for question in questions]
 
         # update the database to reflect changes in json field
         session.commit()
@@ -1,3 +1,4 @@
+import itertools
 import json
 import logging
 import re
@@ -6,14 +7,18 @@ from datetime import datetime
 from collections import defaultdict
 from pathlib import Path
 
+import pandas as pd
+
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy import Integer, SmallInteger, DateTime, Boolean
 from sqlalchemy.orm import relationship
 
 from utils.database import Base, session
+from utils.logger import logger
 from model.question import Questions
 from model.observer import Observers
 from model.survey import Surveys
+from model.pairwise_wins import PairwiseWins
 
 
 class Response(Base):
@@ -28,7 +33,7 @@ class Response(Base):
 
     survey_id   = Column(Integer, ForeignKey("survey.id"), nullable=False)
     survey      = relationship("Survey", back_populates="responses")
-    observer_id = Column(Integer, ForeignKey("observer.id"), nullable=False)
+    observer_id = Column(Integer, ForeignKey("observer.id"), nullable=False, index=True)
     observer    = relationship("Observer", back_populates="responses")
 
     __tablename__ = "response"
@@ -64,7 +69,7 @@ class ResponseType1(Response):
     response    = Column(SmallInteger, nullable=True)
     certainty   = Column(SmallInteger, nullable=False)
 
-    question_id      = Column(Integer, ForeignKey("qtype1.id"), nullable=False)
+    question_id      = Column(Integer, ForeignKey("qtype1.id"), nullable=False, index=True)
     question         = relationship("QuestionType1", back_populates="responses")
 
     # diagnostic_score_id = Column(Integer, ForeignKey("diagnostic_score.id"), nullable=True)
@@ -107,7 +112,7 @@ class ResponseType2(Response):
     id = Column(Integer, ForeignKey("response.id"), primary_key=True)
     choice = Column(SmallInteger, nullable=True)
 
-    question_id = Column(Integer, ForeignKey("qtype2.id"), nullable=False)
+    question_id = Column(Integer, ForeignKey("qtype2.id"), nullable=False, index=True)
     question = relationship("QuestionType2", back_populates="responses")
 
     img1_id = Column(Integer, ForeignKey('image.id'), nullable=False)
@@ -150,6 +155,87 @@ class ResponseType2(Response):
         )
 
 
+class ResponseType3(Response):
+    """
+    A pairwise outcome implied by a ranking given in response to a type 3 question. A ranking of k images is stored as
+    k(k-1)/2 responses, one per pair of ranked images, where the choice is the higher ranked image of the pair. The
+    outcomes have the same form as type 2 responses, so rankings are analyzed in the same way as pairwise comparisons.
+    """
+    __tablename__ = "rtype3"
+    __mapper_args__ = {
+        'polymorphic_identity': 3
+    }
+
+    id = Column(Integer, ForeignKey("response.id"), primary_key=True)
+    choice = Column(SmallInteger, nullable=True)
+
+    question_id = Column(Integer, ForeignKey("qtype3.id"), nullable=False, index=True)
+    question = relationship("QuestionType3", back_populates="responses")
+
+    img1_id = Column(Integer, ForeignKey('image.id'), nullable=False)
+    img2_id = Column(Integer, ForeignKey('image.id'), nullable=False)
+
+    def __init__(self, survey_id, question_id, observer_id, choice, is_redundant, img1_id, img2_id, created=None):
+        super(ResponseType3, self).__init__(
+            survey_id=survey_id,
+            observer_id=observer_id,
+            created=created,
+            is_redundant=is_redundant
+        )
+        self.choice = choice
+        self.question_id = int(question_id)
+        self.img1_id = int(img1_id)
+        self.img2_id = int(img2_id)
+
+    def __repr__(self):
+        return "<Response (question_id: '{}', given by observer: '{}' in survey '{}', type: '{}', " \
+               "choice: '{}'). Associated with images '{}' and '{}'>".format(
+                self.question_id,
+                self.observer.name,
+                self.survey_id,
+                self.type,
+                self.choice,
+                self.img1_id,
+                self.img2_id
+        )
+
+    @staticmethod
+    def from_ranking(survey_id, question, observer_id, ranking, created=None):
+        """
+        Expands a ranking into implied pairwise outcomes.
+
+        :param survey_id: Id of the survey the ranking was given in.
+        :param question: The ranked QuestionType3.
+        :param observer_id: Id of the observer who gave the ranking.
+        :param ranking: Ids of the ranked images, from the highest to the lowest ranked.
+        :param created: Time the ranking was given.
+        :return: A list of responses, one per pair of candidates of the question. Pairs are ordered by image ids, so
+            that responses of different observers to the same question are aligned.
+        """
+        candidate_ids = [image.id for image in question.candidates]
+        if sorted(ranking) != sorted(candidate_ids):
+            logger.error(f"Ranking {ranking} given to question {question.id} does not rank exactly the images "
+                         f"{candidate_ids} of the question.")
+            raise ValueError(f"Ranking {ranking} given to question {question.id} does not rank exactly the images "
+                             f"{candidate_ids} of the question.")
+
+        position = {image_id: i for i, image_id in enumerate(ranking)}
+        with session.no_autoflush:
+            return [
+                ResponseType3(
+                    survey_id=survey_id,
+                    question_id=question.id,
+                    observer_id=observer_id,
+                    choice=img1_id if position[img1_id] < position[img2_id] else img2_id,
+                    is_redundant=question.is_redundant,
+                    img1_id=img1_id,
+                    img2_id=img2_id,
+                    created=created
+                )
+                for img1_id, img2_id in itertools.combinations(candidate_ids, r=2)
+            ]
+
+
 class Responses:
 
     @staticmethod
@@ -166,6 +252,8 @@ class Responses:
     def get_all_responses(type):
         if type == 1:
             responses = session.query(ResponseType1).all()
+        elif type == 3:
+            responses = session.query(ResponseType3).all()
         else:
             responses = session.query(ResponseType2).all()
         return responses
@@ -253,12 +341,53 @@ class Responses:
                     certainty=certainty
                 )
                 Responses.insert(response)
+        elif qtype == 3:
+            # dictionary is in the following format, where rankings list images from the highest to the lowest ranked
+            # {
+            #   's1-q1-ranking': ['im4', 'im2', 'im7'],
+            #   's1-q2-ranking': ['im5', 'im3', 'im6'],
+            # }
+            pattern = r"s(?P<survey_id>\d+)-q(?P<question_id>\d+)-ranking"
+
+            comparisons = list()
+            for key, value in responses.items():
+                match = re.fullmatch(pattern, key)
+                if match is None:
+                    continue
+                question_id = int(match.group('question_id'))
+                question = Questions.get_by_id(question_id, qtype=3)
+                if question is None:
+                    logger.error(f"Response file '{file}' has a ranking for question {question_id} that does not "
+                                 f"exist in the database.")
+                    raise ValueError(f"Response file '{file}' has a ranking for question {question_id} that does "
+                                     f"not exist in the database.")
+
+                ranking = [int(choice.replace('im', '')) for choice in value]
+                implied = ResponseType3.from_ranking(
+                    survey_id=int(match.group('survey_id')),
+                    question=question,
+                    observer_id=observer_id,
+                    ranking=ranking,
+                    created=happened_at
+                )
+                try:
+                    session.add_all(implied)
+                except:
+                    session.rollback()
+                    raise
+                finally:
+                    session.commit()
+                comparisons.extend((question.group, r.img1_id, r.img2_id, r.choice) for r in implied)
+
+            # keep win counts of image pairs up to date, so that rankings are not recomputed from all responses
+            PairwiseWins.add(pd.DataFrame(comparisons, columns=["group_id", "img1_id", "img2_id", "choice"]))
         else:
             # Regular expression pattern to match the required components
             pattern = r"s(?P<survey_id>\d+)-q(?P<question_id>\d+)-im(?P<image1_id>\d+)-im(?P<image2_id>\d+)-.*"
 
             # A set with identifiers of already inserted responses
             response_lookup = set()
+            comparisons = list()
 
             for key, value in responses.items():
                 match = re.match(pattern, key)
@@ -290,5 +419,11 @@ class Responses:
                     created=happened_at
                 )
                 Responses.insert(response)
+                choice = value.replace('im', '')
+                comparisons.append((response.question.group, int(image1_id), int(image2_id),
+                                    int(choice) if choice.isdigit() else None))
+
+            # keep win counts of image pairs up to date, so that rankings are not recomputed from all responses
+            PairwiseWins.add(pd.DataFrame(comparisons, columns=["group_id", "img1_id", "img2_id", "choice"]))
 
 
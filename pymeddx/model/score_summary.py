@@ -0,0 +1,273 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+
+from utils.database import Base, session
+
+from sqlalchemy import Column, UniqueConstraint
+from sqlalchemy import DateTime, Float, Integer, String, Text
+from sqlalchemy.dialects.sqlite import insert
+
+
+class ScoreSummary(Base):
+    """
+    Precomputed summary of scores of one metric, e.g. diagnostic scores of one observer or Copeland scores of images
+    produced by one model.
+
+    Besides the count, mean and the sum of squared deviations from the mean (`m2`), the summary stores the number of
+    occurrences of each distinct score (`histogram`). Scores of both metrics take only a few distinct values (integers
+    from -5 to 5 for diagnostic scores, multiples of 0.5 for Copeland scores), so the histogram is an exact quantile
+    sketch. Summaries of disjoint sets of scores can be merged without reading the scores again.
+    """
+    __tablename__ = "score_summary"
+    __table_args__ = (UniqueConstraint("metric", "run_id", "level", "key"),)
+
+    id         = Column(Integer, primary_key=True, autoincrement=True)
+    metric     = Column(String, nullable=False)
+    run_id     = Column(String, nullable=False, default="default")
+    level      = Column(String, nullable=False)
+    key        = Column(String, nullable=False)
+    count      = Column(Integer, nullable=False)
+    mean       = Column(Float, nullable=False)
+    m2         = Column(Float, nullable=False)
+    histogram  = Column(Text, nullable=False)     # json list of [score, count] pairs sorted by score
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<Summary of '{}' scores (run: '{}', {}: '{}', count: {}, mean: {})>".format(
+            self.metric, self.run_id, self.level, self.key, self.count, self.mean
+        )
+
+    @property
+    def variance(self):
+        """
+        Sample variance of the scores.
+        """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def distribution(self):
+        """
+        :return: A tuple (values, counts) of arrays with the distinct scores in ascending order and their counts.
+        """
+        values, counts = zip(*json.loads(self.histogram))
+        return np.asarray(values, dtype=float), np.asarray(counts, dtype=int)
+
+    def quantile(self, q):
+        """
+        Calculates a quantile of the scores from the histogram, with the same linear interpolation as `numpy.quantile`.
+
+        :param q: Quantile to calculate, between 0 and 1.
+        """
+        values, counts = self.distribution()
+        ends = np.cumsum(counts)
+        position = (self.count - 1) * q
+        lower = values[np.searchsorted(ends, np.floor(position), side="right")]
+        upper = values[np.searchsorted(ends, np.ceil(position), side="right")]
+        return lower + (upper - lower) * (position - np.floor(position))
+
+
+class ScoreSummaries:
+
+    default_run = "default"
+
+    # summary levels and the score columns that identify a summary on each level, "all" summarizes all scores
+    levels = {
+        "all": None,
+        "image": "image_id",
+        "model": "model",
+        "dataset": "dataset",
+        "observer": "observer_id",
+    }
+
+    @staticmethod
+    def summarize(scores):
+        """
+        Summarizes scores on every level for which the scores have an identifying column. Scores without a key on a
+        level, e.g. reference images without a model name, are left out of that level.
+
+        :param scores: A dataframe with the column `value` and any of the columns in `levels`.
+        :return: A list of summary records with keys `level`, `key`, `count`, `mean`, `m2` and `histogram`, where the
+            histogram is a dictionary mapping scores to their counts.
+        """
+        records = list()
+        for level, column in ScoreSummaries.levels.items():
+            if column is None:
+                keys = pd.Series("all", index=scores.index)
+            elif column in scores.columns:
+                keys = scores[column]
+                valid = keys.notna() & (keys.astype(str) != "")
+                keys = keys[valid].astype(str)
+            else:
+                continue
+
+            values = scores.loc[keys.index, "value"].astype(float)
+            if len(values) == 0:
+                continue
+            grouped = values.groupby(keys)
+            stats = pd.DataFrame({"count": grouped.count(), "mean": grouped.mean(), "m2": grouped.var(ddof=0)})
+            stats["m2"] *= stats["count"]
+            histograms = values.groupby([keys, values]).size()
+            for key, row in stats.iterrows():
+                records.append({
+                    "level": level,
+                    "key": key,
+                    "count": int(row["count"]),
+                    "mean": float(row["mean"]),
+                    "m2": float(row["m2"]),
+                    "histogram": {float(value): int(count) for value, count in histograms.loc[key].items()}
+                })
+        return records
+
+    @staticmethod
+    def add(scores, metric, run_id=default_run):
+        """
+        Merges summaries of new scores into the stored summaries, so the stored summaries are refreshed without
+        reading the scores that were summarized before. Means and sums of squared deviations are merged using the
+        parallel algorithm of Chan et al., and histograms are added.
+
+        :param scores: New scores, see `summarize`.
+        :param metric: Metric the scores belong to, e.g. `dv` or `cs`.
+        :param run_id: Identifier of the run the scores belong to.
+        """
+        records = ScoreSummaries.summarize(scores)
+        if len(records) == 0:
+            return
+
+        stored = {
+            (summary.level, summary.key): summary
+            for summary in session.query(ScoreSummary).where(
+                ScoreSummary.metric == metric,
+                ScoreSummary.run_id == run_id
+            )
+        }
+        for record in records:
+            summary = stored.get((record["level"], record["key"]))
+            if summary is None:
+                continue
+            n_a, n_b = summary.count, record["count"]
+            n = n_a + n_b
+            delta = record["mean"] - summary.mean
+            record["mean"] = summary.mean + delta * n_b / n
+            record["m2"] = summary.m2 + record["m2"] + delta ** 2 * n_a * n_b / n
+            record["count"] = n
+            for value, count in json.loads(summary.histogram):
+                record["histogram"][value] = record["histogram"].get(value, 0) + count
+
+        ScoreSummaries._upsert(records, metric, run_id)
+
+    @staticmethod
+    def replace(scores, metric, run_id=default_run):
+        """
+        Replaces all stored summaries of a metric run with summaries of the given scores.
+
+        :param scores: All scores of the run, see `summarize`.
+        :param metric: Metric the scores belong to, e.g. `dv` or `cs`.
+        :param run_id: Identifier of the run the scores belong to.
+        """
+        try:
+            session.query(ScoreSummary).where(
+                ScoreSummary.metric == metric,
+                ScoreSummary.run_id == run_id
+            ).delete()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.commit()
+        ScoreSummaries._upsert(ScoreSummaries.summarize(scores), metric, run_id)
+
+    @staticmethod
+    def _upsert(records, metric, run_id):
+        if len(records) == 0:
+            return
+        updated_at = datetime.now()
+        rows = [
+            {
+                "metric": metric,
+                "run_id": run_id,
+                "level": record["level"],
+                "key": record["key"],
+                "count": record["count"],
+                "mean": record["mean"],
+                "m2": record["m2"],
+                "histogram": json.dumps(sorted([value, count] for value, count in record["histogram"].items())),
+                "updated_at": updated_at
+            }
+            for record in records
+        ]
+        stmt = insert(ScoreSummary)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ScoreSummary.metric, ScoreSummary.run_id, ScoreSummary.level, ScoreSummary.key],
+            set_={column: stmt.excluded[column] for column in ["count", "mean", "m2", "histogram", "updated_at"]}
+        )
+        try:
+            session.execute(stmt, rows)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.commit()
+
+    @staticmethod
+    def count(metric, run_id=default_run):
+        """
+        :return: Number of scores summarized in a metric run.
+        """
+        summary = session.query(ScoreSummary).where(
+            ScoreSummary.metric == metric,
+            ScoreSummary.run_id == run_id,
+            ScoreSummary.level == "all"
+        ).one_or_none()
+        return 0 if summary is None else summary.count
+
+    @staticmethod
+    def get_means(metric, level, run_id=default_run, return_statement=False):
+        """
+        Loads mean scores of a metric run on one level, ordered in descending order.
+
+        :param metric: Metric the scores belong to, e.g. `dv` or `cs`.
+        :param level: One of `levels`.
+        :param run_id: Identifier of the run the scores belong to.
+        :param return_statement: If True, returns the SQL statement for the query instead of executing it.
+        :return: A list of tuples (key, mean score).
+        """
+        query = session.query(
+            ScoreSummary.key.label(level),
+            ScoreSummary.mean
+        ).where(
+            ScoreSummary.metric == metric,
+            ScoreSummary.run_id == run_id,
+            ScoreSummary.level == level
+        ).order_by(
+            ScoreSummary.mean.desc(),
+            ScoreSummary.key
+        )
+        if return_statement:
+            return query.statement
+        return query.all()
+
+    @staticmethod
+    def get(metric, level, run_id=default_run, return_statement=False):
+        """
+        Loads stored summaries of a metric run on one level, ordered by the mean score in descending order.
+
+        :param metric: Metric the scores belong to, e.g. `dv` or `cs`.
+        :param level: One of `levels`.
+        :param run_id: Identifier of the run the scores belong to.
+        :param return_statement: If True, returns the SQL statement for the query instead of executing it.
+        :return: A list of ScoreSummary objects.
+        """
+        query = session.query(ScoreSummary).where(
+            ScoreSummary.metric == metric,
+            ScoreSummary.run_id == run_id,
+            ScoreSummary.level == level
+        ).order_by(
+            ScoreSummary.mean.desc(),
+            ScoreSummary.key
+        )
+        if return_statement:
+            return query.statement
+        return query.all()
@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
 from pathlib import Path
@@ -19,4 +19,13 @@ Base = declarative_base()
 engine = create_engine(SQLALCHEMY_CONN_STRING)
 
 # this session should be used through all application to issue database commands
-session = Session(bind=engine)
\ No newline at end of file
+session = Session(bind=engine)
+
+
+def update_statistics():
+    """
+    Updates statistics of tables and indexes used by the SQLite query planner, so that joins, e.g. pairing of repeated
+    measurements, are planned from the most selective index. Should be called after loading data in bulk.
+    """
+    session.execute(text("ANALYZE"))
+    session.commit()